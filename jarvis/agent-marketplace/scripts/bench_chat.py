@@ -0,0 +1,154 @@
+"""Benchmark concurrent chat turns (POST /sessions/{id}/messages) in one worker.
+
+Runs the FastAPI app in-process, with ``fake_upstream.py`` served on a local
+port as the Anthropic API (the chat path uses the Anthropic SDK, which makes
+real HTTP connections), so no network access or API credits are needed. Each
+simulated user has their own session and sends ``--turns`` messages back to
+back.
+
+The number to watch is ``peak in flight``: how many chat turns were waiting
+on the model at the same moment. A route that blocks a thread for the model
+call tops out at the threadpool size (40 by default); the async route should
+track ``--users`` until the database or upstream becomes the limit.
+
+    python scripts/bench_chat.py --users 200 --turns 3 --upstream-latency-ms 1000 \
+        --db-latency-ms 2
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import httpx
+import uvicorn
+from bench_proxy import DBWrites, _make_engine, _percentiles
+from fake_upstream import FakeUpstreamConfig, create_app
+from sqlmodel import Session, SQLModel
+
+from marketplace import database
+from marketplace.auth import create_jwt
+from marketplace.config import get_settings
+from marketplace.encryption import encrypt_api_key
+from marketplace.main import app
+from marketplace.models import AgentProfile, AgentSession, User
+
+
+def _seed(engine, users: int) -> list[tuple[str, uuid.UUID]]:
+    """An agent plus one user and chat session per simulated user."""
+    with Session(engine) as session:
+        owner = User(email=f"bench-owner-{uuid.uuid4().hex[:8]}@example.com", password_hash="x")
+        session.add(owner)
+        session.commit()
+        session.refresh(owner)
+        agent = AgentProfile(
+            owner_id=owner.id,
+            name="Bench Chat Agent",
+            slug=f"bench-chat-{uuid.uuid4().hex[:8]}",
+            category="other",
+            listing_type="openclaw",
+            encrypted_api_key=encrypt_api_key("sk-ant-bench-key"),
+            has_api_key=True,
+            system_prompt="You are a benchmark agent.",
+        )
+        session.add(agent)
+        session.commit()
+        session.refresh(agent)
+
+        chats = []
+        for i in range(users):
+            user = User(email=f"bench-{i}-{uuid.uuid4().hex[:8]}@example.com", password_hash="x")
+            session.add(user)
+            session.flush()
+            chat = AgentSession(agent_profile_id=agent.id, user_id=user.id)
+            session.add(chat)
+            session.flush()
+            chats.append((create_jwt(str(user.id), user.email), chat.id))
+        session.commit()
+        return chats
+
+
+async def _drive(client: httpx.AsyncClient, chats, turns: int) -> dict:
+    stats = {"latencies": [], "statuses": Counter()}
+
+    async def user(token: str, session_id: uuid.UUID):
+        headers = {"authorization": f"Bearer {token}"}
+        for turn in range(turns):
+            started = time.perf_counter()
+            resp = await client.post(
+                f"/sessions/{session_id}/messages", json={"content": f"message {turn}"}, headers=headers
+            )
+            stats["latencies"].append((time.perf_counter() - started) * 1000)
+            stats["statuses"][resp.status_code] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(token, session_id) for token, session_id in chats))
+    stats["elapsed"] = time.perf_counter() - started
+    return stats
+
+
+def _serve_fake_upstream(args):
+    """Start the fake Anthropic API on a free local port in a background thread."""
+    fake = create_app(FakeUpstreamConfig(
+        latency_ms=args.upstream_latency_ms, jitter_ms=args.upstream_jitter_ms, seed=0
+    ))
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(
+        fake, host="127.0.0.1", port=port, log_level="warning", backlog=4096
+    ))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return fake, server, f"http://127.0.0.1:{port}"
+
+
+async def _run(args) -> dict:
+    engine = _make_engine(args.db_latency_ms)
+    SQLModel.metadata.create_all(engine)
+    database.set_engine(engine)
+    fake, server, url = _serve_fake_upstream(args)
+    get_settings().anthropic_api_url = url
+    chats = _seed(engine, args.users)
+    writes = DBWrites(engine)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://app", timeout=None) as client:
+        stats = await _drive(client, chats, args.turns)
+    server.should_exit = True
+    stats["writes"] = writes
+    stats["upstream"] = fake.state.stats
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200, help="concurrent chat sessions")
+    parser.add_argument("--turns", type=int, default=3, help="messages per session")
+    parser.add_argument("--upstream-latency-ms", type=float, default=1000)
+    parser.add_argument("--upstream-jitter-ms", type=float, default=0)
+    parser.add_argument("--db-latency-ms", type=float, default=2)
+    args = parser.parse_args()
+
+    stats = asyncio.run(_run(args))
+
+    elapsed = stats["elapsed"]
+    sent = len(stats["latencies"])
+    statuses = " ".join(f"{code}={n}" for code, n in sorted(stats["statuses"].items()))
+    print(f"turns:          {sent} from {args.users} users ({statuses})")
+    print(f"throughput:     {sent / elapsed:.1f} turns/s")
+    print(f"latency ms:     {_percentiles(stats['latencies'])}")
+    print(f"peak in flight: {stats['upstream']['max_in_flight']} turns waiting on the model at once")
+    stats["writes"].report(elapsed)
+
+
+if __name__ == "__main__":
+    main()
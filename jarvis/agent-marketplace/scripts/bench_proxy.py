@@ -0,0 +1,251 @@
+"""Benchmark concurrent throughput of the license proxy (/proxy/v1/messages).
+
+By default runs the FastAPI app in-process against ``fake_upstream.py``
+mounted as the upstream, so no network access or API credits are needed.
+``--db-latency-ms`` adds a blocking sleep to every SQL statement to emulate
+the round trip to a remote database, which is what exposes event-loop
+blocking in async routes.
+
+Reports throughput, end-to-end latency, the proxy's own overhead (from its
+Server-Timing header) and how many SQL writes and commits the load caused.
+
+Every request uses the same license, so ``--verify-counters`` doubles as a
+check that concurrent usage updates are never lost: the license's counters
+must equal exactly what succeeded.
+
+    python scripts/bench_proxy.py --requests 400 --concurrency 100 \
+        --upstream-latency-ms 200 --db-latency-ms 5 --verify-counters
+
+``--proxy-url`` drives an already running proxy instead (start it with
+``PROXY_SERVER_TIMING=true`` to get overhead percentiles; DB write rates are
+only measured in-process):
+
+    python scripts/bench_proxy.py --proxy-url http://127.0.0.1:8000 --license-key lic_...
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import httpx
+from fake_upstream import FakeUpstreamConfig, create_app
+from sqlalchemy import event
+from sqlmodel import Session, SQLModel, create_engine
+
+from marketplace import database, upstream
+from marketplace.config import get_settings
+from marketplace.encryption import encrypt_api_key
+from marketplace.licenses import create_license
+from marketplace.main import app
+from marketplace.models import AgentLicense, AgentPricingPlan, AgentProfile, User
+from marketplace.usage_sink import get_usage_sink
+
+INPUT_TOKENS = 12
+OUTPUT_TOKENS = 4
+
+_OVERHEAD = re.compile(r"(?:^|,)\s*overhead;dur=([0-9.]+)")
+
+
+class DBWrites:
+    """Counts write statements, rows and commits issued through an engine."""
+
+    def __init__(self, engine):
+        self.statements = Counter()
+        self.rows = 0
+        self.commits = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+        event.listen(engine, "commit", self._on_commit)
+
+    def _on_execute(self, _conn, _cursor, statement, parameters, _context, executemany):
+        verb = statement.lstrip().split(None, 1)[0].upper()
+        if verb in ("INSERT", "UPDATE", "DELETE"):
+            self.statements[verb] += 1
+            self.rows += len(parameters) if executemany else 1
+
+    def _on_commit(self, _conn):
+        self.commits += 1
+
+    def report(self, elapsed: float):
+        total = sum(self.statements.values())
+        detail = " ".join(f"{verb.lower()}={n}" for verb, n in sorted(self.statements.items()))
+        print(f"db writes:   {total} statements ({total / elapsed:.1f}/s; {detail}), "
+              f"{self.rows} rows, {self.commits} commits ({self.commits / elapsed:.1f}/s)")
+
+
+def _make_engine(db_latency_ms: float):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    if db_latency_ms:
+        @event.listens_for(engine, "before_cursor_execute")
+        def _slow(*_args):
+            time.sleep(db_latency_ms / 1000)
+    return engine
+
+
+def _seed(engine) -> AgentLicense:
+    with Session(engine) as session:
+        user = User(email=f"bench-{uuid.uuid4().hex[:8]}@example.com", password_hash="x")
+        session.add(user)
+        session.commit()
+        session.refresh(user)
+        agent = AgentProfile(
+            owner_id=user.id,
+            name="Bench Agent",
+            slug=f"bench-{uuid.uuid4().hex[:8]}",
+            category="other",
+            listing_type="openclaw",
+            encrypted_api_key=encrypt_api_key("sk-ant-bench-key"),
+            has_api_key=True,
+        )
+        session.add(agent)
+        session.commit()
+        session.refresh(agent)
+        plan = AgentPricingPlan(
+            agent_profile_id=agent.id,
+            plan_type="subscription",
+            price_cents=0,
+            billing_interval="monthly",
+            plan_name="Bench",
+        )
+        session.add(plan)
+        session.commit()
+        session.refresh(plan)
+        return create_license(session, agent.id, user.id, plan)
+
+
+def _fake_upstream(args) -> httpx.AsyncClient:
+    config = FakeUpstreamConfig(
+        latency_ms=args.upstream_latency_ms,
+        jitter_ms=args.upstream_jitter_ms,
+        input_tokens=INPUT_TOKENS,
+        output_tokens=OUTPUT_TOKENS,
+        error_rate=args.error_rate,
+        seed=0,
+    )
+    return httpx.AsyncClient(
+        base_url="http://upstream.local", transport=httpx.ASGITransport(app=create_app(config))
+    )
+
+
+async def _drive(client: httpx.AsyncClient, license_key: str, args) -> dict:
+    payload = {
+        "model": "claude-sonnet-4-20250514",
+        "max_tokens": 16,
+        "messages": [{"role": "user", "content": "ping"}],
+    }
+    if args.stream:
+        payload["stream"] = True
+    stats = {"latencies": [], "overheads": [], "statuses": Counter()}
+    queue: asyncio.Queue[int] = asyncio.Queue()
+    for i in range(args.requests):
+        queue.put_nowait(i)
+
+    async def worker():
+        while not queue.empty():
+            queue.get_nowait()
+            started = time.perf_counter()
+            async with client.stream(
+                "POST", "/proxy/v1/messages", json=payload, headers={"x-api-key": license_key}
+            ) as resp:
+                await resp.aread()
+            stats["latencies"].append((time.perf_counter() - started) * 1000)
+            stats["statuses"][resp.status_code] += 1
+            match = _OVERHEAD.search(resp.headers.get("server-timing", ""))
+            if match:
+                stats["overheads"].append(float(match.group(1)))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    stats["elapsed"] = time.perf_counter() - started
+    return stats
+
+
+async def _run(args) -> dict:
+    if args.proxy_url:
+        async with httpx.AsyncClient(base_url=args.proxy_url, timeout=None) as client:
+            return await _drive(client, args.license_key, args)
+
+    get_settings().proxy_server_timing = True
+    engine = _make_engine(args.db_latency_ms)
+    SQLModel.metadata.create_all(engine)
+    database.set_engine(engine)
+    upstream.set_upstream_client(_fake_upstream(args))
+    license = _seed(engine)
+    writes = DBWrites(engine)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://proxy", timeout=None) as client:
+        stats = await _drive(client, license.license_key, args)
+
+    await get_usage_sink().stop()
+    stats["writes"] = writes
+    if args.verify_counters:
+        _verify_counters(engine, license.id, stats["statuses"][200])
+    return stats
+
+
+def _verify_counters(engine, license_id, sent: int):
+    with Session(engine) as session:
+        license = session.get(AgentLicense, license_id)
+        expected_tokens = sent * (INPUT_TOKENS + OUTPUT_TOKENS)
+        assert license.total_messages == sent, (license.total_messages, sent)
+        assert license.period_messages == sent, (license.period_messages, sent)
+        assert license.total_tokens_used == expected_tokens, (license.total_tokens_used, expected_tokens)
+        assert license.period_tokens == expected_tokens, (license.period_tokens, expected_tokens)
+    print(f"counters:    exact ({sent} messages, {expected_tokens} tokens)")
+
+
+def _percentiles(values: list[float]) -> str:
+    values = sorted(values)
+    pct = lambda p: values[min(len(values) - 1, int(len(values) * p))]  # noqa: E731
+    return (f"p50={pct(0.50):.1f} p95={pct(0.95):.1f} p99={pct(0.99):.1f} "
+            f"mean={statistics.fmean(values):.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--stream", action="store_true", help="send streaming requests")
+    parser.add_argument("--upstream-latency-ms", type=float, default=200)
+    parser.add_argument("--upstream-jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of upstream responses replaced by injected errors")
+    parser.add_argument("--db-latency-ms", type=float, default=5)
+    parser.add_argument("--proxy-url", help="benchmark a running proxy instead of an in-process one")
+    parser.add_argument("--license-key", help="license key to use with --proxy-url")
+    parser.add_argument("--inline-usage", action="store_true",
+                        help="write usage inline instead of through the write-behind sink")
+    parser.add_argument("--verify-counters", action="store_true",
+                        help="assert the license counters match the requests sent")
+    args = parser.parse_args()
+    if args.proxy_url and not args.license_key:
+        parser.error("--proxy-url requires --license-key")
+    get_settings().usage_write_behind = not args.inline_usage
+
+    stats = asyncio.run(_run(args))
+
+    elapsed = stats["elapsed"]
+    statuses = " ".join(f"{code}={n}" for code, n in sorted(stats["statuses"].items()))
+    print(f"requests:    {len(stats['latencies'])} @ concurrency {args.concurrency} ({statuses})")
+    print(f"throughput:  {len(stats['latencies']) / elapsed:.1f} req/s")
+    print(f"latency ms:  {_percentiles(stats['latencies'])}")
+    if stats["overheads"]:
+        print(f"overhead ms: {_percentiles(stats['overheads'])}")
+    else:
+        print("overhead ms: n/a (start the proxy with PROXY_SERVER_TIMING=true)")
+    if "writes" in stats:
+        stats["writes"].report(elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""Local stand-in for the Anthropic Messages API, for load-testing the proxy.
+
+Serves ``POST /v1/messages`` (plain JSON and SSE streaming) and the Message
+Batches endpoints (batches end as soon as they are created) with configurable
+latency, token counts and injected errors, so the proxy can be driven hard
+with no network access or API credits:
+
+    python scripts/fake_upstream.py --port 8999 --latency-ms 200 --error-rate 0.02
+    ANTHROPIC_API_URL=http://127.0.0.1:8999 UPSTREAM_HTTP2=false \\
+        uvicorn marketplace.main:app --app-dir src
+
+``GET /stats`` reports what the fake has served. ``bench_proxy.py`` mounts
+the same app in-process through ``create_app``.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import uuid
+from dataclasses import dataclass
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+_ERROR_TYPES = {
+    400: "invalid_request_error",
+    401: "authentication_error",
+    429: "rate_limit_error",
+    500: "api_error",
+    529: "overloaded_error",
+}
+
+
+@dataclass
+class FakeUpstreamConfig:
+    latency_ms: float = 200.0  # Time to response headers
+    jitter_ms: float = 0.0  # Uniform +/- jitter on latency_ms
+    input_tokens: int | None = None  # None = roughly one token per 4 body bytes
+    output_tokens: int = 16  # Capped by the request's max_tokens
+    stream_chunks: int = 4  # Text deltas per streamed response
+    stream_chunk_ms: float = 10.0  # Delay between streamed deltas
+    error_rate: float = 0.0  # Fraction of requests answered with an error
+    error_statuses: tuple[int, ...] = (529, 429, 500)
+    retry_after: int = 1  # retry-after seconds on injected 429/529
+    stream_abort_rate: float = 0.0  # Fraction of streams cut off mid-response
+    seed: int | None = None
+
+
+def create_app(config: FakeUpstreamConfig | None = None) -> FastAPI:
+    config = config or FakeUpstreamConfig()
+    rng = random.Random(config.seed)
+    stats = {"requests": 0, "streams": 0, "errors": 0, "aborted": 0, "in_flight": 0, "max_in_flight": 0}
+    batches: dict[str, dict] = {}
+    app = FastAPI(title="Fake Anthropic upstream")
+    app.state.stats = stats
+
+    def _error(status: int) -> JSONResponse:
+        headers = {"retry-after": str(config.retry_after)} if status in (429, 529) else None
+        return JSONResponse(
+            {"type": "error", "error": {"type": _ERROR_TYPES.get(status, "api_error"), "message": "Injected error"}},
+            status_code=status,
+            headers=headers,
+        )
+
+    async def _stream(model: str, input_tokens: int, output_tokens: int, abort: bool):
+        def event(name: str, data: dict) -> bytes:
+            return f"event: {name}\ndata: {json.dumps(data)}\n\n".encode()
+
+        try:
+            yield event("message_start", {
+                "type": "message_start",
+                "message": {
+                    "id": f"msg_{uuid.uuid4().hex[:24]}", "type": "message", "role": "assistant",
+                    "model": model, "content": [], "stop_reason": None,
+                    "usage": {"input_tokens": input_tokens, "output_tokens": 1},
+                },
+            })
+            yield event("content_block_start", {
+                "type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""},
+            })
+            for i in range(config.stream_chunks):
+                await asyncio.sleep(config.stream_chunk_ms / 1000)
+                if abort and i == config.stream_chunks // 2:
+                    stats["aborted"] += 1
+                    raise ConnectionAbortedError("Injected stream abort")
+                yield event("content_block_delta", {
+                    "type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "ok "},
+                })
+            yield event("content_block_stop", {"type": "content_block_stop", "index": 0})
+            yield event("message_delta", {
+                "type": "message_delta",
+                "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                "usage": {"output_tokens": output_tokens},
+            })
+            yield event("message_stop", {"type": "message_stop"})
+        finally:
+            stats["in_flight"] -= 1
+
+    @app.post("/v1/messages")
+    async def messages(request: Request):
+        raw = await request.body()
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        streaming = False
+        try:
+            try:
+                body = json.loads(raw)
+            except ValueError:
+                stats["errors"] += 1
+                return _error(400)
+
+            delay = config.latency_ms + rng.uniform(-config.jitter_ms, config.jitter_ms)
+            await asyncio.sleep(max(0.0, delay) / 1000)
+            if config.error_rate and rng.random() < config.error_rate:
+                stats["errors"] += 1
+                return _error(rng.choice(config.error_statuses))
+
+            model = body.get("model", "claude-sonnet-4-20250514")
+            input_tokens = config.input_tokens if config.input_tokens is not None else max(1, len(raw) // 4)
+            output_tokens = min(config.output_tokens, body.get("max_tokens") or config.output_tokens)
+            if body.get("stream"):
+                stats["streams"] += 1
+                streaming = True
+                abort = bool(config.stream_abort_rate) and rng.random() < config.stream_abort_rate
+                return StreamingResponse(
+                    _stream(model, input_tokens, output_tokens, abort), media_type="text/event-stream"
+                )
+            return JSONResponse({
+                "id": f"msg_{uuid.uuid4().hex[:24]}",
+                "type": "message",
+                "role": "assistant",
+                "model": model,
+                "content": [{"type": "text", "text": "ok"}],
+                "stop_reason": "end_turn",
+                "stop_sequence": None,
+                "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens},
+            })
+        finally:
+            if not streaming:
+                stats["in_flight"] -= 1
+
+    def _batch_object(batch_id: str) -> dict:
+        results = batches[batch_id]["results"]
+        succeeded = sum(1 for line in results if line["result"]["type"] == "succeeded")
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended",
+            "request_counts": {
+                "processing": 0, "succeeded": succeeded, "errored": len(results) - succeeded,
+                "canceled": 0, "expired": 0,
+            },
+            "created_at": batches[batch_id]["created_at"],
+            "ended_at": batches[batch_id]["created_at"],
+            "results_url": f"/v1/messages/batches/{batch_id}/results",
+        }
+
+    @app.post("/v1/messages/batches")
+    async def create_batch(request: Request):
+        body = json.loads(await request.body())
+        await asyncio.sleep(config.latency_ms / 1000)
+        results = []
+        for item in body.get("requests", []):
+            params = item.get("params", {})
+            if config.error_rate and rng.random() < config.error_rate:
+                result = {"type": "errored", "error": {
+                    "type": "error", "error": {"type": "api_error", "message": "Injected error"},
+                }}
+            else:
+                input_tokens = (
+                    config.input_tokens if config.input_tokens is not None
+                    else max(1, len(json.dumps(params)) // 4)
+                )
+                result = {"type": "succeeded", "message": {
+                    "id": f"msg_{uuid.uuid4().hex[:24]}", "type": "message", "role": "assistant",
+                    "model": params.get("model", "claude-sonnet-4-20250514"),
+                    "content": [{"type": "text", "text": "ok"}], "stop_reason": "end_turn",
+                    "usage": {
+                        "input_tokens": input_tokens,
+                        "output_tokens": min(config.output_tokens, params.get("max_tokens") or config.output_tokens),
+                    },
+                }}
+            results.append({"custom_id": item.get("custom_id"), "result": result})
+        batch_id = f"msgbatch_{uuid.uuid4().hex[:24]}"
+        batches[batch_id] = {"results": results, "created_at": "2025-01-01T00:00:00Z"}
+        return _batch_object(batch_id)
+
+    @app.get("/v1/messages/batches/{batch_id}")
+    async def get_batch(batch_id: str):
+        if batch_id not in batches:
+            return JSONResponse(
+                {"type": "error", "error": {"type": "not_found_error", "message": "Batch not found"}},
+                status_code=404,
+            )
+        return _batch_object(batch_id)
+
+    @app.get("/v1/messages/batches/{batch_id}/results")
+    async def batch_results(batch_id: str):
+        if batch_id not in batches:
+            return JSONResponse(
+                {"type": "error", "error": {"type": "not_found_error", "message": "Batch not found"}},
+                status_code=404,
+            )
+
+        async def lines():
+            for line in batches[batch_id]["results"]:
+                yield (json.dumps(line) + "\n").encode()
+
+        return StreamingResponse(lines(), media_type="application/binary")
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8999)
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--input-tokens", type=int, default=None)
+    parser.add_argument("--output-tokens", type=int, default=16)
+    parser.add_argument("--stream-chunks", type=int, default=4)
+    parser.add_argument("--stream-chunk-ms", type=float, default=10)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-statuses", default="529,429,500",
+                        help="comma-separated statuses to pick injected errors from")
+    parser.add_argument("--stream-abort-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    config = FakeUpstreamConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        input_tokens=args.input_tokens,
+        output_tokens=args.output_tokens,
+        stream_chunks=args.stream_chunks,
+        stream_chunk_ms=args.stream_chunk_ms,
+        error_rate=args.error_rate,
+        error_statuses=tuple(int(s) for s in args.error_statuses.split(",") if s),
+        stream_abort_rate=args.stream_abort_rate,
+        seed=args.seed,
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,10 @@
+import secrets
 import uuid
 from datetime import UTC, datetime, timedelta
 
 import jwt
 from argon2 import PasswordHasher
-from fastapi import Depends, HTTPException, Security
+from fastapi import Depends, Header, HTTPException, Security
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from sqlmodel import Session, select
 
@@ -72,6 +73,16 @@ def get_current_user(
         raise HTTPException(401, "Invalid token")
 
 
+def require_admin(x_admin_token: str | None = Header(default=None)):
+    """Guard for operator-only routes: ``x-admin-token`` must match ``ADMIN_TOKEN``.
+
+    With no ``ADMIN_TOKEN`` configured these routes are closed to everyone.
+    """
+    expected = get_settings().admin_token
+    if not expected or not x_admin_token or not secrets.compare_digest(x_admin_token, expected):
+        raise HTTPException(403, "Admin access required")
+
+
 def get_optional_user(
     credentials: HTTPAuthorizationCredentials | None = Security(optional_security),
     session: Session = Depends(get_session),
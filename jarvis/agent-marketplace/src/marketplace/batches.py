@@ -0,0 +1,172 @@
+"""Message Batches through the license proxy: sizing, results scanning and reconciliation.
+
+A batch's token budget (each request's ``max_tokens`` plus its estimated
+input) is reserved on the license when the batch is created (see
+``quota.acquire_batch_quota``) and stays in ``AgentLicense.reserved_tokens``
+until the batch's results are reconciled. The results JSONL is scanned as it
+is relayed to the buyer, and the proxy also fetches it itself once it sees the
+batch has ended (on a status call, or from its periodic poll). Once the whole
+results stream has been read, every result becomes a ``ProxyUsageLog`` row,
+the license counters get the actual usage and the reservation is released,
+all in one transaction that only the first complete read of a batch can
+claim. Batches still unreconciled long after they must have ended have
+their reservation released without usage (``expire_batch_reservations``).
+"""
+
+import json
+from datetime import UTC, datetime, timedelta
+
+from sqlalchemy import insert, update
+from sqlmodel import Session, select
+
+from .licenses import increment_usage_counters
+from .models import ProxyBatch, ProxyUsageLog
+from .rollups import apply_usage_rollups
+from .tokens import estimate_input_tokens
+
+# Message Batches are billed at half the standard per-token price
+BATCH_PRICE_FACTOR = 0.5
+
+
+def summarize_batch_request(payload) -> tuple[int, int]:
+    """Request count and token reservation (max_tokens plus estimated input) of a batch.
+
+    Raises ValueError if the body is not a batch of requests with a positive
+    integer ``max_tokens`` each.
+    """
+    requests = payload.get("requests") if isinstance(payload, dict) else None
+    if not isinstance(requests, list) or not requests:
+        raise ValueError("requests: must be a non-empty list")
+    reserve = 0
+    for item in requests:
+        params = item.get("params") if isinstance(item, dict) else None
+        max_tokens = params.get("max_tokens") if isinstance(params, dict) else None
+        if not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens <= 0:
+            custom_id = item.get("custom_id") if isinstance(item, dict) else None
+            raise ValueError(f"requests[{custom_id!r}].params.max_tokens: must be a positive integer")
+        reserve += max_tokens + estimate_input_tokens(params)
+    return len(requests), reserve
+
+
+class BatchResultsTracker:
+    """Incrementally scans a Message Batch results stream (JSONL) for per-result usage.
+
+    Chunks are fed as they are relayed to the client; only the trailing
+    partial line is buffered.
+    """
+
+    def __init__(self):
+        self.results: list[dict] = []
+        self._partial = b""
+
+    def feed(self, chunk: bytes):
+        data = self._partial + chunk
+        lines = data.split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self._handle_line(line)
+
+    def finish(self):
+        """Handle a final line that was not newline-terminated."""
+        if self._partial:
+            self._handle_line(self._partial)
+            self._partial = b""
+
+    def _handle_line(self, line: bytes):
+        line = line.strip()
+        if not line:
+            return
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return
+        result = entry.get("result") or {}
+        result_type = result.get("type")
+        if result_type == "succeeded":
+            message = result.get("message") or {}
+            usage = message.get("usage") or {}
+            self.results.append({
+                "model": message.get("model") or "unknown",
+                "input_tokens": usage.get("input_tokens") or 0,
+                "output_tokens": usage.get("output_tokens") or 0,
+                "success": True,
+                "error_message": None,
+            })
+        elif result_type:
+            error = (result.get("error") or {}).get("error") or result.get("error") or {}
+            self.results.append({
+                "model": "unknown",
+                "input_tokens": 0,
+                "output_tokens": 0,
+                "success": False,
+                "error_message": error.get("message") or f"Batch request {result_type}",
+            })
+
+
+def reconcile_batch(session: Session, batch_id: str, rows: list[dict]) -> bool:
+    """Record a batch's results (ProxyUsageLog column dicts) and release its reservation.
+
+    Returns False, writing nothing, if the batch was already reconciled.
+    """
+    succeeded = [row for row in rows if row["success"]]
+    tokens = sum(row["total_tokens"] for row in succeeded)
+    cost_cents = sum(row["estimated_cost_cents"] for row in succeeded)
+    claimed = session.execute(
+        update(ProxyBatch)
+        .where(ProxyBatch.id == batch_id, ProxyBatch.reconciled_at.is_(None))
+        .values(
+            processing_status="ended",
+            succeeded_count=len(succeeded),
+            errored_count=len(rows) - len(succeeded),
+            total_tokens=tokens,
+            cost_cents=cost_cents,
+            reconciled_at=datetime.now(UTC).replace(tzinfo=None),
+        )
+    )
+    if claimed.rowcount != 1:
+        session.rollback()
+        return False
+
+    batch = session.get(ProxyBatch, batch_id)
+    if rows:
+        session.execute(insert(ProxyUsageLog), rows)
+        apply_usage_rollups(session, rows)
+    increment_usage_counters(
+        session, batch.license_id, len(succeeded), tokens, cost_cents,
+        released_tokens=batch.reserved_tokens,
+    )
+    session.commit()
+    return True
+
+
+def expire_batch_reservations(session: Session, max_age_seconds: float) -> list[str]:
+    """Release the reservation of batches left unreconciled for ``max_age_seconds``.
+
+    Upstream ends every batch within a day, so one still unreconciled long
+    after that never will be (its results expired, or its agent key was
+    removed). Each is claimed like a reconciliation, with no usage, so a later
+    results fetch is relayed without being billed. Returns the expired ids.
+    """
+    now = datetime.now(UTC).replace(tzinfo=None)
+    cutoff = now - timedelta(seconds=max_age_seconds)
+    batch_ids = session.exec(
+        select(ProxyBatch.id)
+        .where(ProxyBatch.reconciled_at.is_(None), ProxyBatch.created_at <= cutoff)
+    ).all()
+    expired = []
+    for batch_id in batch_ids:
+        claimed = session.execute(
+            update(ProxyBatch)
+            .where(ProxyBatch.id == batch_id, ProxyBatch.reconciled_at.is_(None))
+            .values(reconciled_at=now, updated_at=now)
+        )
+        if claimed.rowcount != 1:
+            session.rollback()
+            continue
+        batch = session.get(ProxyBatch, batch_id)
+        increment_usage_counters(
+            session, batch.license_id, 0, 0, 0, released_tokens=batch.reserved_tokens
+        )
+        session.commit()
+        expired.append(batch_id)
+    return expired
@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire ``ttl`` seconds after insertion.
+
+    ``on_evict`` is called (outside the lock) with each value the cache drops
+    on its own: expired, pushed out by ``maxsize`` or replaced by ``set``.
+    Values removed by ``pop``/``discard_*`` are returned to the caller instead.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                return value
+            del self._data[key]
+        if self.on_evict:
+            self.on_evict(value)
+        return default
+
+    def set(self, key, value, ttl: float | None = None):
+        if self.maxsize <= 0:
+            if self.on_evict:
+                self.on_evict(value)
+            return
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        evicted = []
+        with self._lock:
+            old = self._data.get(key)
+            if old is not None and old[1] is not value:
+                evicted.append(old[1])
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                evicted.append(self._data.popitem(last=False)[1][1])
+        if self.on_evict:
+            for old_value in evicted:
+                self.on_evict(old_value)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def discard_where(self, predicate) -> int:
+        """Drop every entry whose value matches ``predicate``; returns how many were dropped."""
+        with self._lock:
+            stale = [k for k, (_, value) in self._data.items() if predicate(value)]
+            for key in stale:
+                del self._data[key]
+        return len(stale)
+
+    def discard_where_key(self, predicate) -> list:
+        """Drop every entry whose key matches ``predicate``; returns the dropped values."""
+        with self._lock:
+            stale = [k for k in self._data if predicate(k)]
+            values = [self._data.pop(k)[1] for k in stale]
+        return values
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -0,0 +1,116 @@
+"""Token-budgeted chat history for agent sessions.
+
+Each ``AgentChatMessage`` stores its ``content_tokens`` when it is written,
+so choosing which turns fit the context window never re-tokenizes history:
+token counts are read newest-first, a page at a time and without message
+bodies, until the budget is spent, and only the chosen messages' content is
+loaded. A turn therefore costs the same however long the session has run.
+
+Sessions with a rolling summary (see ``chat_summary``) send the summary as
+part of the system prompt in place of the turns it covers.
+"""
+
+import uuid
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+from sqlmodel import Session, col, func, select
+
+from .config import get_settings
+from .models import AgentChatMessage
+from .tokens import MESSAGE_OVERHEAD_TOKENS, estimate_system_tokens
+
+_PAGE_SIZE = 100
+# For messages stored before token counts were: a high estimate from length
+_CHARS_PER_TOKEN_FALLBACK = 3
+
+
+def iter_message_costs(session: Session, session_id: uuid.UUID, after: datetime | None = None):
+    """Yield ``(id, role, tokens, created_at)`` for a session's messages, newest first.
+
+    ``tokens`` includes per-message overhead. Only messages newer than
+    ``after`` are read, a page at a time and without their content. Pages
+    continue from the last ``(created_at, id)`` seen, so messages sharing a
+    timestamp across a page boundary are neither skipped nor repeated.
+    """
+    before: tuple[datetime, uuid.UUID] | None = None
+    while True:
+        query = (
+            select(AgentChatMessage.id, AgentChatMessage.role, AgentChatMessage.content_tokens,
+                   func.length(AgentChatMessage.content), AgentChatMessage.created_at)
+            .where(AgentChatMessage.session_id == session_id)
+            .order_by(col(AgentChatMessage.created_at).desc(), col(AgentChatMessage.id).desc())
+            .limit(_PAGE_SIZE)
+        )
+        if before is not None:
+            before_at, before_id = before
+            query = query.where(or_(
+                AgentChatMessage.created_at < before_at,
+                and_(AgentChatMessage.created_at == before_at, AgentChatMessage.id < before_id),
+            ))
+        if after is not None:
+            query = query.where(AgentChatMessage.created_at > after)
+        page = session.exec(query).all()
+        for msg_id, role, tokens, length, created_at in page:
+            tokens = tokens or (length or 0) // _CHARS_PER_TOKEN_FALLBACK + 1
+            yield msg_id, role, tokens + MESSAGE_OVERHEAD_TOKENS, created_at
+            before = created_at, msg_id
+        if len(page) < _PAGE_SIZE:
+            return
+
+
+def _tail(session: Session, session_id: uuid.UUID, budget: int, after: datetime | None) -> list[uuid.UUID]:
+    """Ids of the most recent messages whose tokens fit in ``budget``, oldest first.
+
+    The newest message is always included, even if it alone exceeds the budget.
+    """
+    chosen: list[tuple[uuid.UUID, str]] = []
+    used = 0
+    for msg_id, role, cost, _ in iter_message_costs(session, session_id, after):
+        if chosen and used + cost > budget:
+            break
+        chosen.append((msg_id, role))
+        used += cost
+    return _starting_with_user(chosen)
+
+
+def _starting_with_user(newest_first: list[tuple[uuid.UUID, str]]) -> list[uuid.UUID]:
+    """Oldest-first ids, dropping leading assistant turns (a request must start with a user turn)."""
+    ids = [(msg_id, role) for msg_id, role in reversed(newest_first)]
+    while len(ids) > 1 and ids[0][1] != "user":
+        ids.pop(0)
+    return [msg_id for msg_id, _ in ids]
+
+
+def system_with_summary(system_prompt: str, summary: str | None):
+    """The ``system`` parameter for a chat turn: the agent's prompt, then any rolling summary."""
+    if not summary:
+        return system_prompt
+    return [
+        {"type": "text", "text": system_prompt},
+        {"type": "text", "text": f"Summary of the earlier conversation:\n{summary}"},
+    ]
+
+
+def build_context(
+    session: Session,
+    session_id: uuid.UUID,
+    system,
+    budget: int | None = None,
+    after: datetime | None = None,
+) -> list[dict]:
+    """The most recent turns of a chat session that fit, with ``system``, in ``budget`` tokens.
+
+    With ``after`` (a summary's ``summarized_until``), older turns are never sent.
+    """
+    if budget is None:
+        budget = get_settings().chat_context_max_tokens
+    ids = _tail(session, session_id, max(0, budget - estimate_system_tokens(system)), after)
+    if not ids:
+        return []
+    rows = session.exec(
+        select(AgentChatMessage.role, AgentChatMessage.content)
+        .where(col(AgentChatMessage.id).in_(ids))
+        .order_by(AgentChatMessage.created_at, AgentChatMessage.id)
+    ).all()
+    return [{"role": role, "content": content} for role, content in rows]
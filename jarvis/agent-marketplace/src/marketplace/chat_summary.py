@@ -0,0 +1,215 @@
+"""Rolling summaries of long chat sessions.
+
+With ``chat_summary_enabled``, every finished chat turn queues its session
+here. A background worker checks how much of the session's history is not
+yet covered by its summary; past ``chat_summary_trigger_tokens`` it folds the
+oldest of those turns (keeping the newest ``chat_summary_keep_tokens``
+verbatim) into ``AgentSession.summary`` with one model call that sees only
+the previous summary and the new turns. Chat turns then send the summary in
+place of the turns it covers (see ``chat_context``).
+
+Summaries are written with a conditional update on ``summarized_until``, so
+two passes over the same turns can never both land.
+"""
+
+import asyncio
+import logging
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+
+from sqlalchemy import update
+from sqlmodel import Session, col, select
+
+from .chat_context import iter_message_costs
+from .config import get_settings
+from .database import get_engine, run_in_db_thread
+from .key_pool import PoolKey, load_pool
+from .llm import call_agent_async
+from .models import AgentChatMessage, AgentProfile, AgentSession, _utcnow
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_SYSTEM_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Merge the new turns into the summary so far. Keep what the user has told the assistant "
+    "about themselves and their goals, decisions, results and open questions; drop greetings "
+    "and repetition. Reply with the updated summary only."
+)
+
+
+@dataclass
+class _Fold:
+    """Turns due to be folded into a session's summary."""
+
+    session_id: uuid.UUID
+    agent_id: uuid.UUID
+    api_keys: tuple[PoolKey, ...]
+    previous: str | None
+    summarized_until: datetime | None
+    turns: list[tuple[str, str]]  # (role, content), oldest first
+    until: datetime  # created_at of the newest folded turn
+
+
+def _pending_fold(session_id: uuid.UUID) -> _Fold | None:
+    settings = get_settings()
+    with Session(get_engine()) as session:
+        chat_session = session.get(AgentSession, session_id)
+        agent = session.get(AgentProfile, chat_session.agent_profile_id) if chat_session else None
+        api_keys = load_pool(session, agent) if agent else ()
+        if not api_keys:
+            return None
+
+        # Newest first; bounded, since summarizing keeps the unsummarized part short
+        costs = list(iter_message_costs(session, session_id, chat_session.summarized_until))
+        if sum(cost for _, _, cost, _ in costs) <= settings.chat_summary_trigger_tokens:
+            return None
+
+        kept, used = 0, 0
+        while kept < len(costs) and used + costs[kept][2] <= settings.chat_summary_keep_tokens:
+            used += costs[kept][2]
+            kept += 1
+        # The verbatim history has to start with a user turn
+        while kept > 0 and costs[kept - 1][1] != "user":
+            kept -= 1
+
+        batch, used = [], 0
+        for msg_id, _, cost, created_at in reversed(costs[kept:]):
+            if batch and used + cost > settings.chat_summary_batch_tokens:
+                break
+            batch.append((msg_id, created_at))
+            used += cost
+        if not batch:
+            return None
+
+        turns = session.exec(
+            select(AgentChatMessage.role, AgentChatMessage.content)
+            .where(col(AgentChatMessage.id).in_([msg_id for msg_id, _ in batch]))
+            .order_by(AgentChatMessage.created_at, AgentChatMessage.id)
+        ).all()
+        return _Fold(
+            session_id=session_id,
+            agent_id=agent.id,
+            api_keys=api_keys,
+            previous=chat_session.summary,
+            summarized_until=chat_session.summarized_until,
+            turns=[(role, content) for role, content in turns],
+            until=batch[-1][1],
+        )
+
+
+def _fold_prompt(fold: _Fold) -> str:
+    parts = []
+    if fold.previous:
+        parts.append(f"Summary so far:\n{fold.previous}")
+    turns = "\n\n".join(
+        f"{'User' if role == 'user' else 'Assistant'}: {content}" for role, content in fold.turns
+    )
+    parts.append(f"New turns:\n{turns}")
+    parts.append("Write the updated summary.")
+    return "\n\n".join(parts)
+
+
+def _store_summary(fold: _Fold, result: dict) -> bool:
+    unchanged = (
+        AgentSession.summarized_until.is_(None)
+        if fold.summarized_until is None
+        else AgentSession.summarized_until == fold.summarized_until
+    )
+    with Session(get_engine()) as session:
+        claimed = session.execute(
+            update(AgentSession)
+            .where(AgentSession.id == fold.session_id, unchanged)
+            .values(
+                summary=result["content"].strip(),
+                summary_tokens=result["output_tokens"],
+                summarized_until=fold.until,
+                summary_updated_at=_utcnow(),
+            )
+        )
+        session.commit()
+        return claimed.rowcount == 1
+
+
+class SessionSummarizer:
+    """Background workers that keep long sessions' rolling summaries up to date."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._queue: asyncio.Queue | None = None
+        self._queued: set[uuid.UUID] = set()
+        self._active: set[uuid.UUID] = set()
+        self._tasks: list[asyncio.Task] = []
+
+    def submit(self, session_id: uuid.UUID):
+        """Queue a session for a check after a turn; cheap and never blocks."""
+        if not get_settings().chat_summary_enabled or session_id in self._queued:
+            return
+        if not self._tasks:
+            self.start()
+        self._queued.add(session_id)
+        self._queue.put_nowait(session_id)
+
+    def start(self):
+        if self._tasks or not get_settings().chat_summary_enabled:
+            return
+        self._queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._run()) for _ in range(self.workers)]
+
+    async def _run(self):
+        while True:
+            session_id = await self._queue.get()
+            self._queued.discard(session_id)
+            # A session already being summarized is queued again when that pass lands
+            if session_id in self._active:
+                continue
+            self._active.add(session_id)
+            stored = False
+            try:
+                stored = await self.summarize(session_id)
+            except Exception:
+                logger.exception("Summarizing chat session %s failed", session_id)
+            finally:
+                self._active.discard(session_id)
+            if stored:
+                # A long backlog takes several passes
+                self.submit(session_id)
+
+    async def summarize(self, session_id: uuid.UUID) -> bool:
+        """Fold one batch of a session's older turns into its summary; False if none was due."""
+        fold = await run_in_db_thread(_pending_fold, session_id)
+        if fold is None:
+            return False
+        settings = get_settings()
+        result = await call_agent_async(
+            fold.agent_id,
+            fold.api_keys,
+            system_prompt=SUMMARY_SYSTEM_PROMPT,
+            messages=[{"role": "user", "content": _fold_prompt(fold)}],
+            model=settings.chat_summary_model,
+            temperature=0.0,
+            max_tokens=settings.chat_summary_max_tokens,
+        )
+        return await run_in_db_thread(_store_summary, fold, result)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        self._queued.clear()
+
+
+_summarizer: SessionSummarizer | None = None
+
+
+def get_summarizer() -> SessionSummarizer:
+    global _summarizer
+    if _summarizer is None:
+        _summarizer = SessionSummarizer(get_settings().chat_summary_workers)
+    return _summarizer
@@ -10,6 +10,122 @@ class Settings(BaseSettings):
     base_url: str = "http://localhost:8000"
     frontend_origin: str = "http://localhost:3000"
     encryption_key: str = "swarm-dev-encryption-key-change-in-production"
+    # Operator token for internal status routes (x-admin-token); unset disables them
+    admin_token: str | None = None
+
+    # Database connection pool and the worker threads async routes use for DB calls
+    db_pool_size: int = 10
+    db_max_overflow: int = 10
+    db_thread_pool_size: int = 20
+
+    # Validated license/plan/agent snapshots used by the proxy
+    license_cache_size: int = 10_000
+    license_cache_ttl_seconds: float = 60.0
+
+    # Decrypted creator API keys and their Anthropic clients
+    api_key_cache_size: int = 1_000
+    api_key_cache_ttl_seconds: float = 300.0
+
+    # Opt-in per-agent cache of deterministic (temperature 0) proxy responses
+    response_cache_size: int = 5_000
+    response_cache_ttl_seconds: float = 3600.0
+    response_cache_max_entry_bytes: int = 256 * 1024
+
+    # Local token estimates for quota pre-flight checks; bodies larger than
+    # token_estimate_max_body_bytes only reserve their max_tokens
+    token_count_cache_size: int = 10_000
+    token_count_cache_ttl_seconds: float = 3600.0
+    token_estimate_max_body_bytes: int = 256 * 1024
+
+    # Chat turns send the system prompt plus as much recent history as fits here
+    chat_context_max_tokens: int = 16_000
+    # Rolling chat summaries: once a session's unsummarized history passes
+    # chat_summary_trigger_tokens, its older turns (up to chat_summary_batch_tokens
+    # per pass) are folded into the session summary in the background, keeping
+    # the newest chat_summary_keep_tokens verbatim
+    chat_summary_enabled: bool = False
+    chat_summary_trigger_tokens: int = 12_000
+    chat_summary_keep_tokens: int = 4_000
+    chat_summary_batch_tokens: int = 16_000
+    chat_summary_max_tokens: int = 1_024
+    chat_summary_model: str = "claude-haiku-4-5-20251001"
+    chat_summary_workers: int = 2
+    # Mark the system prompt and the history before the newest user turn as
+    # prompt-cache breakpoints, so repeated prefixes are read from the cache
+    chat_prompt_cache_enabled: bool = True
+
+    # Write-behind proxy usage logging
+    usage_write_behind: bool = True
+    usage_flush_interval_ms: int = 500
+    usage_flush_max_records: int = 500
+    usage_spill_dir: str = "usage_spill"
+
+    # Upstream (Anthropic) HTTP client used by the license proxy
+    anthropic_api_url: str = "https://api.anthropic.com"
+    upstream_http2: bool = True
+    upstream_max_connections: int = 200
+    upstream_max_keepalive_connections: int = 50
+    upstream_keepalive_expiry: float = 60.0
+    upstream_connect_timeout: float = 10.0
+    upstream_read_timeout: float = 300.0
+    upstream_write_timeout: float = 30.0
+    upstream_pool_timeout: float = 10.0
+
+    # Per-upstream-key concurrency gate (limit adapts down on 429/529)
+    upstream_max_in_flight_per_key: int = 16
+    upstream_max_queue_per_key: int = 256
+    upstream_queue_timeout_seconds: float = 30.0
+    # Gates idle this long are dropped, and at most this many idle ones are kept
+    upstream_gate_idle_seconds: float = 3600.0
+    upstream_gates: int = 5_000
+
+    # Agent API key pools: a key sits out this long after a 429 (longer if its
+    # retry-after says so) or after a 401/403
+    key_throttle_eject_seconds: float = 30.0
+    key_auth_eject_seconds: float = 600.0
+    # Per-key balancer state idle this long is dropped, and at most this many
+    # idle entries are kept
+    key_state_idle_seconds: float = 3600.0
+    key_states: int = 5_000
+
+    # Upstream retries (connect errors and 529 only), hedging and circuit breaker
+    upstream_max_retries: int = 2
+    upstream_retry_backoff_base_ms: int = 250
+    upstream_retry_backoff_cap_ms: int = 4000
+    upstream_hedge_enabled: bool = False
+    upstream_hedge_percentile: float = 95.0
+    upstream_hedge_min_samples: int = 50
+    # Hedge-delay latency windows, one per (agent, model)
+    upstream_latency_windows: int = 5_000
+    upstream_latency_window_ttl_seconds: float = 3600.0
+    circuit_failure_threshold: int = 5
+    circuit_reset_seconds: float = 30.0
+
+    # Proxied request bodies: hard size limit, and how much is buffered in memory
+    # before spilling to a temporary file
+    proxy_max_body_bytes: int = 32 * 1024 * 1024
+    proxy_body_spool_bytes: int = 1024 * 1024
+    # Message Batch create bodies are parsed in full to size the reservation
+    proxy_max_batch_body_bytes: int = 256 * 1024 * 1024
+    # Unreconciled Message Batches are polled upstream this often (0 disables
+    # the poll) and their reservation is released once they are this old
+    batch_poll_interval_seconds: float = 300.0
+    batch_reservation_ttl_seconds: float = 3 * 24 * 3600.0
+
+    # Per-phase proxy timings as a Server-Timing response header
+    proxy_server_timing: bool = False
+
+    # Redis-backed license quota and rate counters (unset = DB only)
+    redis_url: str | None = None
+    redis_socket_timeout: float = 0.25
+    redis_retry_seconds: float = 15.0
+    # Reservations outliving this are released: Redis holds expire, database
+    # ones are cleared by the rollover schedule
+    quota_hold_ttl_seconds: float = 900.0
+
+    # Billing-period rollover job (0 disables the in-process schedule)
+    rollover_interval_seconds: float = 3600.0
+    rollover_chunk_size: int = 1000
 
     model_config = {"env_file": ".env", "env_file_encoding": "utf-8"}
 
@@ -1,8 +1,12 @@
+import functools
+
+import anyio
 from sqlmodel import Session, create_engine
 
 from .config import get_settings
 
 _engine = None
+_db_limiter: anyio.CapacityLimiter | None = None
 
 
 def get_engine():
@@ -16,6 +20,10 @@ def get_engine():
         kwargs = {}
         if url.startswith("sqlite"):
             kwargs["connect_args"] = {"check_same_thread": False}
+        else:
+            kwargs["pool_size"] = settings.db_pool_size
+            kwargs["max_overflow"] = settings.db_max_overflow
+            kwargs["pool_pre_ping"] = True
         _engine = create_engine(url, echo=False, **kwargs)
     return _engine
 
@@ -29,3 +37,18 @@ def set_engine(engine):
 def get_session():
     with Session(get_engine()) as session:
         yield session
+
+
+async def run_in_db_thread(func, *args, **kwargs):
+    """Run blocking DB work from an async route without stalling the event loop.
+
+    Calls share a dedicated thread limiter (``db_thread_pool_size``) so that a
+    burst of proxied requests cannot starve Starlette's default thread pool or
+    open more connections than the engine pool can hand out.
+    """
+    global _db_limiter
+    if _db_limiter is None:
+        _db_limiter = anyio.CapacityLimiter(get_settings().db_thread_pool_size)
+    return await anyio.to_thread.run_sync(
+        functools.partial(func, *args, **kwargs), limiter=_db_limiter
+    )
@@ -3,7 +3,10 @@ import hashlib
 
 from cryptography.fernet import Fernet
 
+from .cache import TTLCache
+
 _fernet_instance = None
+_secret_cache: TTLCache | None = None
 
 
 def _get_fernet() -> Fernet:
@@ -30,6 +33,39 @@ def decrypt_api_key(encrypted_key: str) -> str:
     return decrypted.decode()
 
 
+def _get_secret_cache() -> TTLCache:
+    global _secret_cache
+    if _secret_cache is None:
+        from .config import get_settings
+
+        settings = get_settings()
+        _secret_cache = TTLCache(
+            maxsize=settings.api_key_cache_size, ttl=settings.api_key_cache_ttl_seconds
+        )
+    return _secret_cache
+
+
+def secret_cache_key(agent_id, encrypted_key: str) -> tuple:
+    """Cache key for an agent's key; a rotated key has a new ciphertext and so a new entry."""
+    return (agent_id, hashlib.sha256(encrypted_key.encode()).hexdigest())
+
+
+def get_agent_api_key(agent_id, encrypted_key: str) -> str:
+    """Decrypt an agent's API key, reusing a recent decryption when available."""
+    cache = _get_secret_cache()
+    key = secret_cache_key(agent_id, encrypted_key)
+    plain_key = cache.get(key)
+    if plain_key is None:
+        plain_key = decrypt_api_key(encrypted_key)
+        cache.set(key, plain_key)
+    return plain_key
+
+
+def forget_agent_api_key(agent_id):
+    """Drop every cached decryption for an agent (key rotated or removed)."""
+    _get_secret_cache().discard_where_key(lambda key: key[0] == agent_id)
+
+
 def mask_api_key(plain_key: str) -> str:
     if len(plain_key) <= 12:
         return "****"
@@ -0,0 +1,168 @@
+"""Balancing upstream calls across an agent's pool of Anthropic API keys.
+
+An agent's pool is its primary key (``AgentProfile.encrypted_api_key``) plus
+its active ``AgentApiKey`` rows. Each call takes the key with the fewest
+calls in flight per unit of ``weight``. A key that answers 429 is ejected for
+its ``retry-after`` (at least ``key_throttle_eject_seconds``); one that
+answers 401/403 is ejected for ``key_auth_eject_seconds``. When every key is
+ejected, the one due back soonest is used rather than failing locally.
+
+State is per process and guarded by a lock, so the async proxy and the
+threaded chat path share one balancer. A removed key's state is dropped with
+it; state for keys that sit idle is expired like the upstream gates.
+"""
+
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+
+from sqlmodel import Session, select
+
+from .config import get_settings
+from .models import AgentApiKey
+from .upstream_gate import parse_retry_after
+
+THROTTLE_STATUSES = {429}
+AUTH_STATUSES = {401, 403}
+
+
+@dataclass(frozen=True, slots=True)
+class PoolKey:
+    id: uuid.UUID | None  # None = the agent's primary key
+    encrypted_api_key: str
+    weight: int = 1
+
+    @property
+    def label(self) -> str:
+        return str(self.id) if self.id else "primary"
+
+
+def build_pool(primary_encrypted_key: str | None, keys) -> tuple[PoolKey, ...]:
+    """Pool of the primary key (if set) and the given AgentApiKey rows."""
+    pool = [PoolKey(None, primary_encrypted_key)] if primary_encrypted_key else []
+    pool.extend(PoolKey(k.id, k.encrypted_api_key, max(1, k.weight)) for k in keys)
+    return tuple(pool)
+
+
+def load_pool(session: Session, agent) -> tuple[PoolKey, ...]:
+    keys = session.exec(
+        select(AgentApiKey)
+        .where(AgentApiKey.agent_profile_id == agent.id, AgentApiKey.is_active == True)  # noqa: E712
+        .order_by(AgentApiKey.created_at)
+    ).all()
+    return build_pool(agent.encrypted_api_key, keys)
+
+
+@dataclass
+class _KeyState:
+    in_flight: int = 0
+    ejected_until: float = 0.0
+    total_calls: int = 0
+    total_ejections: int = 0
+    last_status: int | None = None
+    last_used: float = 0.0
+
+
+class KeyBalancer:
+    """Least-in-flight, weighted key choice with temporary ejection."""
+
+    def __init__(self):
+        self._states: dict[tuple, _KeyState] = {}
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+
+    def _state(self, agent_id, key: PoolKey, now: float) -> _KeyState:
+        state = self._states.get((agent_id, key.id))
+        if state is None:
+            settings = get_settings()
+            if (len(self._states) >= settings.key_states
+                    or now - self._last_prune > settings.key_state_idle_seconds):
+                self._prune(now, settings.key_states - 1, settings.key_state_idle_seconds)
+            state = self._states[(agent_id, key.id)] = _KeyState()
+        state.last_used = now
+        return state
+
+    def _prune(self, now: float, max_states: int, idle_seconds: float):
+        """Drop idle state (nothing in flight, not ejected): stale first, then the oldest over ``max_states``."""
+        self._last_prune = now
+        idle = sorted(
+            ((state.last_used, key) for key, state in self._states.items()
+             if not state.in_flight and state.ejected_until <= now),
+            key=lambda item: item[0],
+        )
+        excess = len(self._states) - max_states
+        for last_used, key in idle:
+            if last_used > now - idle_seconds and excess <= 0:
+                break
+            del self._states[key]
+            excess -= 1
+
+    def acquire(self, agent_id, keys: tuple[PoolKey, ...]) -> PoolKey:
+        """Pick a key for one call; pair every acquire with a ``release``."""
+        if not keys:
+            raise ValueError("Agent has no API key configured")
+        now = time.monotonic()
+        with self._lock:
+            candidates = [(key, self._state(agent_id, key, now)) for key in keys]
+            live = [(key, state) for key, state in candidates if state.ejected_until <= now]
+            if live:
+                key, state = min(
+                    live, key=lambda ks: ((ks[1].in_flight + 1) / ks[0].weight, random.random())
+                )
+            else:
+                key, state = min(candidates, key=lambda ks: ks[1].ejected_until)
+            state.in_flight += 1
+            state.total_calls += 1
+            return key
+
+    def release(self, agent_id, key: PoolKey, status_code: int | None = None, retry_after: str | None = None):
+        settings = get_settings()
+        now = time.monotonic()
+        with self._lock:
+            state = self._states.get((agent_id, key.id))
+            if state is None:
+                return  # The key was removed while the call was in flight
+            state.in_flight = max(0, state.in_flight - 1)
+            if status_code is None:
+                return
+            state.last_status = status_code
+            if status_code in THROTTLE_STATUSES:
+                pause = max(parse_retry_after(retry_after) or 0.0, settings.key_throttle_eject_seconds)
+            elif status_code in AUTH_STATUSES:
+                pause = settings.key_auth_eject_seconds
+            else:
+                return
+            state.ejected_until = max(state.ejected_until, now + pause)
+            state.total_ejections += 1
+
+    def forget(self, agent_id, key_id: uuid.UUID | None):
+        """Drop a removed or replaced key's state (``key_id`` None = the primary key)."""
+        with self._lock:
+            self._states.pop((agent_id, key_id), None)
+
+    def snapshot(self, agent_id=None) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                f"{a}/{k or 'primary'}": {
+                    "in_flight": s.in_flight,
+                    "ejected_for_ms": max(0, int((s.ejected_until - now) * 1000)),
+                    "total_calls": s.total_calls,
+                    "total_ejections": s.total_ejections,
+                    "last_status": s.last_status,
+                }
+                for (a, k), s in self._states.items()
+                if agent_id is None or a == agent_id
+            }
+
+
+_balancer: KeyBalancer | None = None
+
+
+def get_key_balancer() -> KeyBalancer:
+    global _balancer
+    if _balancer is None:
+        _balancer = KeyBalancer()
+    return _balancer
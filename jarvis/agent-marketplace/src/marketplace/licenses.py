@@ -1,9 +1,74 @@
 import secrets
+import uuid
+from dataclasses import dataclass
 from datetime import UTC, datetime, timedelta
 
+from sqlalchemy import case, func, or_, update
 from sqlmodel import Session, select
 
-from .models import AgentLicense, AgentPricingPlan, AgentProfile
+from .cache import TTLCache
+from .config import get_settings
+from .key_pool import PoolKey, load_pool
+from .models import AgentLicense, AgentPricingPlan, AgentProfile, ProxyBatch
+
+
+# ── Validated snapshots ─────────────────────────────────────────────
+#
+# validate_license caches the parts of a license that do not change per
+# request. Status and usage counters are always read fresh, so quota checks
+# stay exact; the cache only saves the plan and agent lookups.
+
+
+@dataclass(frozen=True, slots=True)
+class LicenseSnapshot:
+    id: uuid.UUID
+    agent_profile_id: uuid.UUID
+    buyer_id: uuid.UUID
+    pricing_plan_id: uuid.UUID
+    license_key: str
+    expires_at: datetime | None
+
+
+@dataclass(frozen=True, slots=True)
+class PlanSnapshot:
+    id: uuid.UUID
+    plan_type: str
+    billing_interval: str | None
+    max_messages_per_period: int | None
+    max_tokens_per_period: int | None
+    max_requests_per_minute: int | None
+    is_active: bool
+
+
+@dataclass(frozen=True, slots=True)
+class AgentSnapshot:
+    id: uuid.UUID
+    owner_id: uuid.UUID
+    name: str
+    listing_type: str
+    encrypted_api_key: str | None
+    proxy_response_cache: bool
+    api_keys: tuple[PoolKey, ...] = ()
+
+
+_license_cache: TTLCache | None = None
+
+
+def _get_license_cache() -> TTLCache:
+    global _license_cache
+    if _license_cache is None:
+        settings = get_settings()
+        _license_cache = TTLCache(
+            maxsize=settings.license_cache_size, ttl=settings.license_cache_ttl_seconds
+        )
+    return _license_cache
+
+
+def billing_period(billing_interval: str | None) -> timedelta | None:
+    """Length of one billing period, or None for plans without recurring periods."""
+    if not billing_interval:
+        return None
+    return timedelta(days=365) if billing_interval == "yearly" else timedelta(days=30)
 
 
 def generate_license_key() -> str:
@@ -22,10 +87,7 @@ def create_license(
     if plan.plan_type == "rental" and plan.rental_duration_days:
         expires_at = now + timedelta(days=plan.rental_duration_days)
     elif plan.plan_type == "subscription" and plan.billing_interval:
-        if plan.billing_interval == "yearly":
-            expires_at = now + timedelta(days=365)
-        else:
-            expires_at = now + timedelta(days=30)
+        expires_at = now + billing_period(plan.billing_interval)
 
     license = AgentLicense(
         agent_profile_id=agent_profile_id,
@@ -44,34 +106,230 @@ def create_license(
 
 
 def validate_license(session: Session, license_key: str) -> dict:
-    license = session.exec(
-        select(AgentLicense).where(AgentLicense.license_key == license_key)
-    ).first()
-    if not license:
-        raise ValueError("Invalid license key")
+    license_cache = _get_license_cache()
+    cached = license_cache.get(license_key)
+    if cached is None:
+        cached = _load_snapshots(session, license_key)
+        license_cache.set(license_key, cached)
+    license, plan, agent = cached
+
+    status, period_messages, period_tokens, reserved_tokens, period_start = session.exec(
+        select(
+            AgentLicense.status,
+            AgentLicense.period_messages,
+            AgentLicense.period_tokens,
+            AgentLicense.reserved_tokens,
+            AgentLicense.period_start,
+        ).where(AgentLicense.id == license.id)
+    ).one()
 
-    if license.status != "active":
-        raise ValueError(f"License is {license.status}")
+    if status != "active":
+        invalidate_license(license_key)
+        raise ValueError(f"License is {status}")
 
     now = datetime.now(UTC).replace(tzinfo=None)
     if license.expires_at and now > license.expires_at:
-        license.status = "expired"
-        session.add(license)
-        session.commit()
+        _set_status(session, license.id, "expired")
+        invalidate_license(license_key)
         raise ValueError("License has expired")
 
-    plan = session.get(AgentPricingPlan, license.pricing_plan_id)
-    if not plan:
-        raise ValueError("License plan not found")
-
     # Check usage limits
-    if plan.max_messages_per_period and license.period_messages >= plan.max_messages_per_period:
+    if plan.max_messages_per_period and period_messages >= plan.max_messages_per_period:
         raise ValueError("Message limit reached for this billing period")
-    if plan.max_tokens_per_period and license.period_tokens >= plan.max_tokens_per_period:
+    if plan.max_tokens_per_period and period_tokens >= plan.max_tokens_per_period:
         raise ValueError("Token limit reached for this billing period")
 
-    agent = session.get(AgentProfile, license.agent_profile_id)
+    return {
+        "license": license,
+        "agent": agent,
+        "plan": plan,
+        "period_messages": period_messages,
+        "period_tokens": period_tokens,
+        "reserved_tokens": reserved_tokens,
+        "period_start": period_start,
+    }
+
+
+def _load_snapshots(
+    session: Session, license_key: str
+) -> tuple[LicenseSnapshot, PlanSnapshot, AgentSnapshot]:
+    license = session.exec(
+        select(AgentLicense).where(AgentLicense.license_key == license_key)
+    ).first()
+    if not license:
+        raise ValueError("Invalid license key")
+
+    plan = session.get(AgentPricingPlan, license.pricing_plan_id)
+    if not plan:
+        raise ValueError("License plan not found")
+
+    agent = load_agent_snapshot(session, license.agent_profile_id)
     if not agent:
         raise ValueError("Agent not found")
 
-    return {"license": license, "agent": agent, "plan": plan}
+    return (
+        LicenseSnapshot(
+            id=license.id,
+            agent_profile_id=license.agent_profile_id,
+            buyer_id=license.buyer_id,
+            pricing_plan_id=license.pricing_plan_id,
+            license_key=license.license_key,
+            expires_at=license.expires_at,
+        ),
+        PlanSnapshot(
+            id=plan.id,
+            plan_type=plan.plan_type,
+            billing_interval=plan.billing_interval,
+            max_messages_per_period=plan.max_messages_per_period,
+            max_tokens_per_period=plan.max_tokens_per_period,
+            max_requests_per_minute=plan.max_requests_per_minute,
+            is_active=plan.is_active,
+        ),
+        agent,
+    )
+
+
+def load_agent_snapshot(session: Session, agent_id: uuid.UUID) -> AgentSnapshot | None:
+    agent = session.get(AgentProfile, agent_id)
+    if not agent:
+        return None
+    return AgentSnapshot(
+        id=agent.id,
+        owner_id=agent.owner_id,
+        name=agent.name,
+        listing_type=agent.listing_type,
+        encrypted_api_key=agent.encrypted_api_key,
+        proxy_response_cache=agent.proxy_response_cache,
+        api_keys=load_pool(session, agent),
+    )
+
+
+def _set_status(session: Session, license_id: uuid.UUID, status: str):
+    license = session.get(AgentLicense, license_id)
+    if license:
+        license.status = status
+        license.updated_at = datetime.now(UTC).replace(tzinfo=None)
+        session.add(license)
+        session.commit()
+
+
+def reserve_tokens(
+    session: Session, license_id: uuid.UUID, tokens: int, max_tokens_per_period: int
+) -> bool:
+    """Hold ``tokens`` of the license's remaining period budget for an in-flight request.
+
+    The budget check and the reservation are one conditional UPDATE, so
+    concurrent requests cannot jointly overshoot the plan limit and no lock is
+    held beyond that statement. Returns False if the budget would be exceeded.
+    """
+    result = session.execute(
+        update(AgentLicense)
+        .where(
+            AgentLicense.id == license_id,
+            AgentLicense.period_tokens + AgentLicense.reserved_tokens + tokens
+            <= max_tokens_per_period,
+        )
+        .values(
+            reserved_tokens=AgentLicense.reserved_tokens + tokens,
+            reserved_updated_at=datetime.now(UTC).replace(tzinfo=None),
+        )
+    )
+    session.commit()
+    return result.rowcount == 1
+
+
+def release_tokens(session: Session, license_id: uuid.UUID, tokens: int):
+    """Return a reservation that ended without usage to log. The caller commits."""
+    increment_usage_counters(session, license_id, 0, 0, 0, released_tokens=tokens)
+
+
+def release_stale_reservations(session: Session, max_age_seconds: float) -> int:
+    """Reset ``reserved_tokens`` on licenses with no reservation activity for ``max_age_seconds``.
+
+    No request is in flight that long, so whatever such a license still holds
+    beyond its unreconciled Message Batches was leaked (a worker crashed
+    between reserving and logging usage). It is reset to the batches' total
+    in one conditional UPDATE: a request reserving at the same moment bumps
+    ``reserved_updated_at`` and so is never reset. Returns the licenses fixed.
+    """
+    now = datetime.now(UTC).replace(tzinfo=None)
+    cutoff = now - timedelta(seconds=max_age_seconds)
+    held_by_batches = (
+        select(func.coalesce(func.sum(ProxyBatch.reserved_tokens), 0))
+        .where(ProxyBatch.license_id == AgentLicense.id, ProxyBatch.reconciled_at.is_(None))
+        .scalar_subquery()
+    )
+    result = session.execute(
+        update(AgentLicense)
+        .where(
+            or_(AgentLicense.reserved_updated_at.is_(None), AgentLicense.reserved_updated_at <= cutoff),
+            AgentLicense.reserved_tokens != held_by_batches,
+        )
+        .values(reserved_tokens=held_by_batches, reserved_updated_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    session.commit()
+    return result.rowcount
+
+
+def increment_usage_counters(
+    session: Session,
+    license_id: uuid.UUID,
+    messages: int,
+    tokens: int,
+    cost_cents: int,
+    released_tokens: int = 0,
+):
+    """Add usage to a license's counters with a single SQL-side ``x = x + delta`` UPDATE.
+
+    ``released_tokens`` returns the request's reservation in the same
+    statement, so actual usage replaces it without a window where neither is
+    counted. Never read-modify-write these counters from ORM attributes:
+    concurrent requests for the same license would lose updates. The caller
+    commits.
+    """
+    now = datetime.now(UTC).replace(tzinfo=None)
+    values = dict(
+        total_messages=AgentLicense.total_messages + messages,
+        total_tokens_used=AgentLicense.total_tokens_used + tokens,
+        total_cost_cents=AgentLicense.total_cost_cents + cost_cents,
+        period_messages=AgentLicense.period_messages + messages,
+        period_tokens=AgentLicense.period_tokens + tokens,
+        updated_at=now,
+    )
+    if released_tokens:
+        # Never below zero: a release logged late (e.g. replayed from the usage
+        # spill) may find its reservation already cleared as stale
+        values["reserved_tokens"] = case(
+            (AgentLicense.reserved_tokens > released_tokens, AgentLicense.reserved_tokens - released_tokens),
+            else_=0,
+        )
+        values["reserved_updated_at"] = now
+    session.execute(update(AgentLicense).where(AgentLicense.id == license_id).values(**values))
+
+
+def revoke_license(session: Session, license: AgentLicense) -> AgentLicense:
+    license.status = "revoked"
+    license.updated_at = datetime.now(UTC).replace(tzinfo=None)
+    session.add(license)
+    session.commit()
+    invalidate_license(license.license_key)
+    return license
+
+
+# ── Cache invalidation hooks ────────────────────────────────────────
+#
+# These only clear this process's cache; other workers pick up the change
+# within license_cache_ttl_seconds.
+
+
+def invalidate_license(license_key: str):
+    _get_license_cache().pop(license_key)
+
+
+def invalidate_plan(plan_id: uuid.UUID):
+    _get_license_cache().discard_where(lambda entry: entry[1].id == plan_id)
+
+
+def invalidate_agent(agent_id: uuid.UUID):
+    _get_license_cache().discard_where(lambda entry: entry[2].id == agent_id)
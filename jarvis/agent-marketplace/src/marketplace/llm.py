@@ -1,41 +1,342 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
 import anthropic
 
-from .encryption import decrypt_api_key
+from .cache import TTLCache
+from .config import get_settings
+from .encryption import decrypt_api_key, get_agent_api_key, secret_cache_key
+from .key_pool import PoolKey, get_key_balancer
 
 
-def call_agent(
-    encrypted_api_key: str,
-    system_prompt: str,
-    messages: list[dict],
-    model: str = "claude-sonnet-4-20250514",
-    temperature: float = 0.7,
-    max_tokens: int = 1024,
-) -> dict:
-    api_key = decrypt_api_key(encrypted_api_key)
-    client = anthropic.Anthropic(api_key=api_key)
-
-    response = client.messages.create(
-        model=model,
-        max_tokens=max_tokens,
-        temperature=temperature,
-        system=system_prompt,
-        messages=messages,
+class _CachedClient:
+    """A cached SDK client and the calls using it.
+
+    Once evicted from its cache the client is closed, but only after the last
+    call using it returns. Async clients are closed on the event loop they
+    were created on.
+    """
+
+    def __init__(self, client, loop: asyncio.AbstractEventLoop | None = None):
+        self.client = client
+        self.loop = loop
+        self._users = 0
+        self._evicted = False
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        """Register a call; False if the client is already closed."""
+        with self._lock:
+            if self._closed:
+                return False
+            self._users += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            close = self._evicted and self._users == 0 and not self._closed
+            self._closed = self._closed or close
+        if close:
+            self._close()
+
+    def evict(self):
+        with self._lock:
+            self._evicted = True
+            close = self._users == 0 and not self._closed
+            self._closed = self._closed or close
+        if close:
+            self._close()
+
+    def _close(self):
+        if self.loop is None:
+            self.client.close()
+        elif not self.loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self.client.close(), self.loop)
+
+
+_client_cache: TTLCache | None = None
+_async_client_cache: TTLCache | None = None
+
+
+def _get_client_cache() -> TTLCache:
+    global _client_cache
+    if _client_cache is None:
+        settings = get_settings()
+        _client_cache = TTLCache(
+            maxsize=settings.api_key_cache_size, ttl=settings.api_key_cache_ttl_seconds,
+            on_evict=_CachedClient.evict,
+        )
+    return _client_cache
+
+
+def _get_async_client_cache() -> TTLCache:
+    global _async_client_cache
+    if _async_client_cache is None:
+        settings = get_settings()
+        _async_client_cache = TTLCache(
+            maxsize=settings.api_key_cache_size, ttl=settings.api_key_cache_ttl_seconds,
+            on_evict=_CachedClient.evict,
+        )
+    return _async_client_cache
+
+
+@contextmanager
+def _checkout_client(cache: TTLCache, agent_id, encrypted_api_key: str, create):
+    key = secret_cache_key(agent_id, encrypted_api_key)
+    entry = cache.get(key)
+    if entry is None or not entry.acquire():
+        entry = create(get_agent_api_key(agent_id, encrypted_api_key))
+        entry.acquire()
+        cache.set(key, entry)
+    try:
+        yield entry.client
+    finally:
+        entry.release()
+
+
+def agent_client(agent_id, encrypted_api_key: str):
+    """Reusable client (and connection pool) for an agent's API key, held for the ``with`` block."""
+    return _checkout_client(
+        _get_client_cache(), agent_id, encrypted_api_key,
+        lambda api_key: _CachedClient(
+            anthropic.Anthropic(api_key=api_key, base_url=get_settings().anthropic_api_url)
+        ),
+    )
+
+
+def async_agent_client(agent_id, encrypted_api_key: str):
+    """``agent_client`` for async code; enter it on the event loop."""
+    return _checkout_client(
+        _get_async_client_cache(), agent_id, encrypted_api_key,
+        lambda api_key: _CachedClient(
+            anthropic.AsyncAnthropic(api_key=api_key, base_url=get_settings().anthropic_api_url),
+            asyncio.get_running_loop(),
+        ),
+    )
+
+
+def forget_agent_clients(agent_id):
+    """Evict an agent's clients; each is closed once no call is using it."""
+    for cache in (_get_client_cache(), _get_async_client_cache()):
+        for entry in cache.discard_where_key(lambda key: key[0] == agent_id):
+            entry.evict()
+
+
+async def close_async_agent_clients():
+    for entry in _get_async_client_cache().discard_where_key(lambda key: True):
+        await entry.client.close()
+
+
+@contextmanager
+def _pool_key(agent_id, api_keys: tuple[PoolKey, ...] | None, encrypted_api_key: str | None):
+    """Yield the encrypted key to call with, taken from ``api_keys`` if given.
+
+    A pooled key is handed back to the balancer with the call's upstream
+    status, so throttled or revoked keys are ejected.
+    """
+    if not api_keys or agent_id is None:
+        yield encrypted_api_key
+        return
+    balancer = get_key_balancer()
+    key = balancer.acquire(agent_id, api_keys)
+    status_code = retry_after = None
+    try:
+        yield key.encrypted_api_key
+        status_code = 200
+    except anthropic.APIStatusError as e:
+        status_code, retry_after = e.status_code, e.response.headers.get("retry-after")
+        raise
+    finally:
+        balancer.release(agent_id, key, status_code, retry_after)
+
+
+_EPHEMERAL = {"type": "ephemeral"}
+
+
+def _with_cache_breakpoints(system_prompt: str | list[dict], messages: list[dict]):
+    """``system`` and ``messages`` with prompt-cache breakpoints, if enabled.
+
+    One breakpoint ends the agent's system prompt (its first block), which is
+    the same for every turn of every session. The other ends the history
+    before the newest user turn: the next turn resends that prefix unchanged,
+    so it is read back from the cache. Prefixes shorter than the model's
+    minimum are simply not cached. The caller's lists are not modified.
+    """
+    if not get_settings().chat_prompt_cache_enabled:
+        return system_prompt, messages
+    blocks = [{"type": "text", "text": system_prompt}] if isinstance(system_prompt, str) else system_prompt
+    system = [dict(block) for block in blocks]
+    if system:
+        system[0]["cache_control"] = _EPHEMERAL
+    if len(messages) < 2:
+        return system, messages
+    messages = list(messages)
+    prefix_end = dict(messages[-2])
+    content = prefix_end["content"]
+    blocks = [{"type": "text", "text": content}] if isinstance(content, str) else [dict(b) for b in content]
+    if blocks:
+        blocks[-1]["cache_control"] = _EPHEMERAL
+    prefix_end["content"] = blocks
+    messages[-2] = prefix_end
+    return system, messages
+
+
+def _usage_tokens(usage) -> tuple[int, int, int]:
+    """Uncached input, cache-read and cache-write token counts of a usage block."""
+    return (
+        usage.input_tokens or 0,
+        getattr(usage, "cache_read_input_tokens", None) or 0,
+        getattr(usage, "cache_creation_input_tokens", None) or 0,
     )
 
+
+def _agent_result(response, model: str) -> dict:
     content = ""
     for block in response.content:
         if block.type == "text":
             content += block.text
 
-    tokens_used = (response.usage.input_tokens or 0) + (response.usage.output_tokens or 0)
+    input_tokens, cache_read, cache_creation = _usage_tokens(response.usage)
+    output_tokens = response.usage.output_tokens or 0
 
     return {
         "content": content,
-        "tokens_used": tokens_used,
+        # Cached prompt tokens are still part of the turn's input
+        "tokens_used": input_tokens + cache_read + cache_creation + output_tokens,
+        "input_tokens": input_tokens + cache_read + cache_creation,
+        "output_tokens": output_tokens,
+        "cache_read_tokens": cache_read,
+        "cache_creation_tokens": cache_creation,
         "model": model,
     }
 
 
+def call_agent(
+    encrypted_api_key: str | None,
+    system_prompt: str,
+    messages: list[dict],
+    model: str = "claude-sonnet-4-20250514",
+    temperature: float = 0.7,
+    max_tokens: int = 1024,
+    agent_id=None,
+    api_keys: tuple[PoolKey, ...] | None = None,
+) -> dict:
+    """Call the agent's model; with ``api_keys`` (and ``agent_id``) the key is picked from the pool."""
+    with _pool_key(agent_id, api_keys, encrypted_api_key) as encrypted_key:
+        if agent_id is not None:
+            client_context = agent_client(agent_id, encrypted_key)
+        else:
+            # One-off client, closed when the call is done
+            client_context = anthropic.Anthropic(api_key=decrypt_api_key(encrypted_key))
+
+        system_prompt, messages = _with_cache_breakpoints(system_prompt, messages)
+        with client_context as client:
+            response = client.messages.create(
+                model=model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                system=system_prompt,
+                messages=messages,
+            )
+    return _agent_result(response, model)
+
+
+async def call_agent_async(
+    agent_id,
+    api_keys: tuple[PoolKey, ...],
+    system_prompt: str | list[dict],
+    messages: list[dict],
+    model: str = "claude-sonnet-4-20250514",
+    temperature: float = 0.7,
+    max_tokens: int = 1024,
+) -> dict:
+    """``call_agent`` for async routes: no thread is held while the model responds."""
+    with _pool_key(agent_id, api_keys, None) as encrypted_key, \
+            async_agent_client(agent_id, encrypted_key) as client:
+        system_prompt, messages = _with_cache_breakpoints(system_prompt, messages)
+        response = await client.messages.create(
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            system=system_prompt,
+            messages=messages,
+        )
+    return _agent_result(response, model)
+
+
+@dataclass
+class AgentReply:
+    """A streamed reply as far as it has been received."""
+
+    model: str
+    parts: list[str] = field(default_factory=list)
+    input_tokens: int = 0  # Uncached input only; see cache_read_tokens and cache_creation_tokens
+    output_tokens: int = 0
+    cache_read_tokens: int = 0
+    cache_creation_tokens: int = 0
+    complete: bool = False
+
+    @property
+    def content(self) -> str:
+        return "".join(self.parts)
+
+    @property
+    def prompt_tokens(self) -> int:
+        return self.input_tokens + self.cache_read_tokens + self.cache_creation_tokens
+
+    @property
+    def tokens_used(self) -> int:
+        return self.prompt_tokens + self.output_tokens
+
+
+async def stream_agent(
+    reply: AgentReply,
+    agent_id,
+    api_keys: tuple[PoolKey, ...],
+    system_prompt: str | list[dict],
+    messages: list[dict],
+    temperature: float = 0.7,
+    max_tokens: int = 1024,
+):
+    """Yield the agent's reply text as it is generated, recording it in ``reply``.
+
+    Usage arrives in the ``message_start`` and ``message_delta`` events; if
+    the stream is abandoned early ``reply.complete`` stays False and
+    ``output_tokens`` only covers what upstream had reported.
+    """
+    with _pool_key(agent_id, api_keys, None) as encrypted_key, \
+            async_agent_client(agent_id, encrypted_key) as client:
+        system_prompt, messages = _with_cache_breakpoints(system_prompt, messages)
+        stream = await client.messages.create(
+            model=reply.model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            system=system_prompt,
+            messages=messages,
+            stream=True,
+        )
+        try:
+            async for event in stream:
+                if event.type == "message_start":
+                    reply.input_tokens, reply.cache_read_tokens, reply.cache_creation_tokens = (
+                        _usage_tokens(event.message.usage)
+                    )
+                    reply.output_tokens = event.message.usage.output_tokens or 0
+                elif event.type == "content_block_delta" and event.delta.type == "text_delta":
+                    reply.parts.append(event.delta.text)
+                    yield event.delta.text
+                elif event.type == "message_delta":
+                    reply.output_tokens = event.usage.output_tokens or reply.output_tokens
+                elif event.type == "message_stop":
+                    reply.complete = True
+        finally:
+            await stream.close()
+
+
 def validate_api_key(api_key: str) -> bool:
     try:
         client = anthropic.Anthropic(api_key=api_key)
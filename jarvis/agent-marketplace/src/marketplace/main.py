@@ -5,8 +5,14 @@ from fastapi.middleware.cors import CORSMiddleware
 from sqlmodel import SQLModel
 
 from .config import get_settings
+from .chat_summary import get_summarizer
 from .database import get_engine
+from .llm import close_async_agent_clients
+from .quota import close_redis
+from .rollover import start_rollover_schedule, stop_rollover_schedule
 from .routers import agents, auth_routes, chat, messages, posts, proxy, tasks
+from .upstream import close_upstream_client, get_upstream_client
+from .usage_sink import get_usage_sink
 
 settings = get_settings()
 
@@ -45,31 +51,93 @@ def on_startup():
 
     engine = get_engine()
     SQLModel.metadata.create_all(engine)
+    get_upstream_client()
 
     # Add new columns to existing tables
     from sqlalchemy import text, inspect
 
     inspector = inspect(engine)
-    existing_cols = {c["name"] for c in inspector.get_columns("agent_profiles")}
 
     new_cols = {
-        "listing_type": "VARCHAR DEFAULT 'chat'",
-        "openclaw_repo_url": "VARCHAR",
-        "openclaw_install_instructions": "TEXT",
-        "openclaw_version": "VARCHAR",
+        "agent_profiles": {
+            "listing_type": "VARCHAR DEFAULT 'chat'",
+            "openclaw_repo_url": "VARCHAR",
+            "openclaw_install_instructions": "TEXT",
+            "openclaw_version": "VARCHAR",
+            "proxy_response_cache": "BOOLEAN DEFAULT FALSE",
+        },
+        "agent_pricing_plans": {
+            "max_requests_per_minute": "INTEGER",
+        },
+        "agent_licenses": {
+            "reserved_tokens": "INTEGER DEFAULT 0",
+            "reserved_updated_at": "TIMESTAMP",
+        },
+        "proxy_usage_logs": {
+            "reserved_tokens": "INTEGER DEFAULT 0",
+            "cache_hit": "BOOLEAN DEFAULT FALSE",
+            "outcome": "VARCHAR DEFAULT 'ok'",
+            "attempts": "INTEGER DEFAULT 1",
+            "upstream_ttfb_ms": "INTEGER DEFAULT 0",
+            "overhead_ms": "INTEGER DEFAULT 0",
+            "api_key_id": "UUID",
+        },
+        "proxy_batches": {
+            "api_key_id": "UUID",
+        },
+        "agent_chat_messages": {
+            "content_tokens": "INTEGER DEFAULT 0",
+            "cache_read_tokens": "INTEGER DEFAULT 0",
+            "cache_creation_tokens": "INTEGER DEFAULT 0",
+        },
+        "agent_sessions": {
+            "summary": "TEXT",
+            "summary_tokens": "INTEGER DEFAULT 0",
+            "summarized_until": "TIMESTAMP",
+            "summary_updated_at": "TIMESTAMP",
+            "total_input_tokens": "INTEGER DEFAULT 0",
+            "total_cache_read_tokens": "INTEGER DEFAULT 0",
+            "total_cache_creation_tokens": "INTEGER DEFAULT 0",
+        },
     }
     with engine.connect() as conn:
-        for col_name, col_type in new_cols.items():
-            if col_name not in existing_cols:
-                try:
-                    conn.execute(text(
-                        f"ALTER TABLE agent_profiles ADD COLUMN {col_name} {col_type}"
-                    ))
-                except Exception as e:
-                    logging.warning(f"Migration skip {col_name}: {e}")
+        for table_name, cols in new_cols.items():
+            existing_cols = {c["name"] for c in inspector.get_columns(table_name)}
+            for col_name, col_type in cols.items():
+                if col_name not in existing_cols:
+                    try:
+                        conn.execute(text(
+                            f"ALTER TABLE {table_name} ADD COLUMN {col_name} {col_type}"
+                        ))
+                    except Exception as e:
+                        logging.warning(f"Migration skip {table_name}.{col_name}: {e}")
+        # Indexes added to tables that may predate them
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_agent_chat_messages_session_created "
+            "ON agent_chat_messages (session_id, created_at)"
+        ))
         conn.commit()
 
 
+@app.on_event("startup")
+async def start_background_tasks():
+    await get_usage_sink().start()
+    start_rollover_schedule()
+    proxy.start_batch_poll()
+    get_summarizer().start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await stop_rollover_schedule()
+    await proxy.stop_batch_poll()
+    await get_summarizer().stop()
+    await get_usage_sink().stop()
+    await close_upstream_client()
+    await close_async_agent_clients()
+    await close_redis()
+
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
@@ -0,0 +1,141 @@
+import time
+from collections import defaultdict
+
+# Linear sub-buckets per power of two: values are kept to within ~6%
+_SUB_BITS = 5
+_HALF = 1 << (_SUB_BITS - 1)
+
+# Phases spent outside the proxy itself; everything else counts as overhead
+EXTERNAL_PHASES = ("gate_wait", "upstream_ttfb", "transfer")
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def bucket_index(value: int) -> int:
+    """Histogram bucket for a non-negative integer value."""
+    shift = max(0, value.bit_length() - _SUB_BITS)
+    return shift * _HALF + (value >> shift)
+
+
+def bucket_upper(index: int) -> int:
+    """Largest value that falls into bucket ``index``."""
+    shift = max(0, index // _HALF - 1)
+    return ((index - shift * _HALF + 1) << shift) - 1
+
+
+def percentile_from_buckets(counts: dict[int, int], pct: float) -> int:
+    """Upper bound of the bucket holding the ``pct``th percentile of ``counts``."""
+    total = sum(counts.values())
+    if not total:
+        return 0
+    rank = max(1, round(total * pct / 100))
+    seen = 0
+    for index in sorted(counts):
+        seen += counts[index]
+        if seen >= rank:
+            return bucket_upper(index)
+    return bucket_upper(max(counts))
+
+
+class LatencyHistogram:
+    """HDR-style log-linear histogram of durations, recorded in microseconds.
+
+    Memory is bounded by the dynamic range (a few hundred buckets for
+    microseconds up to hours), not by the number of samples.
+    """
+
+    def __init__(self):
+        self._counts: dict[int, int] = defaultdict(int)
+        self.count = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    def record(self, ms: float):
+        us = max(0, int(ms * 1000))
+        self._counts[bucket_index(us)] += 1
+        self.count += 1
+        self.total_us += us
+        self.max_us = max(self.max_us, us)
+
+    def percentile(self, pct: float) -> float:
+        return min(percentile_from_buckets(self._counts, pct), self.max_us) / 1000
+
+    def snapshot(self) -> dict:
+        data = {"count": self.count}
+        if self.count:
+            data["mean_ms"] = round(self.total_us / self.count / 1000, 2)
+            data["max_ms"] = round(self.max_us / 1000, 2)
+            for pct in PERCENTILES:
+                data[f"p{pct}_ms"] = round(self.percentile(pct), 2)
+        return data
+
+
+class PhaseTimer:
+    """Attributes the wall-clock time of one proxied request to named phases.
+
+    ``mark(phase)`` charges the time since the previous mark to ``phase``.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.phases: dict[str, float] = {}
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + (now - self._last) * 1000
+        self._last = now
+
+    @property
+    def elapsed_ms(self) -> float:
+        return (self._last - self.started) * 1000
+
+    @property
+    def overhead_ms(self) -> float:
+        return self.elapsed_ms - sum(self.phases.get(p, 0.0) for p in EXTERNAL_PHASES)
+
+    def server_timing(self) -> str:
+        parts = [f"{phase};dur={ms:.1f}" for phase, ms in self.phases.items()]
+        parts.append(f"overhead;dur={self.overhead_ms:.1f}")
+        return ", ".join(parts)
+
+
+class ProxyMetrics:
+    """Per-phase latency histograms for the license proxy, overall, per model and per agent."""
+
+    def __init__(self):
+        self.overall: dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+        self.by_model: dict[str, dict[str, LatencyHistogram]] = defaultdict(
+            lambda: defaultdict(LatencyHistogram)
+        )
+        self.by_agent: dict[str, dict[str, LatencyHistogram]] = defaultdict(
+            lambda: defaultdict(LatencyHistogram)
+        )
+
+    def observe(self, timer: PhaseTimer, model: str, agent_id):
+        samples = dict(timer.phases)
+        samples["overhead"] = timer.overhead_ms
+        samples["total"] = timer.elapsed_ms
+        for target in (self.overall, self.by_model[model], self.by_agent[str(agent_id)]):
+            for phase, ms in samples.items():
+                target[phase].record(ms)
+
+    def snapshot(self) -> dict:
+        def dump(histograms):
+            return {phase: h.snapshot() for phase, h in histograms.items()}
+
+        return {
+            "overall": dump(self.overall),
+            "by_model": {model: dump(h) for model, h in self.by_model.items()},
+            "by_agent": {agent: dump(h) for agent, h in self.by_agent.items()},
+        }
+
+
+_metrics: ProxyMetrics | None = None
+
+
+def get_proxy_metrics() -> ProxyMetrics:
+    global _metrics
+    if _metrics is None:
+        _metrics = ProxyMetrics()
+    return _metrics
@@ -1,7 +1,7 @@
 import uuid
 from datetime import UTC, datetime
 
-from sqlalchemy import JSON, Column, Text
+from sqlalchemy import JSON, Column, Index, Text
 from sqlmodel import Field, SQLModel
 
 
@@ -131,6 +131,8 @@ class AgentProfile(SQLModel, table=True):
         default=None, sa_column=Column("openclaw_install_instructions", Text, nullable=True)
     )
     openclaw_version: str | None = None
+    # Serve identical temperature-0 proxy requests from cache (opt-in by the creator)
+    proxy_response_cache: bool = Field(default=False)
 
     # Docking / Webhook Configuration
     webhook_url: str | None = None
@@ -150,6 +152,23 @@ class AgentProfile(SQLModel, table=True):
     updated_at: datetime = Field(default_factory=_utcnow)
 
 
+class AgentApiKey(SQLModel, table=True):
+    """An extra upstream API key in an agent's pool, used alongside ``encrypted_api_key``."""
+
+    __tablename__ = "agent_api_keys"
+
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    agent_profile_id: uuid.UUID = Field(foreign_key="agent_profiles.id", index=True)
+    label: str | None = None
+    encrypted_api_key: str = Field(sa_column=Column("encrypted_api_key", Text, nullable=False))
+    api_key_preview: str
+    # Relative share of traffic when keys are equally loaded
+    weight: int = Field(default=1)
+    is_active: bool = Field(default=True)
+    created_at: datetime = Field(default_factory=_utcnow)
+    updated_at: datetime = Field(default_factory=_utcnow)
+
+
 # ── Conversation ─────────────────────────────────────────────────────
 
 
@@ -279,18 +298,37 @@ class AgentSession(SQLModel, table=True):
     is_active: bool = Field(default=True)
     total_messages: int = Field(default=0)
     total_tokens_used: int = Field(default=0)
+    # Prompt tokens of the session's turns; the cache counts are the parts
+    # read from and written to the prompt cache
+    total_input_tokens: int = Field(default=0)
+    total_cache_read_tokens: int = Field(default=0)
+    total_cache_creation_tokens: int = Field(default=0)
+    # Rolling summary of the turns up to summarized_until (see chat_summary)
+    summary: str | None = Field(default=None, sa_column=Column("summary", Text, nullable=True))
+    summary_tokens: int = Field(default=0)
+    summarized_until: datetime | None = None
+    summary_updated_at: datetime | None = None
     created_at: datetime = Field(default_factory=_utcnow)
     updated_at: datetime = Field(default_factory=_utcnow)
 
 
 class AgentChatMessage(SQLModel, table=True):
     __tablename__ = "agent_chat_messages"
+    # Chat context reads a session's newest messages first
+    __table_args__ = (
+        Index("ix_agent_chat_messages_session_created", "session_id", "created_at"),
+    )
 
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     session_id: uuid.UUID = Field(foreign_key="agent_sessions.id", index=True)
     role: str  # "user" or "assistant"
     content: str = Field(sa_column=Column("content", Text, nullable=False))
+    # Size of ``content`` as context for later turns (see chat_context)
+    content_tokens: int = Field(default=0)
     tokens_used: int = Field(default=0)
+    # Prompt tokens of an assistant turn read from / written to the prompt cache
+    cache_read_tokens: int = Field(default=0)
+    cache_creation_tokens: int = Field(default=0)
     model_used: str | None = None
     created_at: datetime = Field(default_factory=_utcnow)
 
@@ -340,6 +378,7 @@ class AgentPricingPlan(SQLModel, table=True):
 
     max_messages_per_period: int | None = None
     max_tokens_per_period: int | None = None
+    max_requests_per_minute: int | None = None
 
     plan_name: str
     plan_description: str | None = None
@@ -372,10 +411,28 @@ class AgentLicense(SQLModel, table=True):
     period_tokens: int = Field(default=0)
     period_start: datetime = Field(default_factory=_utcnow)
 
+    # Tokens held by in-flight proxied requests (released when their usage is logged)
+    reserved_tokens: int = Field(default=0)
+    # Last reservation or release; see licenses.release_stale_reservations
+    reserved_updated_at: datetime | None = None
+
     created_at: datetime = Field(default_factory=_utcnow)
     updated_at: datetime = Field(default_factory=_utcnow)
 
 
+class LicensePeriodHistory(SQLModel, table=True):
+    """Usage of one closed billing period, written by the rollover job."""
+
+    __tablename__ = "license_period_history"
+
+    license_id: uuid.UUID = Field(foreign_key="agent_licenses.id", primary_key=True)
+    period_start: datetime = Field(primary_key=True)
+    period_end: datetime
+    messages: int = Field(default=0)
+    tokens: int = Field(default=0)
+    created_at: datetime = Field(default_factory=_utcnow)
+
+
 # ── Proxy Usage Log ──────────────────────────────────────
 
 
@@ -393,7 +450,82 @@ class ProxyUsageLog(SQLModel, table=True):
     total_tokens: int = Field(default=0)
     estimated_cost_cents: int = Field(default=0)
     response_time_ms: int = Field(default=0)
+    # Tokens held in AgentLicense.reserved_tokens (0 when quotas are kept in Redis)
+    reserved_tokens: int = Field(default=0)
+    # AgentApiKey that served the request (None = the agent's primary key)
+    api_key_id: uuid.UUID | None = Field(default=None, index=True)
+    cache_hit: bool = Field(default=False)
+    # ok, retried, hedged, cache_hit, upstream_error, overloaded, timeout,
+    # transport_error, circuit_open, queue_rejected, stream_interrupted,
+    # client_disconnected, key_error, batch, batch_error (one row per Message Batch result)
+    outcome: str = Field(default="ok", index=True)
+    attempts: int = Field(default=1)
+    # response_time_ms split: upstream time-to-first-byte and time spent in the proxy itself
+    upstream_ttfb_ms: int = Field(default=0)
+    overhead_ms: int = Field(default=0)
     success: bool = Field(default=True)
     error_message: str | None = None
 
     created_at: datetime = Field(default_factory=_utcnow)
+
+
+class ProxyBatch(SQLModel, table=True):
+    """A Message Batch created through the license proxy.
+
+    ``reserved_tokens`` stays held on the license until the batch's results
+    are fetched and reconciled into ProxyUsageLog rows, or until it expires
+    unreconciled.
+    """
+
+    __tablename__ = "proxy_batches"
+
+    id: str = Field(primary_key=True)  # Upstream batch id (msgbatch_...)
+    license_id: uuid.UUID = Field(foreign_key="agent_licenses.id", index=True)
+    agent_profile_id: uuid.UUID = Field(foreign_key="agent_profiles.id", index=True)
+    buyer_id: uuid.UUID = Field(foreign_key="users.id")
+
+    # Batches are only visible to the key that created them (None = primary key)
+    api_key_id: uuid.UUID | None = None
+    request_count: int
+    reserved_tokens: int = Field(default=0)
+    processing_status: str = Field(default="in_progress")  # in_progress, canceling, ended
+
+    # Filled in when the results are reconciled
+    succeeded_count: int = Field(default=0)
+    errored_count: int = Field(default=0)
+    total_tokens: int = Field(default=0)
+    cost_cents: int = Field(default=0)
+    reconciled_at: datetime | None = None
+
+    created_at: datetime = Field(default_factory=_utcnow)
+    updated_at: datetime = Field(default_factory=_utcnow)
+
+
+# ── Usage Rollups ──────────────────────────────────────
+
+
+class UsageRollup(SQLModel, table=True):
+    """Proxy usage pre-aggregated per hour/day for one license or one agent.
+
+    Maintained incrementally by the usage sink; ``latency_buckets`` is a
+    mergeable log-linear histogram of response_time_ms (see metrics.py).
+    """
+
+    __tablename__ = "usage_rollups"
+
+    # Key order serves "series for one license/agent over a time range"
+    scope: str = Field(primary_key=True)  # license, agent
+    scope_id: uuid.UUID = Field(primary_key=True)
+    granularity: str = Field(primary_key=True)  # hour, day
+    bucket_start: datetime = Field(primary_key=True)
+
+    requests: int = Field(default=0)
+    input_tokens: int = Field(default=0)
+    output_tokens: int = Field(default=0)
+    cost_cents: int = Field(default=0)
+    error_count: int = Field(default=0)
+    total_latency_ms: int = Field(default=0)
+    latency_buckets: dict = Field(
+        default_factory=dict,
+        sa_column=Column("latency_buckets", JSON, nullable=False, server_default="{}"),
+    )
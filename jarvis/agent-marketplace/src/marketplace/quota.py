@@ -0,0 +1,368 @@
+"""License quota and request-rate enforcement for the proxy.
+
+With ``REDIS_URL`` set, message/token quotas and the per-license
+requests-per-minute limit are checked and reserved by one Lua script, so
+every worker shares exact counters without touching the database on the hot
+path. Each request holds a reservation ("hold") until its usage is settled;
+holds expire after ``quota_hold_ttl_seconds`` so a crashed worker cannot
+leak budget.
+
+Redis is reconciled against ``AgentLicense`` on every check: the caller
+passes the period counters it just read, Redis keeps the larger of the two
+(the database lags by the usage sink's flush interval, Redis may have lost
+data), and a changed ``period_start`` (billing rollover) resets the Redis
+counters to the database's. Tokens held in ``AgentLicense.reserved_tokens``
+(Message Batches, and requests reserved while Redis was down) count against
+the budget too.
+
+If Redis is unreachable the proxy degrades to the database reservation
+(``licenses.reserve_tokens``) and an in-process rate window, and retries
+Redis after ``redis_retry_seconds``. Database reservations that outlive
+``quota_hold_ttl_seconds`` are cleared by the rollover schedule (see
+``licenses.release_stale_reservations``).
+"""
+
+import logging
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+
+from sqlmodel import Session
+
+from .cache import TTLCache
+from .config import get_settings
+from .database import get_engine, run_in_db_thread
+from .licenses import release_tokens, reserve_tokens
+
+logger = logging.getLogger(__name__)
+
+_RESERVE_SCRIPT = """
+local quota, holds, hold_tokens, rate = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local period = ARGV[1]
+local db_messages, db_tokens = tonumber(ARGV[2]), tonumber(ARGV[3])
+local max_messages, max_tokens = tonumber(ARGV[4]), tonumber(ARGV[5])
+local reserve, rpm, now = tonumber(ARGV[6]), tonumber(ARGV[7]), tonumber(ARGV[8])
+local hold_id, hold_ttl, key_ttl = ARGV[9], tonumber(ARGV[10]), tonumber(ARGV[11])
+local db_reserved = tonumber(ARGV[12])
+
+if redis.call('HGET', quota, 'period') ~= period then
+  redis.call('HSET', quota, 'period', period, 'messages', db_messages, 'tokens', db_tokens)
+else
+  if tonumber(redis.call('HGET', quota, 'messages')) < db_messages then
+    redis.call('HSET', quota, 'messages', db_messages)
+  end
+  if tonumber(redis.call('HGET', quota, 'tokens')) < db_tokens then
+    redis.call('HSET', quota, 'tokens', db_tokens)
+  end
+end
+
+for _, expired in ipairs(redis.call('ZRANGEBYSCORE', holds, '-inf', now)) do
+  redis.call('HDEL', hold_tokens, expired)
+end
+redis.call('ZREMRANGEBYSCORE', holds, '-inf', now)
+
+local messages = tonumber(redis.call('HGET', quota, 'messages'))
+local tokens = tonumber(redis.call('HGET', quota, 'tokens'))
+if max_messages > 0 and messages + redis.call('ZCARD', holds) >= max_messages then
+  return {1, 0}
+end
+if max_tokens > 0 then
+  local reserved = db_reserved
+  for _, held in ipairs(redis.call('HVALS', hold_tokens)) do
+    reserved = reserved + tonumber(held)
+  end
+  if tokens + reserved + reserve > max_tokens then
+    return {2, 0}
+  end
+end
+if rpm > 0 then
+  redis.call('ZREMRANGEBYSCORE', rate, '-inf', now - 60000)
+  if redis.call('ZCARD', rate) >= rpm then
+    local oldest = redis.call('ZRANGE', rate, 0, 0, 'WITHSCORES')
+    return {3, tonumber(oldest[2]) + 60000 - now}
+  end
+  redis.call('ZADD', rate, now, hold_id)
+  redis.call('PEXPIRE', rate, 60000)
+end
+
+redis.call('ZADD', holds, now + hold_ttl, hold_id)
+redis.call('HSET', hold_tokens, hold_id, reserve)
+redis.call('EXPIRE', quota, key_ttl)
+redis.call('EXPIRE', holds, key_ttl)
+redis.call('EXPIRE', hold_tokens, key_ttl)
+return {0, 0}
+"""
+
+_SETTLE_SCRIPT = """
+local quota, holds, hold_tokens = KEYS[1], KEYS[2], KEYS[3]
+redis.call('ZREM', holds, ARGV[2])
+redis.call('HDEL', hold_tokens, ARGV[2])
+if redis.call('HGET', quota, 'period') == ARGV[1] then
+  redis.call('HINCRBY', quota, 'messages', ARGV[3])
+  redis.call('HINCRBY', quota, 'tokens', ARGV[4])
+end
+return 1
+"""
+
+# Redis keys outlive the longest gap between requests we care about; an
+# evicted key is simply re-seeded from the database
+_KEY_TTL_SECONDS = 35 * 24 * 3600
+
+_REJECTIONS = {
+    1: "Message limit reached for this billing period",
+    2: "Token limit reached for this billing period",
+    3: "Request rate limit reached for this license",
+}
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, message: str, rate_limited: bool = False, retry_after: float | None = None):
+        super().__init__(message)
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+
+
+@dataclass(slots=True)
+class QuotaHold:
+    """A request's reservation; settle it once the request's usage is known.
+
+    A request that ends without logging usage gives it back with ``release_quota``.
+    """
+
+    license_id: uuid.UUID
+    period: str
+    hold_id: str
+    tokens: int
+    backend: str  # redis, db
+    settled: bool = field(default=False, compare=False)
+
+    @property
+    def db_reserved_tokens(self) -> int:
+        """Tokens to release from ``AgentLicense.reserved_tokens`` when usage is logged."""
+        return self.tokens if self.backend == "db" else 0
+
+
+def _keys(license_id) -> list[str]:
+    # Hash tag keeps one license's keys in the same cluster slot
+    base = f"quota:{{{license_id}}}"
+    return [base, f"{base}:holds", f"{base}:hold_tokens", f"{base}:rpm"]
+
+
+# ── Redis client ────────────────────────────────────────────────────
+
+_redis = None
+_scripts: dict = {}
+_redis_down_until = 0.0
+
+
+def get_redis():
+    """Shared async Redis client, or None if Redis is not configured."""
+    global _redis
+    if _redis is None:
+        settings = get_settings()
+        if not settings.redis_url:
+            return None
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError:
+            logger.warning("REDIS_URL is set but the redis package is not installed; using DB quotas")
+            settings.redis_url = None
+            return None
+        _redis = redis_asyncio.Redis.from_url(
+            settings.redis_url,
+            socket_timeout=settings.redis_socket_timeout,
+            socket_connect_timeout=settings.redis_socket_timeout,
+        )
+    return _redis
+
+
+def set_redis(client):
+    """Override Redis client (for testing)."""
+    global _redis, _redis_down_until
+    _redis = client
+    _redis_down_until = 0.0
+    _scripts.clear()
+
+
+async def close_redis():
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
+        _scripts.clear()
+
+
+def _available_redis():
+    if time.monotonic() < _redis_down_until:
+        return None
+    return get_redis()
+
+
+def _mark_redis_down(exc: Exception):
+    global _redis_down_until
+    if time.monotonic() >= _redis_down_until:
+        logger.warning("Redis unavailable (%s); falling back to DB quotas", exc)
+    _redis_down_until = time.monotonic() + get_settings().redis_retry_seconds
+
+
+def _script(client, name: str, source: str):
+    script = _scripts.get(name)
+    if script is None:
+        script = _scripts[name] = client.register_script(source)
+    return script
+
+
+# ── In-process fallback rate window ─────────────────────────────────
+
+_local_windows: TTLCache | None = None
+
+
+def _get_local_windows() -> TTLCache:
+    """One window per recently seen license; a window idle for a minute is empty and dropped."""
+    global _local_windows
+    if _local_windows is None:
+        _local_windows = TTLCache(maxsize=get_settings().license_cache_size, ttl=60)
+    return _local_windows
+
+
+def _local_rate_check(license_id, rpm: int):
+    now = time.monotonic()
+    windows = _get_local_windows()
+    window = windows.get(license_id)
+    if window is None:
+        window = deque()
+    while window and window[0] <= now - 60:
+        window.popleft()
+    if len(window) >= rpm:
+        raise QuotaExceeded(_REJECTIONS[3], rate_limited=True, retry_after=window[0] + 60 - now)
+    window.append(now)
+    # Re-set on every request so the entry expires a minute after the last one
+    windows.set(license_id, window)
+
+
+# ── Reserve / settle ────────────────────────────────────────────────
+
+
+async def acquire_quota(license, plan, usage: dict, reserve: int) -> QuotaHold | None:
+    """Check the license's quotas and rate limit and reserve ``reserve`` tokens.
+
+    ``usage`` is the result of ``validate_license``. Returns None when the
+    plan has no limits to enforce; raises QuotaExceeded otherwise.
+    """
+    max_messages = plan.max_messages_per_period or 0
+    max_tokens = plan.max_tokens_per_period or 0
+    rpm = plan.max_requests_per_minute or 0
+    if not (max_messages or max_tokens or rpm):
+        return None
+    reserve = reserve if max_tokens else 0
+    period = usage["period_start"].isoformat()
+    hold_id = uuid.uuid4().hex
+
+    client = _available_redis()
+    if client is not None:
+        try:
+            code, retry_after_ms = await _script(client, "reserve", _RESERVE_SCRIPT)(
+                keys=_keys(license.id),
+                args=[
+                    period, usage["period_messages"], usage["period_tokens"],
+                    max_messages, max_tokens, reserve, rpm, int(time.time() * 1000),
+                    hold_id, int(get_settings().quota_hold_ttl_seconds * 1000), _KEY_TTL_SECONDS,
+                    usage["reserved_tokens"],
+                ],
+            )
+        except Exception as e:
+            _mark_redis_down(e)
+        else:
+            if code:
+                raise QuotaExceeded(
+                    _REJECTIONS[code],
+                    rate_limited=code == 3,
+                    retry_after=retry_after_ms / 1000 if code == 3 else None,
+                )
+            return QuotaHold(license.id, period, hold_id, reserve, "redis")
+
+    # Database fallback: message limits were already checked by validate_license
+    if rpm:
+        _local_rate_check(license.id, rpm)
+    if reserve and not await run_in_db_thread(_reserve_in_db, license.id, reserve, max_tokens):
+        raise QuotaExceeded(
+            f"Token limit reached for this billing period ({reserve} reserved tokens "
+            "exceed the remaining budget)"
+        )
+    return QuotaHold(license.id, period, hold_id, reserve, "db")
+
+
+async def acquire_batch_quota(license, plan, usage: dict, requests: int, reserve: int) -> int:
+    """Check a whole Message Batch against the license's limits and reserve its tokens.
+
+    The batch counts as one request against the rate limit; its ``requests``
+    must fit in the remaining message budget. Batches can run far longer
+    than a Redis hold lives, so the reservation is always moved into
+    ``AgentLicense.reserved_tokens``. Returns the tokens reserved.
+    """
+    max_messages = plan.max_messages_per_period or 0
+    if max_messages and usage["period_messages"] + requests > max_messages:
+        raise QuotaExceeded(
+            f"Message limit reached for this billing period ({requests} batch requests "
+            "exceed the remaining budget)"
+        )
+    hold = await acquire_quota(license, plan, usage, reserve)
+    if hold is None:
+        return 0
+    if hold.backend == "db":
+        return hold.tokens
+    try:
+        if hold.tokens and not await run_in_db_thread(
+            _reserve_in_db, license.id, hold.tokens, plan.max_tokens_per_period
+        ):
+            raise QuotaExceeded(_REJECTIONS[2])
+    finally:
+        await settle_quota(hold, 0, 0)
+    return hold.tokens
+
+
+def _reserve_in_db(license_id, tokens: int, max_tokens_per_period: int) -> bool:
+    with Session(get_engine()) as session:
+        return reserve_tokens(session, license_id, tokens, max_tokens_per_period)
+
+
+async def settle_quota(hold: QuotaHold | None, messages: int, tokens: int):
+    """Release a Redis hold and count the request's actual usage against it.
+
+    Database holds are settled by the usage log write instead (see
+    ``QuotaHold.db_reserved_tokens``).
+    """
+    if hold is None or hold.settled:
+        return
+    hold.settled = True
+    if hold.backend != "redis":
+        return
+    client = _available_redis()
+    if client is None:
+        return  # The hold expires on its own; the DB counters catch Redis up
+    try:
+        await _script(client, "settle", _SETTLE_SCRIPT)(
+            keys=_keys(hold.license_id)[:3],
+            args=[hold.period, hold.hold_id, messages, tokens],
+        )
+    except Exception as e:
+        _mark_redis_down(e)
+
+
+async def release_quota(hold: QuotaHold | None):
+    """Give back a hold whose request ended (cancelled, failed) without logging usage."""
+    if hold is None or hold.settled:
+        return
+    if hold.backend == "redis":
+        await settle_quota(hold, 0, 0)
+        return
+    hold.settled = True
+    if hold.tokens:
+        await run_in_db_thread(_release_in_db, hold.license_id, hold.tokens)
+
+
+def _release_in_db(license_id, tokens: int):
+    with Session(get_engine()) as session:
+        release_tokens(session, license_id, tokens)
+        session.commit()
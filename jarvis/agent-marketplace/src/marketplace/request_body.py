@@ -0,0 +1,255 @@
+"""Spooled, incrementally scanned request bodies for the license proxy.
+
+The proxy only needs a handful of top-level fields from a Messages request
+(``model``, ``max_tokens``, ``stream``, ``temperature``), but bodies can be
+tens of megabytes of base64 images or documents. ``read_request_body``
+streams the body into a ``SpooledTemporaryFile`` (memory up to
+``spool_bytes``, disk beyond) while ``TopLevelFieldScanner`` picks those
+fields out of the chunks as they arrive; nested content and long strings are
+skipped with ``re`` searches rather than per-byte Python. The spooled body
+can then be re-sent for retries and hedged requests.
+"""
+
+import json
+import re
+from tempfile import SpooledTemporaryFile
+
+_WHITESPACE = b" \t\r\n"
+_STRING_STOP = re.compile(rb'["\\]')
+_NESTED_STOP = re.compile(rb'["\[\]{}]')
+# Keys and captured values longer than this are never fields we want
+_MAX_CAPTURE = 256
+
+_QUOTE, _BACKSLASH = ord('"'), ord("\\")
+_OPEN = frozenset(b"{[")
+
+FIELDS = ("model", "max_tokens", "stream", "temperature")
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class TopLevelFieldScanner:
+    """Incremental JSON scanner that extracts scalar values of selected top-level keys.
+
+    Feed it the body in arbitrary chunks. ``fields`` holds the values found
+    so far; ``valid`` turns False if the body is not a JSON object (the body
+    is still forwarded as-is and the upstream reports the error).
+    """
+
+    def __init__(self, wanted=FIELDS):
+        self.wanted = frozenset(wanted)
+        self.fields: dict = {}
+        self.valid = True
+        self._state = "start"
+        self._role = None  # "key" or "value" while in a top-level string
+        self._key = None
+        self._buf = bytearray()
+        self._capturing = False
+        self._escape = False
+        self._depth = 0
+        self._nested_string = False
+
+    @property
+    def done(self) -> bool:
+        return self._state in ("done", "invalid")
+
+    def feed(self, data: bytes):
+        i, n = 0, len(data)
+        while i < n and not self.done:
+            state = self._state
+            if state == "string":
+                i = self._scan_string(data, i, capture=self._capturing)
+            elif state == "nested":
+                i = self._scan_nested(data, i)
+            elif state == "scalar":
+                c = data[i]
+                if c in _WHITESPACE or c in b",}":
+                    self._end_scalar()
+                else:
+                    self._append(data[i:i + 1])
+                    i += 1
+            else:
+                c = data[i]
+                i += 1
+                if c not in _WHITESPACE:
+                    self._structural(state, c)
+
+    def _structural(self, state: str, c: int):
+        if state == "start" and c == ord("{"):
+            self._state = "key_or_end"
+        elif state in ("key_or_end", "key") and c == _QUOTE:
+            self._start_string("key", capture=True)
+        elif state == "key_or_end" and c == ord("}"):
+            self._state = "done"
+        elif state == "colon" and c == ord(":"):
+            self._state = "value"
+        elif state == "value":
+            if c == _QUOTE:
+                self._start_string("value", capture=self._key in self.wanted)
+            elif c in _OPEN:
+                self._state, self._depth, self._nested_string = "nested", 1, False
+            else:
+                self._state = "scalar"
+                self._buf = bytearray([c])
+                self._capturing = True
+        elif state == "after_value" and c == ord(","):
+            self._state = "key"
+        elif state == "after_value" and c == ord("}"):
+            self._state = "done"
+        else:
+            self._state = "invalid"
+            self.valid = False
+
+    def _start_string(self, role: str, capture: bool):
+        self._state, self._role = "string", role
+        self._buf = bytearray()
+        self._capturing = capture
+        self._escape = False
+
+    def _append(self, chunk: bytes):
+        if not self._capturing:
+            return
+        if len(self._buf) + len(chunk) > _MAX_CAPTURE:
+            self._capturing = False
+            self._buf = bytearray()
+        else:
+            self._buf += chunk
+
+    def _scan_string(self, data: bytes, i: int, capture: bool) -> int:
+        """Advance through a string body; returns the next index to scan."""
+        if self._escape:
+            self._escape = False
+            if capture:
+                self._append(data[i:i + 1])
+            return i + 1
+        m = _STRING_STOP.search(data, i)
+        if m is None:
+            if capture:
+                self._append(data[i:])
+            return len(data)
+        j = m.start()
+        if capture:
+            self._append(data[i:j])
+        if data[j] == _BACKSLASH:
+            if capture:
+                self._append(b"\\")
+            self._escape = True
+            return j + 1
+        self._end_string()
+        return j + 1
+
+    def _end_string(self):
+        value = self._decode(b'"' + bytes(self._buf) + b'"') if self._capturing else None
+        if self._role == "key":
+            self._key = value
+            self._state = "colon"
+        else:
+            if self._capturing and self._key in self.wanted:
+                self.fields[self._key] = value
+            self._state = "after_value"
+
+    def _end_scalar(self):
+        if self._capturing and self._key in self.wanted:
+            self.fields[self._key] = self._decode(bytes(self._buf))
+        self._state = "after_value"
+
+    def _scan_nested(self, data: bytes, i: int) -> int:
+        if self._nested_string:
+            if self._escape:
+                self._escape = False
+                return i + 1
+            m = _STRING_STOP.search(data, i)
+            if m is None:
+                return len(data)
+            j = m.start()
+            if data[j] == _BACKSLASH:
+                self._escape = True
+            else:
+                self._nested_string = False
+            return j + 1
+        m = _NESTED_STOP.search(data, i)
+        if m is None:
+            return len(data)
+        j = m.start()
+        c = data[j]
+        if c == _QUOTE:
+            self._nested_string = True
+        elif c in _OPEN:
+            self._depth += 1
+        else:
+            self._depth -= 1
+            if self._depth == 0:
+                self._state = "after_value"
+        return j + 1
+
+    @staticmethod
+    def _decode(raw: bytes):
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return None
+
+
+class RequestBody:
+    """A spooled request body plus the top-level fields scanned from it."""
+
+    def __init__(self, spool: SpooledTemporaryFile, size: int, scanner: TopLevelFieldScanner):
+        self._spool = spool
+        self.size = size
+        self.fields = scanner.fields
+
+    async def iter_chunks(self, chunk_size: int = 64 * 1024):
+        """Yield the body from the start; safe to run several readers at once."""
+        pos = 0
+        while pos < self.size:
+            # No await between seek and read, so concurrent readers cannot interleave
+            self._spool.seek(pos)
+            data = self._spool.read(min(chunk_size, self.size - pos))
+            if not data:
+                break
+            pos += len(data)
+            yield data
+
+    def read(self) -> bytes:
+        self._spool.seek(0)
+        return self._spool.read()
+
+    def json(self) -> dict | None:
+        """Fully parse the body (only for callers that need every field)."""
+        try:
+            value = json.loads(self.read())
+        except ValueError:
+            return None
+        return value if isinstance(value, dict) else None
+
+    def close(self):
+        self._spool.close()
+
+
+async def read_request_body(request, max_bytes: int, spool_bytes: int) -> RequestBody:
+    """Stream ``request``'s body into a spool, scanning it on the way.
+
+    Raises BodyTooLarge as soon as the body (or its declared length)
+    exceeds ``max_bytes``.
+    """
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > max_bytes:
+        raise BodyTooLarge(f"Request body exceeds the {max_bytes} byte limit")
+
+    spool = SpooledTemporaryFile(max_size=spool_bytes)
+    scanner = TopLevelFieldScanner()
+    size = 0
+    try:
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > max_bytes:
+                raise BodyTooLarge(f"Request body exceeds the {max_bytes} byte limit")
+            spool.write(chunk)
+            if not scanner.done:
+                scanner.feed(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    return RequestBody(spool, size, scanner)
@@ -0,0 +1,245 @@
+import asyncio
+import random
+import time
+from collections import deque
+from dataclasses import dataclass
+
+import httpx
+
+from .cache import TTLCache
+from .config import get_settings
+
+# Failures where the request never reached the upstream, so it is safe to resend
+RETRYABLE_EXCEPTIONS = (httpx.ConnectError, httpx.ConnectTimeout)
+# Upstream overloaded; nothing was generated or billed
+RETRYABLE_STATUSES = {529}
+# Statuses that count against upstream health in the circuit breaker. Of
+# transport errors only connect failures count (see call_upstream).
+BREAKER_FAILURE_STATUSES = {500, 502, 503, 504}
+
+
+class CircuitOpen(Exception):
+    """The upstream has been failing; requests are rejected without being sent."""
+
+
+class UpstreamFailed(Exception):
+    """Every attempt failed with a transport error; ``cause`` is the last one."""
+
+    def __init__(self, cause: Exception, attempts: int):
+        super().__init__(str(cause))
+        self.cause = cause
+        self.attempts = attempts
+
+
+@dataclass
+class UpstreamResult:
+    response: httpx.Response
+    attempts: int = 1  # upstream requests sent, including retries and hedges
+    retries: int = 0
+    hedged: bool = False  # a hedge request was sent alongside the first attempt
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed → open → half-open (one trial) → closed."""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.total_opened = 0
+        self.total_short_circuited = 0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        # Let one trial through per reset period; a trial that never reports back
+        # (e.g. the client went away) does not wedge the breaker half-open
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            self.opened_at = time.monotonic()
+            return True
+        self.total_short_circuited += 1
+        return False
+
+    def record_success(self):
+        self.state = "closed"
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                self.total_opened += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def record_response(self, status_code: int):
+        if status_code in BREAKER_FAILURE_STATUSES:
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "total_opened": self.total_opened,
+            "total_short_circuited": self.total_short_circuited,
+        }
+
+
+class LatencyWindow:
+    """Rolling window of recent upstream latencies, used to pick the hedge delay."""
+
+    def __init__(self, size: int = 500):
+        self._samples: deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, pct: float, min_samples: int) -> float | None:
+        if len(self._samples) < min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Full-jitter exponential backoff for the given (0-based) retry."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+async def _close(resp: httpx.Response):
+    await resp.aread()
+    await resp.aclose()
+
+
+async def _hedged_send(send, hedge_after: float, try_hedge_slot, release_hedge_slot) -> tuple:
+    """Return ``(response, hedged)`` for the first request to succeed."""
+    primary = asyncio.ensure_future(send())
+    done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+    if done or not try_hedge_slot():
+        return await primary, False
+
+    hedge = asyncio.ensure_future(send())
+    try:
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((task for task in done if task.exception() is None), None)
+            if winner is not None:
+                for other in pending:
+                    other.cancel()
+                for other in done - {winner}:
+                    if other.exception() is None:
+                        await other.result().aclose()
+                return winner.result(), True
+            error = next(iter(done)).exception()
+        raise error
+    finally:
+        release_hedge_slot()
+
+
+async def call_upstream(
+    send,
+    breaker: CircuitBreaker,
+    *,
+    stream: bool,
+    hedge_after: float | None = None,
+    try_hedge_slot=None,
+    release_hedge_slot=None,
+) -> UpstreamResult:
+    """Send a request with bounded retries, optional hedging and a circuit breaker.
+
+    ``send`` is a zero-argument coroutine function issuing one fresh upstream
+    request. Connect failures and 529 responses are retried with jittered
+    backoff (honoring ``retry-after`` up to the backoff cap); anything that may
+    have reached the model is not. Hedging only applies to the first attempt
+    of non-streaming calls, when ``hedge_after`` is known and a second
+    upstream slot is free.
+    """
+    settings = get_settings()
+    base = settings.upstream_retry_backoff_base_ms / 1000
+    cap = settings.upstream_retry_backoff_cap_ms / 1000
+
+    retries = 0
+    attempts = 0
+    hedged = False
+    last_error = None
+    while True:
+        if not breaker.allow():
+            if last_error is not None:
+                raise UpstreamFailed(last_error, attempts) from last_error
+            raise CircuitOpen("Upstream API is unavailable; failing fast")
+        attempts += 1
+        try:
+            if retries == 0 and not stream and hedge_after is not None and try_hedge_slot:
+                resp, hedged = await _hedged_send(send, hedge_after, try_hedge_slot, release_hedge_slot)
+                attempts += hedged
+            else:
+                resp = await send()
+        except RETRYABLE_EXCEPTIONS as e:
+            breaker.record_failure()
+            last_error = e
+            if retries >= settings.upstream_max_retries:
+                raise UpstreamFailed(e, attempts) from e
+            await asyncio.sleep(backoff_delay(retries, base, cap))
+            retries += 1
+            continue
+        except httpx.HTTPError as e:
+            # Not counted against the breaker: a read or pool timeout means one
+            # slow generation or local saturation, and the breaker is shared by
+            # every agent
+            raise UpstreamFailed(e, attempts) from e
+
+        breaker.record_response(resp.status_code)
+        if resp.status_code in RETRYABLE_STATUSES and retries < settings.upstream_max_retries:
+            retry_after = resp.headers.get("retry-after")
+            await _close(resp)
+            delay = backoff_delay(retries, base, cap)
+            try:
+                delay = max(delay, min(cap, float(retry_after)))
+            except (TypeError, ValueError):
+                pass
+            await asyncio.sleep(delay)
+            retries += 1
+            continue
+        return UpstreamResult(resp, attempts=attempts, retries=retries, hedged=hedged)
+
+
+_breaker: CircuitBreaker | None = None
+_latency_windows: TTLCache | None = None
+
+
+def get_breaker() -> CircuitBreaker:
+    global _breaker
+    if _breaker is None:
+        settings = get_settings()
+        _breaker = CircuitBreaker(
+            failure_threshold=settings.circuit_failure_threshold,
+            reset_timeout=settings.circuit_reset_seconds,
+        )
+    return _breaker
+
+
+def get_latency_window(key, create: bool = True) -> LatencyWindow | None:
+    """Latency window for ``key`` (agent, model); with ``create=False``, None if there is none yet.
+
+    Keys include the client-supplied model name, so windows live in a bounded
+    cache and are only created for requests that succeeded.
+    """
+    global _latency_windows
+    if _latency_windows is None:
+        settings = get_settings()
+        _latency_windows = TTLCache(
+            maxsize=settings.upstream_latency_windows,
+            ttl=settings.upstream_latency_window_ttl_seconds,
+        )
+    window = _latency_windows.get(key)
+    if window is None and create:
+        window = LatencyWindow()
+        _latency_windows.set(key, window)
+    return window
@@ -0,0 +1,63 @@
+import hashlib
+import json
+from dataclasses import dataclass
+
+from .cache import TTLCache
+from .config import get_settings
+
+# Request fields that never change what the model returns
+_IGNORED_FIELDS = {"stream", "metadata"}
+# Request headers that do change it
+_KEY_HEADERS = ("anthropic-version", "anthropic-beta")
+
+
+@dataclass(frozen=True, slots=True)
+class CachedResponse:
+    content: bytes
+    media_type: str
+    model: str
+
+
+_cache: TTLCache | None = None
+
+
+def _get_cache() -> TTLCache:
+    global _cache
+    if _cache is None:
+        settings = get_settings()
+        _cache = TTLCache(
+            maxsize=settings.response_cache_size, ttl=settings.response_cache_ttl_seconds
+        )
+    return _cache
+
+
+def cache_key(agent_id, request_json: dict, headers) -> str | None:
+    """Canonical hash of a deterministic Messages request, or None if it is not cacheable.
+
+    Only non-streaming requests with an explicit ``temperature: 0`` qualify.
+    Keys are sorted so semantically identical bodies hash the same regardless
+    of client field order.
+    """
+    if request_json.get("stream") or request_json.get("temperature") != 0:
+        return None
+    canonical = {k: v for k, v in request_json.items() if k not in _IGNORED_FIELDS}
+    digest = hashlib.sha256()
+    digest.update(str(agent_id).encode())
+    for name in _KEY_HEADERS:
+        digest.update(b"\0" + (headers.get(name) or "").encode())
+    digest.update(b"\0" + json.dumps(canonical, sort_keys=True, separators=(",", ":")).encode())
+    return f"{agent_id}:{digest.hexdigest()}"
+
+
+def get_cached_response(key: str) -> CachedResponse | None:
+    return _get_cache().get(key)
+
+
+def store_response(key: str, content: bytes, media_type: str, model: str):
+    if len(content) <= get_settings().response_cache_max_entry_bytes:
+        _get_cache().set(key, CachedResponse(content=content, media_type=media_type, model=model))
+
+
+def forget_agent_responses(agent_id):
+    prefix = f"{agent_id}:"
+    _get_cache().discard_where_key(lambda key: key.startswith(prefix))
@@ -0,0 +1,230 @@
+"""Billing-period rollover for subscription licenses.
+
+Closes every active license's period once its plan's ``billing_interval``
+has elapsed: the closed period's counters are snapshotted into
+``license_period_history`` and subtracted from the live counters, and
+``period_start`` advances by whole periods (so it stays on the license's
+anniversary even if the job ran late).
+
+Licenses are processed in keyset-paginated chunks, each in its own short
+transaction, so the job never holds locks on more than one chunk. Counters
+are reset with ``x = x - snapshot`` rather than ``x = 0``: usage logged while
+a chunk is in progress lands in the new period instead of being lost. Rows
+locked by another worker's chunk are skipped (on databases that support
+``SKIP LOCKED``); the history table's primary key prevents a period from
+being closed twice.
+
+The in-process schedule also clears token reservations leaked by requests
+that never logged their usage (see ``licenses.release_stale_reservations``)
+and by Message Batches that were never reconciled
+(``batches.expire_batch_reservations``).
+
+    python -m marketplace.rollover [--chunk-size 1000]
+"""
+
+import argparse
+import asyncio
+import logging
+from datetime import UTC, datetime
+
+from sqlalchemy import and_, bindparam, insert, or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+
+from .batches import expire_batch_reservations
+from .config import get_settings
+from .database import get_engine, run_in_db_thread
+from .licenses import billing_period, release_stale_reservations
+from .models import AgentLicense, AgentPricingPlan, LicensePeriodHistory
+
+logger = logging.getLogger(__name__)
+
+_licenses = AgentLicense.__table__
+
+
+def _due_condition(now: datetime):
+    """Active licenses whose current period has run its full length."""
+    yearly = billing_period("yearly")
+    monthly = billing_period("monthly")
+    return and_(
+        AgentLicense.status == "active",
+        or_(
+            and_(
+                AgentPricingPlan.billing_interval == "yearly",
+                AgentLicense.period_start <= now - yearly,
+            ),
+            and_(
+                AgentPricingPlan.billing_interval.is_not(None),
+                AgentPricingPlan.billing_interval != "",
+                AgentPricingPlan.billing_interval != "yearly",
+                AgentLicense.period_start <= now - monthly,
+            ),
+        ),
+    )
+
+
+def rollover_chunk(session: Session, after_id, now: datetime, chunk_size: int) -> tuple[int, object]:
+    """Roll over up to ``chunk_size`` due licenses with ids above ``after_id``.
+
+    Returns ``(rolled_over, last_id)``; ``last_id`` is None once no due
+    licenses remain.
+    """
+    query = (
+        select(
+            AgentLicense.id,
+            AgentLicense.period_start,
+            AgentLicense.period_messages,
+            AgentLicense.period_tokens,
+            AgentPricingPlan.billing_interval,
+        )
+        .join(AgentPricingPlan, AgentPricingPlan.id == AgentLicense.pricing_plan_id)
+        .where(_due_condition(now))
+        .order_by(AgentLicense.id)
+        .limit(chunk_size)
+        .with_for_update(of=AgentLicense, skip_locked=True)
+    )
+    if after_id is not None:
+        query = query.where(AgentLicense.id > after_id)
+    rows = session.exec(query).all()
+    if not rows:
+        return 0, None
+
+    history = []
+    resets = []
+    for license_id, period_start, messages, tokens, billing_interval in rows:
+        length = billing_period(billing_interval)
+        new_start = period_start + length * ((now - period_start) // length)
+        history.append({
+            "license_id": license_id,
+            "period_start": period_start,
+            "period_end": new_start,
+            "messages": messages,
+            "tokens": tokens,
+            "created_at": now,
+        })
+        resets.append({
+            "b_id": license_id,
+            "b_old_start": period_start,
+            "b_new_start": new_start,
+            "b_messages": messages,
+            "b_tokens": tokens,
+        })
+
+    session.execute(insert(LicensePeriodHistory), history)
+    session.connection().execute(
+        update(_licenses)
+        .where(
+            _licenses.c.id == bindparam("b_id"),
+            _licenses.c.period_start == bindparam("b_old_start"),
+        )
+        .values(
+            period_start=bindparam("b_new_start"),
+            period_messages=_licenses.c.period_messages - bindparam("b_messages"),
+            period_tokens=_licenses.c.period_tokens - bindparam("b_tokens"),
+            updated_at=now,
+        ),
+        resets,
+    )
+    session.commit()
+    return len(rows), rows[-1][0]
+
+
+def rollover_periods(chunk_size: int | None = None, now: datetime | None = None) -> int:
+    """Roll over every due license, one chunk per transaction. Returns the count."""
+    chunk_size = chunk_size or get_settings().rollover_chunk_size
+    now = now or datetime.now(UTC).replace(tzinfo=None)
+    total = 0
+    after_id = None
+    conflicts = 0
+    while True:
+        with Session(get_engine()) as session:
+            try:
+                count, last_id = rollover_chunk(session, after_id, now, chunk_size)
+            except IntegrityError:
+                # Another worker closed some of these periods first. Those
+                # licenses are no longer due, so the retried chunk skips them.
+                session.rollback()
+                conflicts += 1
+                if conflicts > 3:
+                    raise
+                continue
+        if last_id is None:
+            break
+        total += count
+        after_id = last_id
+        conflicts = 0
+    if total:
+        logger.info("Rolled over %d license billing periods", total)
+    return total
+
+
+# ── In-process schedule ─────────────────────────────────────────────
+
+_task: asyncio.Task | None = None
+
+
+def _release_stale_reservations() -> int:
+    with Session(get_engine()) as session:
+        count = release_stale_reservations(session, get_settings().quota_hold_ttl_seconds)
+    if count:
+        logger.warning("Released stale token reservations on %d licenses", count)
+    return count
+
+
+def _expire_batch_reservations() -> list[str]:
+    with Session(get_engine()) as session:
+        expired = expire_batch_reservations(session, get_settings().batch_reservation_ttl_seconds)
+    if expired:
+        logger.warning("Released the reservation of %d unreconciled batches: %s",
+                       len(expired), ", ".join(expired))
+    return expired
+
+
+async def _run_schedule(interval: float):
+    while True:
+        try:
+            await run_in_db_thread(rollover_periods)
+        except Exception:
+            logger.exception("Billing-period rollover failed")
+        try:
+            await run_in_db_thread(_release_stale_reservations)
+        except Exception:
+            logger.exception("Releasing stale token reservations failed")
+        try:
+            await run_in_db_thread(_expire_batch_reservations)
+        except Exception:
+            logger.exception("Expiring unreconciled batch reservations failed")
+        await asyncio.sleep(interval)
+
+
+def start_rollover_schedule():
+    global _task
+    interval = get_settings().rollover_interval_seconds
+    if _task is None and interval > 0:
+        _task = asyncio.get_running_loop().create_task(_run_schedule(interval))
+
+
+async def stop_rollover_schedule():
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Roll over finished license billing periods.")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="licenses per transaction (default: ROLLOVER_CHUNK_SIZE)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    count = rollover_periods(chunk_size=args.chunk_size)
+    print(f"Rolled over {count} license billing periods")
+
+
+if __name__ == "__main__":
+    main()
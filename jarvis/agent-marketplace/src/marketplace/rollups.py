@@ -0,0 +1,159 @@
+"""Hourly and daily proxy usage rollups per license and per agent.
+
+The usage sink applies every flushed batch of ``ProxyUsageLog`` rows here in
+the same transaction, so rollups never drift from the raw log. Time-series
+queries read only ``usage_rollups`` and cost the same however many raw rows
+exist.
+"""
+
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, col, select
+
+from .metrics import bucket_index, percentile_from_buckets
+from .models import UsageRollup
+
+GRANULARITIES = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+
+_SUM_FIELDS = ("requests", "input_tokens", "output_tokens", "cost_cents", "error_count", "total_latency_ms")
+
+
+def bucket_start(ts: datetime, granularity: str) -> datetime:
+    ts = ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0) if granularity == "day" else ts
+
+
+def _aggregate(rows: list[dict]) -> dict:
+    deltas = defaultdict(lambda: {**dict.fromkeys(_SUM_FIELDS, 0), "buckets": Counter()})
+    for row in rows:
+        latency = max(0, int(row.get("response_time_ms") or 0))
+        for granularity in GRANULARITIES:
+            start = bucket_start(row["created_at"], granularity)
+            for scope, scope_id in (("license", row["license_id"]), ("agent", row["agent_profile_id"])):
+                delta = deltas[(scope, scope_id, granularity, start)]
+                delta["requests"] += 1
+                delta["input_tokens"] += row.get("input_tokens", 0)
+                delta["output_tokens"] += row.get("output_tokens", 0)
+                delta["cost_cents"] += row.get("estimated_cost_cents", 0)
+                delta["error_count"] += 0 if row["success"] else 1
+                delta["total_latency_ms"] += latency
+                delta["buckets"][bucket_index(latency)] += 1
+    return deltas
+
+
+def _key(rollup: UsageRollup) -> tuple:
+    return (rollup.scope, rollup.scope_id, rollup.granularity, rollup.bucket_start)
+
+
+def _merge(rollup: UsageRollup, delta: dict):
+    for field in _SUM_FIELDS:
+        setattr(rollup, field, getattr(rollup, field) + delta[field])
+    buckets = Counter({int(k): v for k, v in rollup.latency_buckets.items()})
+    buckets.update(delta["buckets"])
+    # Assign a new dict so the JSON column is marked dirty
+    rollup.latency_buckets = {str(k): v for k, v in buckets.items()}
+
+
+def _new_row(key: tuple, delta: dict) -> dict:
+    scope, scope_id, granularity, start = key
+    return {
+        "scope": scope,
+        "scope_id": scope_id,
+        "granularity": granularity,
+        "bucket_start": start,
+        **{field: delta[field] for field in _SUM_FIELDS},
+        "latency_buckets": {str(k): v for k, v in delta["buckets"].items()},
+    }
+
+
+def _upsert_one(session: Session, key: tuple, delta: dict):
+    pk = dict(zip(("scope", "scope_id", "granularity", "bucket_start"), key))
+    rollup = session.get(UsageRollup, pk, with_for_update=True)
+    if rollup is None:
+        try:
+            with session.begin_nested():
+                session.execute(insert(UsageRollup), [_new_row(key, delta)])
+            return
+        except IntegrityError:
+            rollup = session.get(UsageRollup, pk, with_for_update=True, populate_existing=True)
+    _merge(rollup, delta)
+
+
+def apply_usage_rollups(session: Session, rows: list[dict]):
+    """Fold usage rows (ProxyUsageLog column dicts) into their rollups. The caller commits.
+
+    Existing rollups for the batch are read with one locking SELECT and
+    updated in place; missing ones are created with one multi-row INSERT,
+    falling back to per-row upserts if another worker created some first.
+    """
+    deltas = _aggregate(rows)
+    if not deltas:
+        return
+
+    scope_ids = {key[1] for key in deltas}
+    starts = {key[3] for key in deltas}
+    candidates = session.exec(
+        select(UsageRollup)
+        .where(
+            col(UsageRollup.scope_id).in_(scope_ids),
+            col(UsageRollup.bucket_start).in_(starts),
+        )
+        .with_for_update()
+    ).all()
+    existing = {_key(r): r for r in candidates if _key(r) in deltas}
+    for key, rollup in existing.items():
+        _merge(rollup, deltas[key])
+
+    missing = [key for key in sorted(deltas) if key not in existing]
+    if not missing:
+        return
+    try:
+        with session.begin_nested():
+            session.execute(insert(UsageRollup), [_new_row(key, deltas[key]) for key in missing])
+    except IntegrityError:
+        for key in missing:
+            _upsert_one(session, key, deltas[key])
+
+
+def usage_series(
+    session: Session,
+    scope: str,
+    scope_id,
+    granularity: str,
+    start: datetime,
+    end: datetime,
+) -> list[dict]:
+    """Rollup points for one license or agent in ``[start, end)``, oldest first.
+
+    Buckets without any usage are omitted.
+    """
+    rollups = session.exec(
+        select(UsageRollup)
+        .where(
+            UsageRollup.scope == scope,
+            UsageRollup.scope_id == scope_id,
+            UsageRollup.granularity == granularity,
+            UsageRollup.bucket_start >= bucket_start(start, granularity),
+            UsageRollup.bucket_start < end,
+        )
+        .order_by(UsageRollup.bucket_start)
+    ).all()
+
+    points = []
+    for rollup in rollups:
+        buckets = {int(k): v for k, v in rollup.latency_buckets.items()}
+        points.append({
+            "bucket_start": rollup.bucket_start,
+            "requests": rollup.requests,
+            "input_tokens": rollup.input_tokens,
+            "output_tokens": rollup.output_tokens,
+            "cost_cents": rollup.cost_cents,
+            "error_count": rollup.error_count,
+            "avg_latency_ms": round(rollup.total_latency_ms / rollup.requests) if rollup.requests else 0,
+            "p50_latency_ms": percentile_from_buckets(buckets, 50),
+            "p95_latency_ms": percentile_from_buckets(buckets, 95),
+        })
+    return points
@@ -1,17 +1,19 @@
 import uuid
-from datetime import UTC, datetime
+from datetime import UTC, datetime, timedelta
 
 from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlmodel import Session, col, func, select
 
 from ..auth import get_current_user
 from ..database import get_session
-from ..licenses import create_license
+from ..licenses import create_license, invalidate_agent, invalidate_plan, revoke_license
 from ..models import (
     AGENT_CATEGORIES,
+    AgentApiKey,
     AgentLicense,
     AgentPricingPlan,
     AgentProfile,
+    AgentSession,
     Conversation,
     Message,
     ProxyUsageLog,
@@ -25,6 +27,9 @@ from ..schemas import (
     AgentUpdateRequest,
     AgentBrainConfigRequest,
     AgentApiKeyRequest,
+    AgentPoolKeyRequest,
+    AgentPoolKeyResponse,
+    AgentPoolKeyUpdateRequest,
     AgentPricingRequest,
     DashboardStatsResponse,
     LicenseResponse,
@@ -33,18 +38,30 @@ from ..schemas import (
     PurchaseRequest,
     PurchaseResponse,
     UsageLogResponse,
+    UsageSeriesResponse,
     UsageStatsResponse,
     WebhookConfigRequest,
     WebhookConfigResponse,
 )
-from ..encryption import encrypt_api_key, mask_api_key
-from ..llm import validate_api_key
+from ..encryption import encrypt_api_key, forget_agent_api_key, mask_api_key
+from ..key_pool import get_key_balancer
+from ..llm import forget_agent_clients, validate_api_key
+from ..response_cache import forget_agent_responses
+from ..rollups import usage_series
 from ..slug import ensure_unique_slug, generate_slug
 from ..webhook import generate_webhook_secret, ping_webhook
 
 router = APIRouter(tags=["agents"])
 
 
+def _forget_agent_key(agent_id: uuid.UUID):
+    """Evict everything derived from an agent's old API key after rotation or removal."""
+    invalidate_agent(agent_id)
+    forget_agent_api_key(agent_id)
+    forget_agent_clients(agent_id)
+    forget_agent_responses(agent_id)
+
+
 def _enrich(profile: AgentProfile, session: Session) -> AgentResponse:
     resp = AgentResponse.model_validate(profile)
     owner = session.get(User, profile.owner_id)
@@ -250,6 +267,9 @@ def update_agent_profile(
     session.add(profile)
     session.commit()
     session.refresh(profile)
+    if "proxy_response_cache" in update_data:
+        invalidate_agent(profile.id)
+        forget_agent_responses(profile.id)
     return _enrich(profile, session)
 
 
@@ -325,6 +345,9 @@ def set_agent_api_key(
 
     session.add(agent)
     session.commit()
+    _forget_agent_key(agent.id)
+    # A new primary key starts without the old one's ejections
+    get_key_balancer().forget(agent.id, None)
     return {"status": "ok", "preview": agent.api_key_preview}
 
 
@@ -344,6 +367,128 @@ def remove_agent_api_key(
     agent.updated_at = datetime.now(UTC).replace(tzinfo=None)
     session.add(agent)
     session.commit()
+    _forget_agent_key(agent.id)
+    get_key_balancer().forget(agent.id, None)
+    return {"status": "ok"}
+
+
+# ── API key pool ─────────────────────────────────────────────────────
+#
+# Extra upstream keys the proxy and chat balance across alongside the
+# primary key, so an agent is not capped at one key's rate limit.
+
+
+def _own_pool_key(agent_id: uuid.UUID, key_id: uuid.UUID, user: User, session: Session) -> AgentApiKey:
+    agent = session.get(AgentProfile, agent_id)
+    if not agent or agent.owner_id != user.id:
+        raise HTTPException(403, "Not your agent")
+    key = session.get(AgentApiKey, key_id)
+    if not key or key.agent_profile_id != agent.id:
+        raise HTTPException(404, "API key not found")
+    return key
+
+
+def _pool_key_response(key: AgentApiKey, runtime: dict) -> AgentPoolKeyResponse:
+    state = runtime.get(f"{key.agent_profile_id}/{key.id}", {})
+    return AgentPoolKeyResponse(
+        id=key.id,
+        label=key.label,
+        api_key_preview=key.api_key_preview,
+        weight=key.weight,
+        is_active=key.is_active,
+        created_at=key.created_at.isoformat(),
+        in_flight=state.get("in_flight", 0),
+        ejected_for_ms=state.get("ejected_for_ms", 0),
+        total_calls=state.get("total_calls", 0),
+        last_status=state.get("last_status"),
+    )
+
+
+@router.get("/agents/{id}/api-keys", response_model=list[AgentPoolKeyResponse])
+def list_agent_pool_keys(
+    id: uuid.UUID,
+    user: User = Depends(get_current_user),
+    session: Session = Depends(get_session),
+):
+    """The agent's extra keys, with this process's in-flight and ejection state for each."""
+    agent = session.get(AgentProfile, id)
+    if not agent or agent.owner_id != user.id:
+        raise HTTPException(403, "Not your agent")
+    keys = session.exec(
+        select(AgentApiKey)
+        .where(AgentApiKey.agent_profile_id == agent.id)
+        .order_by(AgentApiKey.created_at)
+    ).all()
+    runtime = get_key_balancer().snapshot(agent.id)
+    return [_pool_key_response(k, runtime) for k in keys]
+
+
+@router.post("/agents/{id}/api-keys", response_model=AgentPoolKeyResponse, status_code=201)
+def add_agent_pool_key(
+    id: uuid.UUID,
+    data: AgentPoolKeyRequest,
+    user: User = Depends(get_current_user),
+    session: Session = Depends(get_session),
+):
+    agent = session.get(AgentProfile, id)
+    if not agent or agent.owner_id != user.id:
+        raise HTTPException(403, "Not your agent")
+
+    if not data.api_key.startswith("sk-ant-"):
+        raise HTTPException(400, "Invalid Anthropic API key format. Must start with sk-ant-")
+
+    if not validate_api_key(data.api_key):
+        raise HTTPException(400, "API key is invalid. Please check and try again.")
+
+    key = AgentApiKey(
+        agent_profile_id=agent.id,
+        label=data.label,
+        encrypted_api_key=encrypt_api_key(data.api_key),
+        api_key_preview=mask_api_key(data.api_key),
+        weight=data.weight,
+    )
+    session.add(key)
+    session.commit()
+    session.refresh(key)
+    invalidate_agent(agent.id)
+    return _pool_key_response(key, {})
+
+
+@router.patch("/agents/{id}/api-keys/{key_id}", response_model=AgentPoolKeyResponse)
+def update_agent_pool_key(
+    id: uuid.UUID,
+    key_id: uuid.UUID,
+    data: AgentPoolKeyUpdateRequest,
+    user: User = Depends(get_current_user),
+    session: Session = Depends(get_session),
+):
+    key = _own_pool_key(id, key_id, user, session)
+    for field, value in data.model_dump(exclude_unset=True).items():
+        if value is not None or field == "label":
+            setattr(key, field, value)
+    key.updated_at = datetime.now(UTC).replace(tzinfo=None)
+    session.add(key)
+    session.commit()
+    session.refresh(key)
+    invalidate_agent(key.agent_profile_id)
+    if not key.is_active:
+        get_key_balancer().forget(key.agent_profile_id, key.id)
+    return _pool_key_response(key, get_key_balancer().snapshot(key.agent_profile_id))
+
+
+@router.delete("/agents/{id}/api-keys/{key_id}")
+def remove_agent_pool_key(
+    id: uuid.UUID,
+    key_id: uuid.UUID,
+    user: User = Depends(get_current_user),
+    session: Session = Depends(get_session),
+):
+    key = _own_pool_key(id, key_id, user, session)
+    agent_id = key.agent_profile_id
+    session.delete(key)
+    session.commit()
+    _forget_agent_key(agent_id)
+    get_key_balancer().forget(agent_id, key_id)
     return {"status": "ok"}
 
 
@@ -377,6 +522,14 @@ def get_brain_status(
     if not agent or agent.owner_id != user.id:
         raise HTTPException(403, "Not your agent")
 
+    input_tokens, cache_read, cache_creation = session.exec(
+        select(
+            func.coalesce(func.sum(AgentSession.total_input_tokens), 0),
+            func.coalesce(func.sum(AgentSession.total_cache_read_tokens), 0),
+            func.coalesce(func.sum(AgentSession.total_cache_creation_tokens), 0),
+        ).where(AgentSession.agent_profile_id == id)
+    ).one()
+
     return {
         "has_system_prompt": bool(agent.system_prompt),
         "system_prompt": agent.system_prompt or "",
@@ -391,6 +544,13 @@ def get_brain_status(
             "per_conversation_cents": agent.price_per_conversation_cents,
             "per_message_cents": agent.price_per_message_cents,
         },
+        # Chat prompt tokens served from the prompt cache
+        "prompt_cache": {
+            "input_tokens": input_tokens,
+            "cache_read_tokens": cache_read,
+            "cache_creation_tokens": cache_creation,
+            "hit_ratio": round(cache_read / input_tokens, 4) if input_tokens else 0.0,
+        },
     }
 
 
@@ -543,6 +703,7 @@ def create_pricing_plan(
         rental_duration_days=data.rental_duration_days,
         max_messages_per_period=data.max_messages_per_period,
         max_tokens_per_period=data.max_tokens_per_period,
+        max_requests_per_minute=data.max_requests_per_minute,
     )
     session.add(plan)
     session.commit()
@@ -583,6 +744,7 @@ def delete_pricing_plan(
     plan.is_active = False
     session.add(plan)
     session.commit()
+    invalidate_plan(plan.id)
 
 
 # ── Purchase / Licenses ─────────────────────────────────────────
@@ -665,6 +827,22 @@ def list_my_licenses(
     return results
 
 
+@router.post("/licenses/{license_id}/revoke", status_code=204)
+def revoke_agent_license(
+    license_id: uuid.UUID,
+    user: User = Depends(get_current_user),
+    session: Session = Depends(get_session),
+):
+    """Cancel a license (its buyer) or revoke it (the agent's owner)."""
+    license = session.get(AgentLicense, license_id)
+    agent = session.get(AgentProfile, license.agent_profile_id) if license else None
+    if not license or user.id not in (license.buyer_id, agent and agent.owner_id):
+        raise HTTPException(404, "License not found")
+    if license.status != "active":
+        raise HTTPException(400, f"License is already {license.status}")
+    revoke_license(session, license)
+
+
 @router.get("/licenses/{license_id}/usage", response_model=UsageStatsResponse)
 def get_license_usage(
     license_id: uuid.UUID,
@@ -700,6 +878,67 @@ def get_license_usage(
     )
 
 
+# Default window when a usage series is requested without explicit bounds
+_SERIES_DEFAULT_WINDOW = {"hour": timedelta(hours=48), "day": timedelta(days=30)}
+
+
+def _series_response(
+    session: Session,
+    scope: str,
+    scope_id: uuid.UUID,
+    granularity: str,
+    start: datetime | None,
+    end: datetime | None,
+) -> UsageSeriesResponse:
+    # Stored timestamps are naive UTC
+    if end and end.tzinfo:
+        end = end.astimezone(UTC).replace(tzinfo=None)
+    if start and start.tzinfo:
+        start = start.astimezone(UTC).replace(tzinfo=None)
+    end = end or datetime.now(UTC).replace(tzinfo=None)
+    start = start or end - _SERIES_DEFAULT_WINDOW[granularity]
+    if start >= end:
+        raise HTTPException(400, "start must be before end")
+    return UsageSeriesResponse(
+        scope=scope,
+        scope_id=scope_id,
+        granularity=granularity,
+        start=start,
+        end=end,
+        points=usage_series(session, scope, scope_id, granularity, start, end),
+    )
+
+
+@router.get("/licenses/{license_id}/usage/series", response_model=UsageSeriesResponse)
+def get_license_usage_series(
+    license_id: uuid.UUID,
+    granularity: str = Query(default="hour", pattern="^(hour|day)$"),
+    start: datetime | None = None,
+    end: datetime | None = None,
+    user: User = Depends(get_current_user),
+    session: Session = Depends(get_session),
+):
+    license = session.get(AgentLicense, license_id)
+    if not license or license.buyer_id != user.id:
+        raise HTTPException(404, "License not found")
+    return _series_response(session, "license", license_id, granularity, start, end)
+
+
+@router.get("/agents/{id}/usage/series", response_model=UsageSeriesResponse)
+def get_agent_usage_series(
+    id: uuid.UUID,
+    granularity: str = Query(default="day", pattern="^(hour|day)$"),
+    start: datetime | None = None,
+    end: datetime | None = None,
+    user: User = Depends(get_current_user),
+    session: Session = Depends(get_session),
+):
+    agent = session.get(AgentProfile, id)
+    if not agent or agent.owner_id != user.id:
+        raise HTTPException(403, "Not your agent")
+    return _series_response(session, "agent", id, granularity, start, end)
+
+
 # ── Dashboard Stats (JWT) ───────────────────────────────────────────
 
 
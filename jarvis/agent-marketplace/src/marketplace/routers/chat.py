@@ -1,10 +1,17 @@
+import json
+import logging
 import uuid
+from dataclasses import dataclass
 
+import anyio
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import update
 from sqlmodel import Session, select
 
 from ..auth import get_current_user
-from ..database import get_session
+from ..chat_context import build_context, system_with_summary
+from ..chat_summary import get_summarizer
+from ..database import get_engine, get_session, run_in_db_thread
 from ..models import AgentProfile, AgentSession, AgentChatMessage, User, _utcnow
 from ..schemas import (
     SessionResponse,
@@ -12,7 +19,12 @@ from ..schemas import (
     ChatMessageResponse,
     ChatResponse,
 )
-from ..llm import call_agent
+from ..key_pool import PoolKey, load_pool
+from ..llm import AgentReply, call_agent_async, stream_agent
+from ..streaming import RelayResponse
+from ..tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(tags=["chat"])
 
@@ -58,7 +70,7 @@ def start_session(
         raise HTTPException(404, "Agent not found")
     if not agent.system_prompt:
         raise HTTPException(400, "This agent is not configured for chat yet")
-    if not agent.has_api_key or not agent.encrypted_api_key:
+    if not load_pool(session, agent):
         raise HTTPException(400, "This agent is not configured for chat yet")
 
     chat_session = AgentSession(
@@ -71,82 +83,230 @@ def start_session(
     return _session_response(chat_session, agent)
 
 
-@router.post("/sessions/{session_id}/messages", response_model=ChatResponse)
-def send_message(
-    session_id: uuid.UUID,
-    data: ChatSendMessageRequest,
-    user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
-):
-    chat_session = session.get(AgentSession, session_id)
-    if not chat_session:
-        raise HTTPException(404, "Session not found")
-    if chat_session.user_id != user.id:
-        raise HTTPException(403, "Not your session")
-    if not chat_session.is_active:
-        raise HTTPException(400, "Session is closed")
+@dataclass
+class _Turn:
+    """What a chat turn needs from the database, loaded before the model is called."""
 
-    agent = session.get(AgentProfile, chat_session.agent_profile_id)
-    if not agent or not agent.encrypted_api_key or not agent.system_prompt:
-        raise HTTPException(400, "Agent is not properly configured")
-
-    user_msg = AgentChatMessage(
-        session_id=chat_session.id,
-        role="user",
-        content=data.content,
-        tokens_used=0,
-    )
-    session.add(user_msg)
-    session.flush()
+    session_id: uuid.UUID
+    agent_id: uuid.UUID
+    api_keys: tuple[PoolKey, ...]
+    system_prompt: str | list[dict]  # With the session's rolling summary, if any
+    model: str
+    temperature: float
+    max_tokens: int
+    messages: list[dict]
+    user_message: AgentChatMessage
 
-    history = session.exec(
-        select(AgentChatMessage)
-        .where(AgentChatMessage.session_id == chat_session.id)
-        .order_by(AgentChatMessage.created_at.asc())
-    ).all()
 
-    messages = [{"role": msg.role, "content": msg.content} for msg in history]
+def _start_turn(session_id: uuid.UUID, user_id: uuid.UUID, content: str) -> _Turn:
+    """Check the session, store the user's message and pick the history that fits the context budget."""
+    with Session(get_engine()) as session:
+        chat_session = session.get(AgentSession, session_id)
+        if not chat_session:
+            raise HTTPException(404, "Session not found")
+        if chat_session.user_id != user_id:
+            raise HTTPException(403, "Not your session")
+        if not chat_session.is_active:
+            raise HTTPException(400, "Session is closed")
 
-    try:
-        result = call_agent(
-            encrypted_api_key=agent.encrypted_api_key,
-            system_prompt=agent.system_prompt,
-            messages=messages,
+        agent = session.get(AgentProfile, chat_session.agent_profile_id)
+        api_keys = load_pool(session, agent) if agent else ()
+        if not api_keys or not agent.system_prompt:
+            raise HTTPException(400, "Agent is not properly configured")
+
+        user_msg = AgentChatMessage(
+            session_id=chat_session.id,
+            role="user",
+            content=content,
+            content_tokens=estimate_tokens(content),
+            tokens_used=0,
+        )
+        session.add(user_msg)
+        session.flush()
+
+        system_prompt = system_with_summary(agent.system_prompt, chat_session.summary)
+        turn = _Turn(
+            session_id=chat_session.id,
+            agent_id=agent.id,
+            api_keys=api_keys,
+            system_prompt=system_prompt,
             model=agent.llm_model,
             temperature=agent.temperature,
             max_tokens=agent.max_tokens,
+            messages=build_context(
+                session, chat_session.id, system_prompt, after=chat_session.summarized_until
+            ),
+            user_message=user_msg,
         )
-    except Exception as e:
+        # Committed before the model call so the message survives a failed turn
         session.commit()
-        raise HTTPException(502, f"Agent failed to respond: {str(e)}")
+        session.refresh(user_msg)
+        return turn
 
-    assistant_msg = AgentChatMessage(
-        session_id=chat_session.id,
-        role="assistant",
-        content=result["content"],
-        tokens_used=result["tokens_used"],
-        model_used=result["model"],
-    )
-    session.add(assistant_msg)
 
-    chat_session.total_messages += 2
-    chat_session.total_tokens_used += result["tokens_used"]
-    chat_session.updated_at = _utcnow()
+def _finish_turn(turn: _Turn, result: dict) -> AgentChatMessage:
+    """Store the assistant's reply and bump the session's counters."""
+    with Session(get_engine()) as session:
+        assistant_msg = AgentChatMessage(
+            session_id=turn.session_id,
+            role="assistant",
+            content=result["content"],
+            content_tokens=result["output_tokens"],
+            tokens_used=result["tokens_used"],
+            cache_read_tokens=result["cache_read_tokens"],
+            cache_creation_tokens=result["cache_creation_tokens"],
+            model_used=result["model"],
+        )
+        session.add(assistant_msg)
 
-    if chat_session.title is None:
-        chat_session.title = data.content[:80] + ("..." if len(data.content) > 80 else "")
+        # Atomic increments: a user can have several turns in flight at once
+        session.execute(
+            update(AgentSession)
+            .where(AgentSession.id == turn.session_id)
+            .values(
+                total_messages=AgentSession.total_messages + 2,
+                total_tokens_used=AgentSession.total_tokens_used + result["tokens_used"],
+                total_input_tokens=AgentSession.total_input_tokens + result["input_tokens"],
+                total_cache_read_tokens=(
+                    AgentSession.total_cache_read_tokens + result["cache_read_tokens"]
+                ),
+                total_cache_creation_tokens=(
+                    AgentSession.total_cache_creation_tokens + result["cache_creation_tokens"]
+                ),
+                updated_at=_utcnow(),
+            )
+        )
+        content = turn.user_message.content
+        session.execute(
+            update(AgentSession)
+            .where(AgentSession.id == turn.session_id, AgentSession.title.is_(None))
+            .values(title=content[:80] + ("..." if len(content) > 80 else ""))
+        )
+        session.commit()
+        session.refresh(assistant_msg)
+        return assistant_msg
 
-    session.add(chat_session)
-    session.commit()
-    session.refresh(user_msg)
-    session.refresh(assistant_msg)
 
+@router.post("/sessions/{session_id}/messages", response_model=ChatResponse)
+async def send_message(
+    session_id: uuid.UUID,
+    data: ChatSendMessageRequest,
+    user: User = Depends(get_current_user),
+    session: Session = Depends(get_session),
+):
+    # The auth lookup's connection would otherwise stay checked out for the
+    # whole model call; the turn's own DB work uses short-lived sessions
+    session.close()
+
+    turn = await run_in_db_thread(_start_turn, session_id, user.id, data.content)
+    try:
+        result = await call_agent_async(
+            turn.agent_id,
+            turn.api_keys,
+            system_prompt=turn.system_prompt,
+            messages=turn.messages,
+            model=turn.model,
+            temperature=turn.temperature,
+            max_tokens=turn.max_tokens,
+        )
+    except Exception as e:
+        raise HTTPException(502, f"Agent failed to respond: {str(e)}")
+
+    assistant_msg = await run_in_db_thread(_finish_turn, turn, result)
+    get_summarizer().submit(turn.session_id)
     return ChatResponse(
-        user_message=_msg_response(user_msg),
+        user_message=_msg_response(turn.user_message),
         assistant_message=_msg_response(assistant_msg),
     )
 
 
+@router.post("/sessions/{session_id}/messages/stream")
+async def stream_message(
+    session_id: uuid.UUID,
+    data: ChatSendMessageRequest,
+    user: User = Depends(get_current_user),
+    session: Session = Depends(get_session),
+):
+    """Like ``send_message``, but relays the reply as server-sent events.
+
+    Events: ``user_message`` (the stored message), ``delta`` (``{"text": ...}``
+    per chunk of the reply), then ``assistant_message`` once the reply is
+    stored, or ``error`` if the model call fails.
+    """
+    session.close()
+    turn = await run_in_db_thread(_start_turn, session_id, user.id, data.content)
+    relay = _ReplyRelay(turn)
+    return RelayResponse(
+        relay.events(),
+        on_close=relay.close,
+        media_type="text/event-stream",
+        headers={"cache-control": "no-cache", "x-accel-buffering": "no"},
+    )
+
+
+def _sse(event: str, data) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+class _ReplyRelay:
+    """Relays one streamed reply; ``close`` stores whatever was generated, exactly once."""
+
+    def __init__(self, turn: _Turn):
+        self.turn = turn
+        self.reply = AgentReply(model=turn.model)
+        self.chunks = stream_agent(
+            self.reply,
+            turn.agent_id,
+            turn.api_keys,
+            system_prompt=turn.system_prompt,
+            messages=turn.messages,
+            temperature=turn.temperature,
+            max_tokens=turn.max_tokens,
+        )
+        self.assistant_msg: AgentChatMessage | None = None
+        self._closed = False
+
+    async def events(self):
+        turn = self.turn
+        yield _sse("user_message", _msg_response(turn.user_message).model_dump(mode="json"))
+        failed = False
+        try:
+            async for text in self.chunks:
+                yield _sse("delta", {"text": text})
+        except Exception as e:
+            failed = True
+            logger.warning("Chat stream for session %s failed: %s", turn.session_id, e)
+            yield _sse("error", {"message": f"Agent failed to respond: {str(e)}"})
+        # Stored before the final event so it can carry the message's id
+        with anyio.CancelScope(shield=True):
+            await self.close()
+        if self.assistant_msg and not failed:
+            yield _sse("assistant_message", _msg_response(self.assistant_msg).model_dump(mode="json"))
+
+    async def close(self):
+        """Store the reply along with the tokens it used, even if the client left mid-stream."""
+        if self._closed:
+            return
+        self._closed = True
+        await self.chunks.aclose()
+        reply = self.reply
+        if not (reply.parts or reply.prompt_tokens):
+            return
+        output_tokens = reply.output_tokens
+        if not reply.complete:
+            output_tokens = max(output_tokens, estimate_tokens(reply.content))
+        self.assistant_msg = await run_in_db_thread(_finish_turn, self.turn, {
+            "content": reply.content,
+            "tokens_used": reply.prompt_tokens + output_tokens,
+            "input_tokens": reply.prompt_tokens,
+            "output_tokens": output_tokens,
+            "cache_read_tokens": reply.cache_read_tokens,
+            "cache_creation_tokens": reply.cache_creation_tokens,
+            "model": reply.model,
+        })
+        get_summarizer().submit(self.turn.session_id)
+
+
 @router.get("/sessions/{session_id}")
 def get_session_detail(
     session_id: uuid.UUID,
@@ -1,21 +1,60 @@
+import asyncio
+import json
 import logging
+import math
 import time
+import uuid
 from datetime import UTC, datetime
 
+import anyio
 import httpx
-from fastapi import APIRouter, Request, Response
-from sqlmodel import Session
+from fastapi import APIRouter, Depends, Request, Response
+from sqlalchemy import update
+from sqlmodel import Session, select
+from starlette.background import BackgroundTask
 
-from ..database import get_engine
-from ..encryption import decrypt_api_key
-from ..licenses import validate_license
-from ..models import ProxyUsageLog
+from ..auth import require_admin
+from ..batches import BATCH_PRICE_FACTOR, BatchResultsTracker, reconcile_batch, summarize_batch_request
+from ..config import get_settings
+from ..database import get_engine, run_in_db_thread
+from ..encryption import get_agent_api_key
+from ..key_pool import PoolKey, get_key_balancer
+from ..licenses import increment_usage_counters, load_agent_snapshot, validate_license
+from ..metrics import PhaseTimer, get_proxy_metrics
+from ..models import ProxyBatch, ProxyUsageLog
+from ..quota import (
+    QuotaExceeded,
+    QuotaHold,
+    acquire_batch_quota,
+    acquire_quota,
+    release_quota,
+    settle_quota,
+)
+from ..request_body import BodyTooLarge, RequestBody, read_request_body
+from ..resilience import (
+    CircuitOpen,
+    UpstreamFailed,
+    UpstreamResult,
+    call_upstream,
+    get_breaker,
+    get_latency_window,
+)
+from ..response_cache import cache_key, get_cached_response, store_response
+from ..rollups import apply_usage_rollups
+from ..sse import SSEUsageTracker
+from ..streaming import RelayResponse
+from ..tokens import estimate_input_tokens
+from ..upstream import get_upstream_client
+from ..upstream_gate import GateRejected, gate_snapshots, get_gate
+from ..usage_sink import get_usage_sink, usage_row
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/proxy", tags=["proxy"])
 
-ANTHROPIC_API_URL = "https://api.anthropic.com/v1/messages"
+ANTHROPIC_MESSAGES_PATH = "/v1/messages"
+ANTHROPIC_BATCHES_PATH = "/v1/messages/batches"
+ANTHROPIC_COUNT_TOKENS_PATH = "/v1/messages/count_tokens"
 
 # Cost per million tokens (in cents)
 MODEL_PRICING = {
@@ -35,14 +74,20 @@ def _estimate_cost_cents(model: str, input_tokens: int, output_tokens: int) -> i
 
 
 def _error_response(error_type: str, message: str, status_code: int = 400) -> Response:
-    import json
-
     body = json.dumps({"type": "error", "error": {"type": error_type, "message": message}})
     return Response(content=body, status_code=status_code, media_type="application/json")
 
 
-@router.post("/v1/messages")
-async def proxy_messages(request: Request):
+class _Rejected(Exception):
+    """Raised by shared request steps; carries the error response to return."""
+
+    def __init__(self, response: Response):
+        super().__init__(response.status_code)
+        self.response = response
+
+
+async def _authorize(request: Request, timer: PhaseTimer | None = None) -> dict:
+    """Validate the request's license key; returns the ``validate_license`` result."""
     # 1. Extract license key from headers
     license_key = request.headers.get("x-api-key") or ""
     if not license_key:
@@ -51,52 +96,191 @@ async def proxy_messages(request: Request):
             license_key = auth_header[7:]
 
     if not license_key or not license_key.startswith("swrm_lic_"):
-        return _error_response(
+        raise _Rejected(_error_response(
             "authentication_error",
             "Invalid or missing license key. Use your Swarm license key as the x-api-key header.",
             401,
-        )
+        ))
 
     # 2. Validate license
-    engine = get_engine()
-    with Session(engine) as session:
-        try:
-            result = validate_license(session, license_key)
-        except ValueError as e:
-            return _error_response("authentication_error", str(e), 403)
+    try:
+        result = await run_in_db_thread(_validate, license_key)
+    except ValueError as e:
+        raise _Rejected(_error_response("authentication_error", str(e), 403))
 
-        license = result["license"]
-        agent = result["agent"]
-        plan = result["plan"]
+    agent = result["agent"]
+    if timer:
+        timer.mark("license")
+
+    if not agent.api_keys:
+        raise _Rejected(_error_response(
+            "invalid_request_error",
+            "Agent has no API key configured. Contact the agent creator.",
+            400,
+        ))
+    return result
+
+
+def _checkout_key(agent, key_id=None, pinned: bool = False) -> tuple[PoolKey, str]:
+    """Take a key from the agent's pool and decrypt it; pair with ``_return_key``.
 
-        # 3. Decrypt creator's API key
-        if not agent.encrypted_api_key:
-            return _error_response(
+    With ``pinned``, the key ``key_id`` (None = the primary key) is used instead
+    of the balancer's choice, for resources that live under one upstream key.
+    """
+    balancer = get_key_balancer()
+    if pinned:
+        key = next((k for k in agent.api_keys if k.id == key_id), None)
+        if key is None:
+            raise _Rejected(_error_response(
                 "invalid_request_error",
-                "Agent has no API key configured. Contact the agent creator.",
-                400,
+                "The agent API key this batch was created with is no longer available. "
+                "Contact the agent creator.",
+                409,
+            ))
+        key = balancer.acquire(agent.id, (key,))
+    else:
+        key = balancer.acquire(agent.id, agent.api_keys)
+    try:
+        return key, get_agent_api_key(agent.id, key.encrypted_api_key)
+    except Exception:
+        balancer.release(agent.id, key)
+        raise _Rejected(_error_response(
+            "invalid_request_error",
+            "Failed to decrypt agent API key. Contact the agent creator.",
+            500,
+        ))
+
+
+def _return_key(agent, key: PoolKey, resp: httpx.Response | None = None):
+    """Release a checked-out key, ejecting it for a while if upstream throttled or refused it."""
+    if resp is None:
+        get_key_balancer().release(agent.id, key)
+    else:
+        get_key_balancer().release(agent.id, key, resp.status_code, resp.headers.get("retry-after"))
+
+
+class _Lease:
+    """A request's gate slot and pooled key, released exactly once.
+
+    ``handed_off`` marks a lease whose release now belongs to a stream relay.
+    """
+
+    def __init__(self, gate, agent, key: PoolKey):
+        self.gate = gate
+        self.agent = agent
+        self.key = key
+        self.handed_off = False
+        self._released = False
+
+    def release(self, resp: httpx.Response | None = None):
+        if self._released:
+            return
+        self._released = True
+        if resp is None:
+            self.gate.release()
+        else:
+            self.gate.release(resp.status_code, resp.headers.get("retry-after"))
+        _return_key(self.agent, self.key, resp)
+
+
+def _forward_headers(request: Request, real_api_key: str, content_length: int | None = None) -> dict:
+    headers = {"x-api-key": real_api_key, "content-type": "application/json"}
+    if content_length is not None:
+        headers["content-length"] = str(content_length)
+    for header_name in PASS_THROUGH_HEADERS - {"content-type"}:
+        val = request.headers.get(header_name)
+        if val:
+            headers[header_name] = val
+    if "anthropic-version" not in headers:
+        headers["anthropic-version"] = "2023-06-01"
+    return headers
+
+
+def _quota_error_response(e: QuotaExceeded) -> Response:
+    if e.rate_limited:
+        response = _error_response("rate_limit_error", f"{e}. Please retry shortly.", 429)
+        if e.retry_after is not None:
+            response.headers["retry-after"] = str(max(1, math.ceil(e.retry_after)))
+        return response
+    return _error_response("authentication_error", str(e), 403)
+
+
+@router.post("/v1/messages")
+async def proxy_messages(request: Request):
+    timer = PhaseTimer()
+    try:
+        result = await _authorize(request, timer)
+    except _Rejected as e:
+        return e.response
+    license = result["license"]
+    agent = result["agent"]
+    plan = result["plan"]
+
+    settings = get_settings()
+
+    # 4. Spool the request body, scanning out only the top-level fields we need
+    try:
+        body = await read_request_body(
+            request, settings.proxy_max_body_bytes, settings.proxy_body_spool_bytes
+        )
+    except BodyTooLarge as e:
+        return _error_response("request_too_large", str(e), 413)
+    is_stream = body.fields.get("stream") is True
+    timer.mark("body")
+
+    # 4a. Serve identical deterministic requests from the agent's response cache
+    # (only these need the fully parsed body)
+    request_json = None
+    response_cache_key = None
+    if agent.proxy_response_cache and not is_stream and body.fields.get("temperature") == 0:
+        request_json = body.json()
+        response_cache_key = cache_key(agent.id, request_json, request.headers) if request_json else None
+        cached = get_cached_response(response_cache_key) if response_cache_key else None
+        timer.mark("cache")
+        if cached:
+            body.close()
+            # A hit costs no tokens but is still a request: it counts against
+            # the plan's rate limit and message budget
+            try:
+                hold = await acquire_quota(license, plan, result, 0)
+            except QuotaExceeded as e:
+                return _quota_error_response(e)
+            await _record_usage(
+                license, agent, cached.model, 0, 0, 0, 0, 0, True, None, hold=hold,
+                cache_hit=True, outcome="cache_hit", attempts=0, overhead_ms=int(timer.overhead_ms),
+            )
+            timer.mark("record")
+            get_proxy_metrics().observe(timer, cached.model, agent.id)
+            return Response(
+                content=cached.content,
+                status_code=200,
+                media_type=cached.media_type,
+                headers={"x-swarm-cache": "hit", **_timing_headers(timer)},
             )
 
+    # 4b. Enforce the plan's quotas and rate limit; reserve the estimated input
+    # plus max_tokens against the token budget
+    try:
+        hold = await acquire_quota(license, plan, result, _token_reservation(body, plan, request_json))
+    except QuotaExceeded as e:
+        body.close()
+        return _quota_error_response(e)
+    timer.mark("reserve")
+    relay = None
+    try:
+        # 5. Pick one of the agent's upstream keys and build headers for Anthropic
         try:
-            real_api_key = decrypt_api_key(agent.encrypted_api_key)
-        except Exception:
-            return _error_response(
-                "invalid_request_error",
-                "Failed to decrypt agent API key. Contact the agent creator.",
-                500,
+            key, real_api_key = _checkout_key(agent)
+        except _Rejected as e:
+            body.close()
+            await _record_usage(
+                license, agent, "unknown", 0, 0, 0, 0, 0, False, "Agent API key unavailable",
+                hold=hold, outcome="key_error", attempts=0,
             )
-
-        # 4. Read raw request body
-        body = await request.body()
-
-        # 5. Build headers for Anthropic
-        forward_headers = {"x-api-key": real_api_key, "content-type": "application/json"}
-        for header_name in PASS_THROUGH_HEADERS - {"content-type"}:
-            val = request.headers.get(header_name)
-            if val:
-                forward_headers[header_name] = val
-        if "anthropic-version" not in forward_headers:
-            forward_headers["anthropic-version"] = "2023-06-01"
+            return e.response
+        timer.mark("decrypt")
+        forward_headers = _forward_headers(request, real_api_key, body.size)
+        timer.mark("prepare")
 
         # 6. Forward to Anthropic
         start_time = time.time()
@@ -107,61 +291,827 @@ async def proxy_messages(request: Request):
         success = True
         error_message = None
 
+        # All buyers of an agent share its keys; queue behind this key's concurrency gate
+        gate = get_gate(f"{agent.id}/{key.label}")
         try:
-            async with httpx.AsyncClient(timeout=300.0) as client:
-                resp = await client.post(
-                    ANTHROPIC_API_URL,
-                    content=body,
-                    headers=forward_headers,
-                )
-        except httpx.TimeoutException:
+            await gate.acquire()
+        except GateRejected as e:
+            _return_key(agent, key)
             response_time_ms = int((time.time() - start_time) * 1000)
-            _log_usage(
-                session, license, agent, "unknown", 0, 0, 0, 0, response_time_ms, False, "Upstream timeout"
+            await _record_usage(
+                license, agent, "unknown", 0, 0, 0, 0, response_time_ms, False, str(e),
+                hold=hold, outcome="queue_rejected", attempts=0, api_key_id=key.id,
             )
-            return _error_response("api_error", "Request timed out", 504)
-        except Exception as e:
+            body.close()
+            return _error_response("rate_limit_error", f"{e}. Please retry shortly.", 429)
+        except BaseException:
+            # Cancelled while queued: the key was checked out but no slot taken
+            _return_key(agent, key)
+            body.close()
+            raise
+        timer.mark("gate_wait")
+        lease = _Lease(gate, agent, key)
+        try:
+            client = get_upstream_client()
+
+            # Always return at response headers so time-to-first-byte and body transfer
+            # are measured separately; non-streaming bodies are read below. Each attempt
+            # (retry or hedge) replays the spooled body from the start.
+            async def send() -> httpx.Response:
+                upstream_request = client.build_request(
+                    "POST", ANTHROPIC_MESSAGES_PATH, content=body.iter_chunks(), headers=forward_headers
+                )
+                return await client.send(upstream_request, stream=True)
+
+            latency_key = (agent.id, body.fields.get("model"))
+            hedge_after = None
+            latency = get_latency_window(latency_key, create=False)
+            if settings.upstream_hedge_enabled and not is_stream and latency:
+                hedge_after = latency.percentile(
+                    settings.upstream_hedge_percentile, settings.upstream_hedge_min_samples
+                )
+
+            try:
+                try:
+                    result = await call_upstream(
+                        send,
+                        get_breaker(),
+                        stream=is_stream,
+                        hedge_after=hedge_after,
+                        try_hedge_slot=gate.try_acquire,
+                        release_hedge_slot=gate.release,
+                    )
+                finally:
+                    # Every attempt has finished sending by the time call_upstream returns
+                    body.close()
+            except CircuitOpen as e:
+                lease.release()
+                response_time_ms = int((time.time() - start_time) * 1000)
+                await _record_usage(
+                    license, agent, "unknown", 0, 0, 0, 0, response_time_ms, False, str(e),
+                    hold=hold, outcome="circuit_open", attempts=0, api_key_id=key.id,
+                )
+                return _error_response("api_error", "Upstream API is unavailable. Please retry shortly.", 503)
+            except UpstreamFailed as e:
+                lease.release()
+                response_time_ms = int((time.time() - start_time) * 1000)
+                if isinstance(e.cause, httpx.TimeoutException):
+                    await _record_usage(
+                        license, agent, "unknown", 0, 0, 0, 0, response_time_ms, False, "Upstream timeout",
+                        hold=hold, outcome="timeout", attempts=e.attempts, api_key_id=key.id,
+                    )
+                    return _error_response("api_error", "Request timed out", 504)
+                await _record_usage(
+                    license, agent, "unknown", 0, 0, 0, 0, response_time_ms, False, str(e),
+                    hold=hold, outcome="transport_error", attempts=e.attempts, api_key_id=key.id,
+                )
+                return _error_response("api_error", "Failed to reach upstream API", 502)
+
+            resp = result.response
+            attempts = result.attempts
+            outcome = _outcome(resp.status_code, result)
+            timer.mark("upstream_ttfb")
+            if resp.status_code == 200 and not is_stream and attempts == 1:
+                get_latency_window(latency_key).add(timer.phases["upstream_ttfb"] / 1000)
+
+            if is_stream and resp.status_code == 200:
+                relay = _StreamRelay(resp, lease, license, agent, start_time, hold, attempts, timer)
+                lease.handed_off = True
+                return RelayResponse(
+                    relay.chunks(),
+                    on_close=relay.close,
+                    status_code=resp.status_code,
+                    media_type=resp.headers.get("content-type", "text/event-stream"),
+                    headers={"cache-control": "no-cache", "x-accel-buffering": "no", **_timing_headers(timer)},
+                )
+
+            # Non-streaming response, or upstream rejected a stream before it started
+            try:
+                await resp.aread()
+            except httpx.HTTPError as e:
+                lease.release()
+                response_time_ms = int((time.time() - start_time) * 1000)
+                timed_out = isinstance(e, httpx.TimeoutException)
+                await _record_usage(
+                    license, agent, "unknown", 0, 0, 0, 0, response_time_ms, False,
+                    "Upstream timeout" if timed_out else str(e),
+                    hold=hold, outcome="timeout" if timed_out else "transport_error",
+                    attempts=attempts, api_key_id=key.id,
+                )
+                if timed_out:
+                    return _error_response("api_error", "Request timed out", 504)
+                return _error_response("api_error", "Failed to reach upstream API", 502)
+            finally:
+                await resp.aclose()
+            timer.mark("transfer")
+
+            lease.release(resp)
             response_time_ms = int((time.time() - start_time) * 1000)
-            _log_usage(
-                session, license, agent, "unknown", 0, 0, 0, 0, response_time_ms, False, str(e)
+
+            # 7. Parse response for usage tracking
+            if resp.status_code == 200:
+                try:
+                    resp_json = resp.json()
+                    usage = resp_json.get("usage", {})
+                    input_tokens = usage.get("input_tokens", 0)
+                    output_tokens = usage.get("output_tokens", 0)
+                    total_tokens = input_tokens + output_tokens
+                    model_used = resp_json.get("model", "unknown")
+                except Exception:
+                    pass
+            else:
+                success = False
+                try:
+                    err_body = resp.json()
+                    error_message = err_body.get("error", {}).get("message", "Unknown error")
+                except Exception:
+                    error_message = f"HTTP {resp.status_code}"
+
+            # 8. Log usage and update license counters
+            cost_cents = _estimate_cost_cents(model_used, input_tokens, output_tokens)
+            await _record_usage(
+                license, agent, model_used, input_tokens, output_tokens,
+                total_tokens, cost_cents, response_time_ms, success, error_message,
+                hold=hold, outcome=outcome, attempts=attempts, api_key_id=key.id,
+                upstream_ttfb_ms=int(timer.phases["upstream_ttfb"]), overhead_ms=int(timer.overhead_ms),
             )
-            return _error_response("api_error", "Failed to reach upstream API", 502)
+            timer.mark("record")
+            get_proxy_metrics().observe(timer, model_used, agent.id)
 
-        response_time_ms = int((time.time() - start_time) * 1000)
+            if response_cache_key and resp.status_code == 200:
+                store_response(
+                    response_cache_key,
+                    resp.content,
+                    resp.headers.get("content-type", "application/json"),
+                    model_used,
+                )
 
-        # 7. Parse response for usage tracking
-        if resp.status_code == 200:
-            try:
-                resp_json = resp.json()
-                usage = resp_json.get("usage", {})
-                input_tokens = usage.get("input_tokens", 0)
-                output_tokens = usage.get("output_tokens", 0)
-                total_tokens = input_tokens + output_tokens
-                model_used = resp_json.get("model", "unknown")
-            except Exception:
-                pass
-        else:
-            success = False
+            # 9. Return Anthropic's raw response
+            return Response(
+                content=resp.content,
+                status_code=resp.status_code,
+                media_type=resp.headers.get("content-type", "application/json"),
+                headers=_timing_headers(timer),
+            )
+
+        finally:
+            # Any path that neither released the lease nor handed it to the stream
+            # relay (a cancelled request, an unexpected error) releases it here
+            if not lease.handed_off:
+                lease.release()
+    finally:
+        # A request that ended without logging usage (cancelled, or an
+        # unexpected error) gives its reservation back here
+        if relay is None:
+            with anyio.CancelScope(shield=True):
+                await release_quota(hold)
+
+
+def _token_reservation(body: RequestBody, plan, request_json: dict | None = None) -> int:
+    """Tokens to hold for a request: max_tokens plus the estimated input.
+
+    Input is only estimated when the plan limits tokens and the body is small
+    enough to parse cheaply; large (media-heavy) bodies reserve max_tokens.
+    """
+    max_tokens = body.fields.get("max_tokens")
+    reserve = max_tokens if isinstance(max_tokens, int) and max_tokens > 0 else 0
+    if not plan.max_tokens_per_period or body.size > get_settings().token_estimate_max_body_bytes:
+        return reserve
+    if request_json is None:
+        request_json = body.json()
+    return reserve + (estimate_input_tokens(request_json) if request_json else 0)
+
+
+# ── Token counting and Message Batches ──────────────────────────────
+#
+# Control-plane calls: they skip the per-key concurrency gate (they have
+# their own upstream limits) but share the retry policy and circuit breaker.
+
+
+@router.post("/v1/messages/count_tokens")
+async def proxy_count_tokens(request: Request):
+    """Exact input token count from upstream; free, so nothing is reserved or logged."""
+    try:
+        agent = (await _authorize(request))["agent"]
+    except _Rejected as e:
+        return e.response
+    settings = get_settings()
+    try:
+        body = await read_request_body(
+            request, settings.proxy_max_body_bytes, settings.proxy_body_spool_bytes
+        )
+    except BodyTooLarge as e:
+        return _error_response("request_too_large", str(e), 413)
+
+    key = resp = None
+    try:
+        key, real_api_key = _checkout_key(agent)
+        resp = await _call_upstream_api(
+            "POST", ANTHROPIC_COUNT_TOKENS_PATH,
+            _forward_headers(request, real_api_key, body.size),
+            body=body,
+        )
+        try:
+            await resp.aread()
+        finally:
+            await resp.aclose()
+    except _Rejected as e:
+        return e.response
+    except httpx.HTTPError:
+        return _error_response("api_error", "Failed to reach upstream API", 502)
+    finally:
+        body.close()
+        if key:
+            _return_key(agent, key, resp)
+    return Response(
+        content=resp.content,
+        status_code=resp.status_code,
+        media_type=resp.headers.get("content-type", "application/json"),
+    )
+
+
+@router.post("/v1/messages/batches")
+async def proxy_create_batch(request: Request):
+    try:
+        result = await _authorize(request)
+    except _Rejected as e:
+        return e.response
+    license = result["license"]
+    agent = result["agent"]
+    settings = get_settings()
+
+    try:
+        body = await read_request_body(
+            request, settings.proxy_max_batch_body_bytes, settings.proxy_body_spool_bytes
+        )
+    except BodyTooLarge as e:
+        return _error_response("request_too_large", str(e), 413)
+
+    try:
+        try:
+            # Parsing and estimating a large batch is CPU-bound; keep it off the event loop
+            request_count, reserve = await anyio.to_thread.run_sync(
+                lambda: summarize_batch_request(body.json())
+            )
+        except ValueError as e:
+            return _error_response("invalid_request_error", str(e), 400)
+
+        try:
+            reserved = await acquire_batch_quota(
+                license, result["plan"], result, request_count, reserve
+            )
+        except QuotaExceeded as e:
+            return _quota_error_response(e)
+
+        # The batch lives under the key it was created with; later calls reuse it
+        key = resp = None
+        try:
+            key, real_api_key = _checkout_key(agent)
+            resp = await _call_upstream_api(
+                "POST", ANTHROPIC_BATCHES_PATH,
+                _forward_headers(request, real_api_key, body.size),
+                body=body,
+            )
             try:
-                err_body = resp.json()
-                error_message = err_body.get("error", {}).get("message", "Unknown error")
-            except Exception:
-                error_message = f"HTTP {resp.status_code}"
-
-        # 8. Log usage and update license counters
-        cost_cents = _estimate_cost_cents(model_used, input_tokens, output_tokens)
-        _log_usage(
-            session, license, agent, model_used, input_tokens, output_tokens,
-            total_tokens, cost_cents, response_time_ms, success, error_message,
+                await resp.aread()
+            finally:
+                await resp.aclose()
+            upstream_batch = resp.json() if resp.status_code == 200 else None
+        except (_Rejected, httpx.HTTPError, ValueError) as e:
+            await run_in_db_thread(_release_batch_reservation, license.id, reserved)
+            if isinstance(e, _Rejected):
+                return e.response
+            return _error_response("api_error", "Failed to reach upstream API", 502)
+        finally:
+            if key:
+                _return_key(agent, key, resp)
+    finally:
+        body.close()
+
+    if upstream_batch is None:
+        await run_in_db_thread(_release_batch_reservation, license.id, reserved)
+    else:
+        await run_in_db_thread(
+            _create_batch, license, agent, key, upstream_batch, request_count, reserved
+        )
+    return Response(
+        content=resp.content,
+        status_code=resp.status_code,
+        media_type=resp.headers.get("content-type", "application/json"),
+    )
+
+
+@router.get("/v1/messages/batches/{batch_id}")
+async def proxy_get_batch(batch_id: str, request: Request):
+    try:
+        result = await _authorize(request)
+        agent = result["agent"]
+        batch = await _licensed_batch(batch_id, result["license"])
+        key, real_api_key = _checkout_key(agent, batch.api_key_id, pinned=True)
+    except _Rejected as e:
+        return e.response
+    resp = None
+    try:
+        resp = await _call_upstream_api(
+            "GET", f"{ANTHROPIC_BATCHES_PATH}/{batch_id}", _forward_headers(request, real_api_key)
+        )
+        try:
+            await resp.aread()
+        finally:
+            await resp.aclose()
+    except _Rejected as e:
+        return e.response
+    except httpx.HTTPError:
+        return _error_response("api_error", "Failed to reach upstream API", 502)
+    finally:
+        _return_key(agent, key, resp)
+
+    if resp.status_code == 200:
+        try:
+            status = resp.json().get("processing_status")
+        except ValueError:
+            status = None
+        if status:
+            await run_in_db_thread(_set_batch_status, batch_id, status)
+        if status == "ended" and batch.reconciled_at is None:
+            # Reconciled server-side, so the reservation does not wait for the
+            # buyer to download the results
+            background = BackgroundTask(_reconcile_in_background, batch, agent)
+            return Response(
+                content=resp.content,
+                status_code=resp.status_code,
+                media_type=resp.headers.get("content-type", "application/json"),
+                background=background,
+            )
+    return Response(
+        content=resp.content,
+        status_code=resp.status_code,
+        media_type=resp.headers.get("content-type", "application/json"),
+    )
+
+
+@router.get("/v1/messages/batches/{batch_id}/results")
+async def proxy_batch_results(batch_id: str, request: Request):
+    """Stream the batch's JSONL results; a complete read reconciles its usage if still pending."""
+    try:
+        result = await _authorize(request)
+        agent = result["agent"]
+        batch = await _licensed_batch(batch_id, result["license"])
+        key, real_api_key = _checkout_key(agent, batch.api_key_id, pinned=True)
+    except _Rejected as e:
+        return e.response
+    resp = None
+    try:
+        resp = await _call_upstream_api(
+            "GET", f"{ANTHROPIC_BATCHES_PATH}/{batch_id}/results",
+            _forward_headers(request, real_api_key),
         )
+    except _Rejected as e:
+        return e.response
+    finally:
+        # The key is only held until upstream answers, not for the whole relay
+        _return_key(agent, key, resp)
 
-        # 9. Return Anthropic's raw response
+    if resp.status_code != 200:
+        try:
+            await resp.aread()
+        except httpx.HTTPError:
+            return _error_response("api_error", "Failed to reach upstream API", 502)
+        finally:
+            await resp.aclose()
         return Response(
             content=resp.content,
             status_code=resp.status_code,
             media_type=resp.headers.get("content-type", "application/json"),
         )
 
+    return RelayResponse(
+        _relay_batch_results(resp, batch),
+        on_close=resp.aclose,
+        media_type=resp.headers.get("content-type", "application/binary"),
+    )
+
+
+async def _call_upstream_api(method: str, path: str, headers: dict, body=None) -> httpx.Response:
+    """Send one control-plane call with retries; the caller reads and closes the response."""
+    client = get_upstream_client()
+
+    async def send() -> httpx.Response:
+        upstream_request = client.build_request(
+            method, path, content=body.iter_chunks() if body else None, headers=headers
+        )
+        return await client.send(upstream_request, stream=True)
+
+    try:
+        return (await call_upstream(send, get_breaker(), stream=False)).response
+    except CircuitOpen:
+        raise _Rejected(_error_response(
+            "api_error", "Upstream API is unavailable. Please retry shortly.", 503
+        ))
+    except UpstreamFailed as e:
+        if isinstance(e.cause, httpx.TimeoutException):
+            raise _Rejected(_error_response("api_error", "Request timed out", 504))
+        raise _Rejected(_error_response("api_error", "Failed to reach upstream API", 502))
+
+
+async def _licensed_batch(batch_id: str, license) -> ProxyBatch:
+    batch = await run_in_db_thread(_get_batch, batch_id)
+    if batch is None or batch.license_id != license.id:
+        raise _Rejected(_error_response("not_found_error", "Batch not found", 404))
+    return batch
+
+
+async def _relay_batch_results(resp: httpx.Response, batch: ProxyBatch):
+    """Relay result lines as they arrive; reconcile usage if the whole stream was read."""
+    tracker = BatchResultsTracker() if batch.reconciled_at is None else None
+    complete = False
+    try:
+        async for chunk in resp.aiter_bytes():
+            if tracker:
+                tracker.feed(chunk)
+            yield chunk
+        complete = True
+    except httpx.HTTPError as e:
+        logger.warning("Batch %s results stream interrupted: %s", batch.id, e.__class__.__name__)
+    finally:
+        # Shielded so a results stream read to the end is reconciled even if the
+        # client disconnects right after the last chunk
+        with anyio.CancelScope(shield=True):
+            await resp.aclose()
+            if tracker and complete:
+                tracker.finish()
+                rows = [_batch_usage_row(batch, r) for r in tracker.results]
+                await run_in_db_thread(_reconcile_batch, batch.id, rows)
+
+
+async def _reconcile_from_upstream(batch: ProxyBatch, agent) -> bool:
+    """Read an ended batch's results from upstream and reconcile them.
+
+    Returns False if upstream did not serve the whole results stream.
+    """
+    key, real_api_key = _checkout_key(agent, batch.api_key_id, pinned=True)
+    resp = None
+    try:
+        resp = await _call_upstream_api(
+            "GET", f"{ANTHROPIC_BATCHES_PATH}/{batch.id}/results",
+            {"x-api-key": real_api_key, "anthropic-version": "2023-06-01"},
+        )
+        try:
+            if resp.status_code != 200:
+                return False
+            tracker = BatchResultsTracker()
+            async for chunk in resp.aiter_bytes():
+                tracker.feed(chunk)
+            tracker.finish()
+        finally:
+            await resp.aclose()
+    finally:
+        _return_key(agent, key, resp)
+    rows = [_batch_usage_row(batch, r) for r in tracker.results]
+    await run_in_db_thread(_reconcile_batch, batch.id, rows)
+    return True
+
+
+# Batches being reconciled by this process, so repeated status calls fetch once
+_reconciling: set[str] = set()
+
+
+async def _reconcile_in_background(batch: ProxyBatch, agent):
+    if batch.id in _reconciling:
+        return
+    _reconciling.add(batch.id)
+    try:
+        if not await _reconcile_from_upstream(batch, agent):
+            logger.warning("Batch %s results were not available for reconciliation", batch.id)
+    except (_Rejected, httpx.HTTPError) as e:
+        logger.warning("Reconciling batch %s failed: %s", batch.id, e.__class__.__name__)
+    except Exception:
+        logger.exception("Reconciling batch %s failed", batch.id)
+    finally:
+        _reconciling.discard(batch.id)
+
+
+async def _poll_batch(batch: ProxyBatch):
+    """Refresh one unreconciled batch's status and reconcile it if it has ended."""
+    agent = await run_in_db_thread(_get_agent, batch.agent_profile_id)
+    if agent is None:
+        return
+    key, real_api_key = _checkout_key(agent, batch.api_key_id, pinned=True)
+    resp = None
+    try:
+        resp = await _call_upstream_api(
+            "GET", f"{ANTHROPIC_BATCHES_PATH}/{batch.id}",
+            {"x-api-key": real_api_key, "anthropic-version": "2023-06-01"},
+        )
+        try:
+            await resp.aread()
+        finally:
+            await resp.aclose()
+    finally:
+        _return_key(agent, key, resp)
+    if resp.status_code != 200:
+        return
+    status = resp.json().get("processing_status")
+    if status:
+        await run_in_db_thread(_set_batch_status, batch.id, status)
+    if status == "ended":
+        await _reconcile_in_background(batch, agent)
+
+
+async def poll_pending_batches() -> int:
+    """Poll every unreconciled batch upstream once. Returns the number polled."""
+    batches = await run_in_db_thread(_pending_batches)
+    for batch in batches:
+        try:
+            await _poll_batch(batch)
+        except (_Rejected, httpx.HTTPError, ValueError) as e:
+            logger.warning("Polling batch %s failed: %s", batch.id, e.__class__.__name__)
+    return len(batches)
+
+
+_poll_task: asyncio.Task | None = None
+
+
+async def _run_batch_poll(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await poll_pending_batches()
+        except Exception:
+            logger.exception("Polling unreconciled batches failed")
+
+
+def start_batch_poll():
+    global _poll_task
+    interval = get_settings().batch_poll_interval_seconds
+    if _poll_task is None and interval > 0:
+        _poll_task = asyncio.get_running_loop().create_task(_run_batch_poll(interval))
+
+
+async def stop_batch_poll():
+    global _poll_task
+    if _poll_task is None:
+        return
+    _poll_task.cancel()
+    try:
+        await _poll_task
+    except asyncio.CancelledError:
+        pass
+    _poll_task = None
+
+
+def _batch_usage_row(batch: ProxyBatch, result: dict) -> dict:
+    input_tokens, output_tokens = result["input_tokens"], result["output_tokens"]
+    cost_cents = round(
+        _estimate_cost_cents(result["model"], input_tokens, output_tokens) * BATCH_PRICE_FACTOR
+    )
+    return dict(
+        id=uuid.uuid4(),
+        license_id=batch.license_id,
+        agent_profile_id=batch.agent_profile_id,
+        buyer_id=batch.buyer_id,
+        api_key_id=batch.api_key_id,
+        created_at=datetime.now(UTC).replace(tzinfo=None),
+        model=result["model"],
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        total_tokens=input_tokens + output_tokens,
+        estimated_cost_cents=cost_cents,
+        response_time_ms=0,
+        reserved_tokens=0,
+        cache_hit=False,
+        outcome="batch" if result["success"] else "batch_error",
+        attempts=1,
+        upstream_ttfb_ms=0,
+        overhead_ms=0,
+        success=result["success"],
+        error_message=result["error_message"],
+    )
+
+
+def _get_batch(batch_id: str) -> ProxyBatch | None:
+    with Session(get_engine()) as session:
+        return session.get(ProxyBatch, batch_id)
+
+
+def _pending_batches() -> list[ProxyBatch]:
+    with Session(get_engine()) as session:
+        return list(session.exec(
+            select(ProxyBatch)
+            .where(ProxyBatch.reconciled_at.is_(None))
+            .order_by(ProxyBatch.created_at)
+        ).all())
+
+
+def _get_agent(agent_id):
+    with Session(get_engine()) as session:
+        return load_agent_snapshot(session, agent_id)
+
+
+def _create_batch(license, agent, key: PoolKey, upstream_batch: dict, request_count: int, reserved: int):
+    with Session(get_engine()) as session:
+        session.add(ProxyBatch(
+            id=upstream_batch["id"],
+            license_id=license.id,
+            agent_profile_id=agent.id,
+            buyer_id=license.buyer_id,
+            api_key_id=key.id,
+            request_count=request_count,
+            reserved_tokens=reserved,
+            processing_status=upstream_batch.get("processing_status") or "in_progress",
+        ))
+        session.commit()
+
+
+def _set_batch_status(batch_id: str, status: str):
+    with Session(get_engine()) as session:
+        session.execute(
+            update(ProxyBatch)
+            .where(ProxyBatch.id == batch_id, ProxyBatch.processing_status != status)
+            .values(processing_status=status, updated_at=datetime.now(UTC).replace(tzinfo=None))
+        )
+        session.commit()
+
+
+def _release_batch_reservation(license_id, reserved: int):
+    if not reserved:
+        return
+    with Session(get_engine()) as session:
+        increment_usage_counters(session, license_id, 0, 0, 0, released_tokens=reserved)
+        session.commit()
+
+
+def _reconcile_batch(batch_id: str, rows: list[dict]):
+    with Session(get_engine()) as session:
+        reconcile_batch(session, batch_id, rows)
+
+
+@router.get("/gates", dependencies=[Depends(require_admin)])
+def upstream_gates():
+    """Queue depth, in-flight count, adaptive limit and wait times per upstream key."""
+    return gate_snapshots()
+
+
+@router.get("/circuit", dependencies=[Depends(require_admin)])
+def upstream_circuit():
+    """State of the upstream circuit breaker."""
+    return get_breaker().snapshot()
+
+
+@router.get("/metrics", dependencies=[Depends(require_admin)])
+def proxy_metrics():
+    """Per-phase latency percentiles (overall, per model, per agent) plus gate, key and breaker state."""
+    return {
+        **get_proxy_metrics().snapshot(),
+        "gates": gate_snapshots(),
+        "keys": get_key_balancer().snapshot(),
+        "circuit": get_breaker().snapshot(),
+    }
+
+
+def _timing_headers(timer: PhaseTimer) -> dict:
+    if not get_settings().proxy_server_timing:
+        return {}
+    return {"server-timing": timer.server_timing()}
+
+
+def _outcome(status_code: int, result: UpstreamResult) -> str:
+    if status_code == 529:
+        return "overloaded"
+    if status_code != 200:
+        return "upstream_error"
+    if result.hedged:
+        return "hedged"
+    return "retried" if result.retries else "ok"
+
+
+def _validate(license_key: str) -> dict:
+    with Session(get_engine()) as session:
+        return validate_license(session, license_key)
+
+
+async def _record_usage(
+    license,
+    agent,
+    model: str,
+    input_tokens: int,
+    output_tokens: int,
+    total_tokens: int,
+    cost_cents: int,
+    response_time_ms: int,
+    success: bool,
+    error_message: str | None,
+    hold: QuotaHold | None = None,
+    cache_hit: bool = False,
+    outcome: str = "ok",
+    attempts: int = 1,
+    upstream_ttfb_ms: int = 0,
+    overhead_ms: int = 0,
+    api_key_id=None,
+):
+    # Shielded: once a hold is settled here its usage must be written, or the
+    # reservation would never be released
+    with anyio.CancelScope(shield=True):
+        await settle_quota(hold, 1 if success else 0, total_tokens if success else 0)
+        # Only database-side reservations are released by the usage log write
+        reserved_tokens = hold.db_reserved_tokens if hold else 0
+        if get_settings().usage_write_behind:
+            get_usage_sink().submit(usage_row(
+                license, agent,
+                model=model,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+                total_tokens=total_tokens,
+                estimated_cost_cents=cost_cents,
+                response_time_ms=response_time_ms,
+                reserved_tokens=reserved_tokens,
+                cache_hit=cache_hit,
+                outcome=outcome,
+                attempts=attempts,
+                upstream_ttfb_ms=upstream_ttfb_ms,
+                overhead_ms=overhead_ms,
+                api_key_id=api_key_id,
+                success=success,
+                error_message=error_message,
+            ))
+            return
+        await run_in_db_thread(
+            _log_usage_inline, license, agent, model, input_tokens, output_tokens,
+            total_tokens, cost_cents, response_time_ms, success, error_message,
+            reserved_tokens, cache_hit, outcome, attempts, upstream_ttfb_ms, overhead_ms, api_key_id,
+        )
+
+
+def _log_usage_inline(license, agent, *args):
+    with Session(get_engine()) as session:
+        _log_usage(session, license, agent, *args)
+
+
+class _StreamRelay:
+    """Relays one upstream SSE stream; ``close`` settles it exactly once."""
+
+    def __init__(
+        self, resp: httpx.Response, lease: _Lease, license, agent, start_time: float,
+        hold: QuotaHold | None, attempts: int = 1, timer: PhaseTimer | None = None,
+    ):
+        self.resp = resp
+        self.lease = lease
+        self.license = license
+        self.agent = agent
+        self.start_time = start_time
+        self.hold = hold
+        self.attempts = attempts
+        self.timer = timer
+        self.tracker = SSEUsageTracker()
+        self.error_message: str | None = None
+        self.outcome = "retried" if attempts > 1 else "ok"
+        self.started = False
+        self._closed = False
+
+    async def chunks(self):
+        """Relay upstream SSE chunks as they arrive."""
+        self.started = True
+        try:
+            async for chunk in self.resp.aiter_bytes():
+                self.tracker.feed(chunk)
+                yield chunk
+        except httpx.HTTPError as e:
+            self.error_message = f"Upstream stream interrupted: {e.__class__.__name__}"
+            self.outcome = "stream_interrupted"
+            err = {"type": "error", "error": {"type": "api_error", "message": self.error_message}}
+            yield f"event: error\ndata: {json.dumps(err)}\n\n".encode()
+
+    async def close(self):
+        """Close the upstream stream, release the lease, and log usage."""
+        if self._closed:
+            return
+        self._closed = True
+        resp, timer, tracker = self.resp, self.timer, self.tracker
+        await resp.aclose()
+        if timer:
+            timer.mark("transfer")
+        self.lease.release(resp)
+        response_time_ms = int((time.time() - self.start_time) * 1000)
+        error_message, outcome = self.error_message, self.outcome
+        if not self.started:
+            error_message = "Client disconnected before the stream started"
+            outcome = "client_disconnected"
+        elif error_message is None and tracker.error_message:
+            error_message = tracker.error_message
+            outcome = "upstream_error"
+        cost_cents = _estimate_cost_cents(tracker.model, tracker.input_tokens, tracker.output_tokens)
+        await _record_usage(
+            self.license, self.agent, tracker.model, tracker.input_tokens,
+            tracker.output_tokens, tracker.total_tokens, cost_cents,
+            response_time_ms, error_message is None, error_message,
+            hold=self.hold, outcome=outcome, attempts=self.attempts, api_key_id=self.lease.key.id,
+            upstream_ttfb_ms=int(timer.phases.get("upstream_ttfb", 0)) if timer else 0,
+            overhead_ms=int(timer.overhead_ms) if timer else 0,
+        )
+        if timer:
+            timer.mark("record")
+            get_proxy_metrics().observe(timer, tracker.model, self.agent.id)
+
 
 def _log_usage(
     session: Session,
@@ -175,9 +1125,14 @@ def _log_usage(
     response_time_ms: int,
     success: bool,
     error_message: str | None,
+    reserved_tokens: int = 0,
+    cache_hit: bool = False,
+    outcome: str = "ok",
+    attempts: int = 1,
+    upstream_ttfb_ms: int = 0,
+    overhead_ms: int = 0,
+    api_key_id=None,
 ):
-    now = datetime.now(UTC).replace(tzinfo=None)
-
     log = ProxyUsageLog(
         license_id=license.id,
         agent_profile_id=agent.id,
@@ -188,19 +1143,25 @@ def _log_usage(
         total_tokens=total_tokens,
         estimated_cost_cents=cost_cents,
         response_time_ms=response_time_ms,
+        reserved_tokens=reserved_tokens,
+        cache_hit=cache_hit,
+        outcome=outcome,
+        attempts=attempts,
+        upstream_ttfb_ms=upstream_ttfb_ms,
+        overhead_ms=overhead_ms,
+        api_key_id=api_key_id,
         success=success,
         error_message=error_message,
     )
     session.add(log)
+    apply_usage_rollups(session, [log.model_dump()])
 
-    # Update license counters
+    # Update license counters and release the request's token reservation
     if success:
-        license.total_messages += 1
-        license.total_tokens_used += total_tokens
-        license.total_cost_cents += cost_cents
-        license.period_messages += 1
-        license.period_tokens += total_tokens
-        license.updated_at = now
-        session.add(license)
+        increment_usage_counters(
+            session, license.id, 1, total_tokens, cost_cents, released_tokens=reserved_tokens
+        )
+    elif reserved_tokens:
+        increment_usage_counters(session, license.id, 0, 0, 0, released_tokens=reserved_tokens)
 
     session.commit()
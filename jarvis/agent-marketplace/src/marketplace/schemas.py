@@ -81,6 +81,7 @@ class AgentUpdateRequest(BaseModel):
     openclaw_repo_url: str | None = None
     openclaw_install_instructions: str | None = None
     openclaw_version: str | None = None
+    proxy_response_cache: bool | None = None
 
 
 class AgentResponse(BaseModel):
@@ -125,6 +126,7 @@ class AgentResponse(BaseModel):
     openclaw_repo_url: str | None = None
     openclaw_install_instructions: str | None = None
     openclaw_version: str | None = None
+    proxy_response_cache: bool = False
 
     # Joined fields (for browse)
     owner_display_name: str | None = None
@@ -348,6 +350,31 @@ class AgentApiKeyRequest(BaseModel):
     api_key: str
 
 
+class AgentPoolKeyRequest(BaseModel):
+    api_key: str
+    label: str | None = Field(default=None, max_length=100)
+    weight: int = Field(default=1, ge=1, le=100)
+
+
+class AgentPoolKeyUpdateRequest(BaseModel):
+    label: str | None = Field(default=None, max_length=100)
+    weight: int | None = Field(default=None, ge=1, le=100)
+    is_active: bool | None = None
+
+
+class AgentPoolKeyResponse(BaseModel):
+    id: uuid.UUID
+    label: str | None
+    api_key_preview: str
+    weight: int
+    is_active: bool
+    created_at: str
+    in_flight: int = 0
+    ejected_for_ms: int = 0
+    total_calls: int = 0
+    last_status: int | None = None
+
+
 class AgentPricingRequest(BaseModel):
     price_per_conversation_cents: int | None = None
     price_per_message_cents: int | None = None
@@ -403,6 +430,7 @@ class PricingPlanCreateRequest(BaseModel):
     rental_duration_days: int | None = None
     max_messages_per_period: int | None = None
     max_tokens_per_period: int | None = None
+    max_requests_per_minute: int | None = Field(default=None, ge=1)
 
 
 class PricingPlanResponse(BaseModel):
@@ -419,6 +447,7 @@ class PricingPlanResponse(BaseModel):
     rental_duration_days: int | None
     max_messages_per_period: int | None
     max_tokens_per_period: int | None
+    max_requests_per_minute: int | None = None
     is_active: bool
     created_at: datetime
 
@@ -476,11 +505,38 @@ class UsageLogResponse(BaseModel):
     total_tokens: int
     estimated_cost_cents: int
     response_time_ms: int
+    cache_hit: bool = False
+    outcome: str = "ok"
+    attempts: int = 1
+    upstream_ttfb_ms: int = 0
+    overhead_ms: int = 0
+    api_key_id: uuid.UUID | None = None
     success: bool
     error_message: str | None
     created_at: datetime
 
 
+class UsageSeriesPoint(BaseModel):
+    bucket_start: datetime
+    requests: int
+    input_tokens: int
+    output_tokens: int
+    cost_cents: int
+    error_count: int
+    avg_latency_ms: int
+    p50_latency_ms: int
+    p95_latency_ms: int
+
+
+class UsageSeriesResponse(BaseModel):
+    scope: str  # license, agent
+    scope_id: uuid.UUID
+    granularity: str  # hour, day
+    start: datetime
+    end: datetime
+    points: list[UsageSeriesPoint] = []
+
+
 class UsageStatsResponse(BaseModel):
     license: LicenseResponse
     recent_usage: list[UsageLogResponse] = []
@@ -0,0 +1,61 @@
+import json
+
+
+class SSEUsageTracker:
+    """Incrementally scans an Anthropic Messages SSE stream for usage data.
+
+    Chunks are fed as they are relayed to the client; only the trailing
+    partial line is buffered, and only ``message_start``, ``message_delta``
+    and ``error`` events are JSON-decoded.
+    """
+
+    TRACKED_EVENTS = {"message_start", "message_delta", "error"}
+
+    def __init__(self):
+        self.model = "unknown"
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.error_message: str | None = None
+        self._event: str | None = None
+        self._partial = b""
+
+    @property
+    def total_tokens(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+    def feed(self, chunk: bytes):
+        data = self._partial + chunk
+        lines = data.split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self._handle_line(line.rstrip(b"\r"))
+
+    def _handle_line(self, line: bytes):
+        if not line:
+            self._event = None
+        elif line.startswith(b"event:"):
+            self._event = line[6:].strip().decode("utf-8", "replace")
+        elif line.startswith(b"data:") and self._event in self.TRACKED_EVENTS:
+            try:
+                payload = json.loads(line[5:])
+            except ValueError:
+                return
+            self._handle_event(payload)
+
+    def _handle_event(self, payload: dict):
+        event_type = payload.get("type")
+        if event_type == "message_start":
+            message = payload.get("message", {})
+            self.model = message.get("model") or self.model
+            usage = message.get("usage", {})
+            self.input_tokens = usage.get("input_tokens") or 0
+            self.output_tokens = usage.get("output_tokens") or 0
+        elif event_type == "message_delta":
+            # message_delta usage is cumulative for the whole message
+            usage = payload.get("usage", {})
+            if usage.get("input_tokens"):
+                self.input_tokens = usage["input_tokens"]
+            if usage.get("output_tokens") is not None:
+                self.output_tokens = usage["output_tokens"]
+        elif event_type == "error":
+            self.error_message = payload.get("error", {}).get("message", "Stream error")
@@ -0,0 +1,28 @@
+"""Streaming responses whose cleanup runs even if the client leaves early."""
+
+import anyio
+from fastapi.responses import StreamingResponse
+
+
+class RelayResponse(StreamingResponse):
+    """A StreamingResponse that always runs ``on_close`` once the response is over.
+
+    When the client has already gone, Starlette cancels the body before the
+    iterator's first step, so a generator's ``finally`` would never run.
+    Anything that must happen for every relayed response (closing the upstream
+    response, releasing what the request holds, logging usage) goes in
+    ``on_close`` instead.
+    """
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self._on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Shielded so cleanup still runs when the request task is cancelled
+            with anyio.CancelScope(shield=True):
+                await self.body_iterator.aclose()
+                await self._on_close()
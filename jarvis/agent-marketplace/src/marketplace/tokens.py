@@ -0,0 +1,117 @@
+"""Fast local token estimates for Messages requests.
+
+Used for pre-flight decisions (quota reservations) where an exact count from
+``/v1/messages/count_tokens`` would cost an upstream round trip. Text is
+estimated from its word, digit-run and punctuation counts, leaning high
+rather than low. Images and PDFs are charged fixed upper-bound amounts since
+their real cost depends on dimensions and page counts we do not decode.
+
+System prompts and tool definitions are usually identical across a buyer's
+requests, so their estimates are cached by content hash.
+"""
+
+import hashlib
+import json
+import re
+
+from .cache import TTLCache
+from .config import get_settings
+
+# Words, runs of digits and individual punctuation marks each start a token;
+# long words split into several
+_PIECE = re.compile(r"[A-Za-z]+|\d{1,3}|[^\sA-Za-z\d]")
+_CHARS_PER_LONG_WORD_TOKEN = 6
+
+# Anthropic resizes images to at most ~1.15 megapixels, about 1,600 tokens
+IMAGE_TOKENS = 1_600
+# Rough upper bound for a PDF page (text plus page image)
+PDF_TOKENS_PER_PAGE = 3_000
+_PDF_BYTES_PER_PAGE = 50_000
+# Role markers and other per-message framing
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_prefix_cache: TTLCache | None = None
+
+
+def _get_prefix_cache() -> TTLCache:
+    global _prefix_cache
+    if _prefix_cache is None:
+        settings = get_settings()
+        _prefix_cache = TTLCache(
+            maxsize=settings.token_count_cache_size, ttl=settings.token_count_cache_ttl_seconds
+        )
+    return _prefix_cache
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimated token count of a piece of text."""
+    if not text:
+        return 0
+    tokens = 0
+    for piece in _PIECE.findall(text):
+        tokens += 1 + (len(piece) - 1) // _CHARS_PER_LONG_WORD_TOKEN if len(piece) > 1 else 1
+    return tokens
+
+
+def _estimate_content(content) -> int:
+    if isinstance(content, str):
+        return estimate_tokens(content)
+    if not isinstance(content, list):
+        return 0
+    tokens = 0
+    for block in content:
+        if not isinstance(block, dict):
+            continue
+        block_type = block.get("type")
+        if block_type == "text":
+            tokens += estimate_tokens(block.get("text") or "")
+        elif block_type == "image":
+            tokens += IMAGE_TOKENS
+        elif block_type == "document":
+            source = block.get("source") or {}
+            if source.get("type") == "text":
+                tokens += estimate_tokens(source.get("data") or "")
+            elif source.get("type") == "content":
+                tokens += _estimate_content(source.get("content"))
+            else:
+                # base64 PDF: decoded size is 3/4 of the encoded length
+                pages = max(1, len(source.get("data") or "") * 3 // 4 // _PDF_BYTES_PER_PAGE)
+                tokens += pages * PDF_TOKENS_PER_PAGE
+        elif block_type == "tool_result":
+            tokens += _estimate_content(block.get("content"))
+        elif block_type in ("tool_use", "server_tool_use"):
+            tokens += estimate_tokens(block.get("name") or "")
+            tokens += estimate_tokens(json.dumps(block.get("input") or {}))
+        elif block_type in ("thinking", "redacted_thinking"):
+            tokens += estimate_tokens(block.get("thinking") or block.get("data") or "")
+    return tokens
+
+
+def _cached_estimate(kind: str, value, estimate) -> int:
+    raw = value if isinstance(value, str) else json.dumps(value, sort_keys=True)
+    key = (kind, hashlib.blake2b(raw.encode(), digest_size=16).digest())
+    prefix_cache = _get_prefix_cache()
+    tokens = prefix_cache.get(key)
+    if tokens is None:
+        tokens = estimate(value)
+        prefix_cache.set(key, tokens)
+    return tokens
+
+
+def estimate_system_tokens(system) -> int:
+    """Estimated tokens of a ``system`` prompt (string or text blocks), cached by content."""
+    if not system:
+        return 0
+    return _cached_estimate("system", system, _estimate_content)
+
+
+def estimate_input_tokens(payload: dict) -> int:
+    """Estimated input tokens of a Messages request body (system, messages and tools)."""
+    tokens = estimate_system_tokens(payload.get("system"))
+    for message in payload.get("messages") or []:
+        if isinstance(message, dict):
+            tokens += MESSAGE_OVERHEAD_TOKENS + _estimate_content(message.get("content"))
+    tools = payload.get("tools")
+    if tools:
+        tokens += _cached_estimate("tools", tools, lambda t: estimate_tokens(json.dumps(t)))
+    return tokens
@@ -0,0 +1,45 @@
+import httpx
+
+from .config import get_settings
+
+_client: httpx.AsyncClient | None = None
+
+
+def get_upstream_client() -> httpx.AsyncClient:
+    """Process-wide pooled client for the upstream Anthropic API.
+
+    Connections are kept alive (and multiplexed over HTTP/2) across proxied
+    requests, so each call skips the TCP+TLS handshake.
+    """
+    global _client
+    if _client is None:
+        settings = get_settings()
+        _client = httpx.AsyncClient(
+            base_url=settings.anthropic_api_url,
+            http2=settings.upstream_http2,
+            limits=httpx.Limits(
+                max_connections=settings.upstream_max_connections,
+                max_keepalive_connections=settings.upstream_max_keepalive_connections,
+                keepalive_expiry=settings.upstream_keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(
+                connect=settings.upstream_connect_timeout,
+                read=settings.upstream_read_timeout,
+                write=settings.upstream_write_timeout,
+                pool=settings.upstream_pool_timeout,
+            ),
+        )
+    return _client
+
+
+def set_upstream_client(client: httpx.AsyncClient | None):
+    """Override upstream client (for testing)."""
+    global _client
+    _client = client
+
+
+async def close_upstream_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,199 @@
+import asyncio
+import time
+from collections import deque
+
+from .config import get_settings
+
+# Upstream statuses that mean "this key is sending too much"
+THROTTLE_STATUSES = {429, 529}
+
+
+class GateRejected(Exception):
+    """The request could not get an upstream slot (queue full or wait timed out)."""
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+class UpstreamGate:
+    """Adaptive concurrency gate in front of one upstream API key.
+
+    At most ``limit`` requests are in flight; others wait in a bounded FIFO
+    queue for up to ``queue_timeout`` seconds. The limit follows AIMD: it is
+    halved whenever the upstream answers 429/529 (and the gate pauses for any
+    ``retry-after``), and grows back by roughly one slot per ``limit``
+    successful calls, up to ``max_in_flight``.
+    """
+
+    def __init__(self, max_in_flight: int, max_queue: int, queue_timeout: float, min_in_flight: int = 1):
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min(min_in_flight, max_in_flight)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.limit = float(max_in_flight)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._waiters: deque[asyncio.Future] = deque()
+        self._wake_handle: asyncio.TimerHandle | None = None
+        self.last_used = time.monotonic()
+        # Observability
+        self.total_admitted = 0
+        self.total_queued = 0
+        self.total_waited = 0
+        self.total_rejected = 0
+        self.total_throttled = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    @property
+    def idle(self) -> bool:
+        """Nothing in flight, queued or paused: dropping the gate loses only its adapted limit."""
+        return not self.in_flight and not self._waiters and time.monotonic() >= self.paused_until
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < int(self.limit) and time.monotonic() >= self.paused_until
+
+    async def acquire(self) -> float:
+        """Wait for a slot; returns the time spent queued in milliseconds."""
+        self.last_used = time.monotonic()
+        if not self._waiters and self._has_capacity():
+            self.in_flight += 1
+            self.total_admitted += 1
+            return 0.0
+        if len(self._waiters) >= self.max_queue:
+            self.total_rejected += 1
+            raise GateRejected("Upstream queue for this agent is full")
+
+        started = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.total_queued += 1
+        self._wake()
+        try:
+            await asyncio.wait_for(waiter, timeout=self.queue_timeout)
+        except TimeoutError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter.done() and not waiter.cancelled():
+                # Granted a slot just as the wait timed out; hand it back
+                self.release()
+            self.total_rejected += 1
+            raise GateRejected("Timed out waiting for an upstream slot for this agent")
+        except BaseException:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+        wait_ms = (time.monotonic() - started) * 1000
+        self.total_admitted += 1
+        self.total_waited += 1
+        self.total_wait_ms += wait_ms
+        self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+        return wait_ms
+
+    def try_acquire(self) -> bool:
+        """Take a slot only if one is free right now (never queues)."""
+        self.last_used = time.monotonic()
+        if self._waiters or not self._has_capacity():
+            return False
+        self.in_flight += 1
+        self.total_admitted += 1
+        return True
+
+    def release(self, status_code: int | None = None, retry_after: str | None = None):
+        self.in_flight = max(0, self.in_flight - 1)
+        if status_code in THROTTLE_STATUSES:
+            self.total_throttled += 1
+            self.limit = max(float(self.min_in_flight), self.limit / 2)
+            pause = parse_retry_after(retry_after)
+            if pause:
+                self.paused_until = max(self.paused_until, time.monotonic() + pause)
+        elif status_code is not None and status_code < 500:
+            self.limit = min(float(self.max_in_flight), self.limit + 1 / self.limit)
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self._has_capacity():
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+        if self._waiters and self.in_flight == 0 and self.paused_until > time.monotonic():
+            # Nothing in flight will call release(); wake the queue when the pause ends
+            if self._wake_handle is None or self._wake_handle.cancelled():
+                delay = self.paused_until - time.monotonic()
+                self._wake_handle = asyncio.get_running_loop().call_later(delay, self._on_pause_end)
+
+    def _on_pause_end(self):
+        self._wake_handle = None
+        self._wake()
+
+    def snapshot(self) -> dict:
+        waited = self.total_waited
+        return {
+            "limit": int(self.limit),
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "queue_depth": len(self._waiters),
+            "paused_for_ms": max(0, int((self.paused_until - time.monotonic()) * 1000)),
+            "total_admitted": self.total_admitted,
+            "total_queued": self.total_queued,
+            "total_rejected": self.total_rejected,
+            "total_throttled": self.total_throttled,
+            "avg_wait_ms": round(self.total_wait_ms / waited, 1) if waited else 0.0,
+            "max_wait_ms": round(self.max_wait_ms, 1),
+        }
+
+
+_gates: dict = {}
+_last_prune = 0.0
+
+
+def _prune_gates(max_gates: int, idle_seconds: float):
+    """Drop gates idle for ``idle_seconds``, then the least recently used idle ones over ``max_gates``.
+
+    Gates with requests in flight or queued are never dropped, so a key's
+    concurrency limit always holds.
+    """
+    global _last_prune
+    now = time.monotonic()
+    _last_prune = now
+    idle = sorted(
+        ((gate.last_used, key) for key, gate in _gates.items() if gate.idle),
+        key=lambda item: item[0],
+    )
+    excess = len(_gates) - max_gates
+    for last_used, key in idle:
+        if last_used > now - idle_seconds and excess <= 0:
+            break
+        del _gates[key]
+        excess -= 1
+
+
+def get_gate(key) -> UpstreamGate:
+    """Gate for one upstream key (see ``key_pool.PoolKey``)."""
+    gate = _gates.get(key)
+    if gate is None:
+        settings = get_settings()
+        if (len(_gates) >= settings.upstream_gates
+                or time.monotonic() - _last_prune > settings.upstream_gate_idle_seconds):
+            _prune_gates(settings.upstream_gates - 1, settings.upstream_gate_idle_seconds)
+        gate = UpstreamGate(
+            max_in_flight=settings.upstream_max_in_flight_per_key,
+            max_queue=settings.upstream_max_queue_per_key,
+            queue_timeout=settings.upstream_queue_timeout_seconds,
+        )
+        _gates[key] = gate
+    return gate
+
+
+def gate_snapshots() -> dict:
+    return {str(key): gate.snapshot() for key, gate in _gates.items()}
@@ -0,0 +1,238 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import DateTime, Uuid, insert
+from sqlmodel import Session
+
+from .config import get_settings
+from .database import get_engine, run_in_db_thread
+from .licenses import increment_usage_counters
+from .models import ProxyUsageLog, _utcnow
+from .rollups import apply_usage_rollups
+
+logger = logging.getLogger(__name__)
+
+# Spilled rows are JSON; these columns are restored to their Python types on
+# replay. Derived from the model so a new column cannot be missed.
+_UUID_FIELDS = tuple(c.name for c in ProxyUsageLog.__table__.columns if isinstance(c.type, Uuid))
+_DATETIME_FIELDS = tuple(
+    c.name for c in ProxyUsageLog.__table__.columns if isinstance(c.type, DateTime)
+)
+
+
+def usage_row(license, agent, **fields) -> dict:
+    """Build a ProxyUsageLog row for the sink from a license/agent snapshot."""
+    return {
+        "id": uuid.uuid4(),
+        "license_id": license.id,
+        "agent_profile_id": agent.id,
+        "buyer_id": license.buyer_id,
+        "created_at": _utcnow(),
+        **fields,
+    }
+
+
+def write_usage_rows(rows: list[dict]):
+    """Insert usage rows and apply their license counter deltas in one transaction.
+
+    Counters are aggregated per license and applied as ``x = x + delta``, so a
+    batch costs one multi-row INSERT plus one UPDATE per distinct license.
+    Token reservations are released whether or not the request succeeded.
+    The hourly/daily usage rollups are updated in the same transaction.
+    """
+    deltas = defaultdict(lambda: {"messages": 0, "tokens": 0, "cost": 0, "released": 0})
+    for row in rows:
+        delta = deltas[row["license_id"]]
+        delta["released"] += row.get("reserved_tokens", 0)
+        if row["success"]:
+            delta["messages"] += 1
+            delta["tokens"] += row["total_tokens"]
+            delta["cost"] += row["estimated_cost_cents"]
+
+    with Session(get_engine()) as session:
+        session.execute(insert(ProxyUsageLog), rows)
+        for license_id, delta in deltas.items():
+            increment_usage_counters(
+                session, license_id, delta["messages"], delta["tokens"], delta["cost"],
+                released_tokens=delta["released"],
+            )
+        apply_usage_rollups(session, rows)
+        session.commit()
+
+
+def _encode(row: dict) -> str:
+    return json.dumps(row, default=str)
+
+
+def _decode(line: str) -> dict:
+    row = json.loads(line)
+    for field in _UUID_FIELDS:
+        if row.get(field) is not None:
+            row[field] = uuid.UUID(row[field])
+    for field in _DATETIME_FIELDS:
+        if row.get(field) is not None:
+            row[field] = datetime.fromisoformat(row[field])
+    return row
+
+
+class UsageSink:
+    """Write-behind buffer for proxy usage records.
+
+    Records are flushed in bulk every ``flush_interval_ms`` or as soon as
+    ``max_batch`` are pending. If a flush fails the batch is appended to a
+    per-process spill file under ``spill_dir``; spill files (including ones
+    left by earlier or other processes) are replayed before the next batch.
+    Spilled lines that cannot be decoded (e.g. torn by a crash mid-append) are
+    moved to a ``quarantine-*.jsonl`` file for inspection instead of blocking
+    the rest.
+    """
+
+    def __init__(self, flush_interval_ms: int, max_batch: int, spill_dir: str):
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch = max_batch
+        self.spill_dir = spill_dir
+        self._buffer: list[dict] = []
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._flush_lock: asyncio.Lock | None = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def submit(self, row: dict):
+        self._buffer.append(row)
+        if self._task is None:
+            self._start_task()
+        if len(self._buffer) >= self.max_batch:
+            self._wakeup.set()
+
+    async def start(self):
+        if self._task is None:
+            self._start_task()
+
+    def _start_task(self):
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Usage sink flush failed")
+
+    async def flush(self):
+        async with self._flush_lock:
+            rows, self._buffer = self._buffer, []
+            if rows or self._spill_files():
+                await run_in_db_thread(self._flush_rows, rows)
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        await self.flush()
+        self._task = None
+
+    # Runs in a DB worker thread
+
+    def _flush_rows(self, rows: list[dict]):
+        try:
+            self._replay_spills()
+        except Exception:
+            # Never at the expense of the current batch
+            logger.exception("Replaying usage spill files failed")
+        if not rows:
+            return
+        try:
+            write_usage_rows(rows)
+        except Exception:
+            logger.exception("Usage flush of %d records failed; spilling to disk", len(rows))
+            self._spill(rows)
+
+    def _spill_files(self) -> list[str]:
+        return glob.glob(os.path.join(self.spill_dir, "spill-*.jsonl"))
+
+    def _spill(self, rows: list[dict]):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = os.path.join(self.spill_dir, f"spill-{os.getpid()}.jsonl")
+        with open(path, "a", encoding="utf-8") as f:
+            f.writelines(_encode(row) + "\n" for row in rows)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _quarantine(self, lines: list[str]):
+        path = os.path.join(self.spill_dir, f"quarantine-{os.getpid()}.jsonl")
+        with open(path, "a", encoding="utf-8") as f:
+            f.writelines(line if line.endswith("\n") else line + "\n" for line in lines)
+
+    def _replay_spills(self):
+        for path in self._spill_files():
+            # Claim the file by renaming it so concurrent workers never replay it twice
+            claimed = f"{path}.{os.getpid()}.replay"
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            try:
+                self._replay_file(path, claimed)
+            except Exception:
+                logger.exception("Replay of %s failed; keeping it spilled", path)
+                # Back under a fresh spill name, so it is retried and never
+                # clobbers a spill file written meanwhile
+                os.replace(claimed, os.path.join(
+                    self.spill_dir, f"spill-{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl"
+                ))
+
+    def _replay_file(self, path: str, claimed: str):
+        rows, bad = [], []
+        with open(claimed, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    rows.append(_decode(line))
+                except Exception:
+                    bad.append(line)
+        if bad:
+            logger.error("Quarantining %d unreadable usage records from %s", len(bad), path)
+            self._quarantine(bad)
+        if rows:
+            try:
+                write_usage_rows(rows)
+            except Exception:
+                logger.exception("Replay of %s failed; keeping it spilled", path)
+                self._spill(rows)
+        os.remove(claimed)
+
+
+_sink: UsageSink | None = None
+
+
+def get_usage_sink() -> UsageSink:
+    global _sink
+    if _sink is None:
+        settings = get_settings()
+        _sink = UsageSink(
+            flush_interval_ms=settings.usage_flush_interval_ms,
+            max_batch=settings.usage_flush_max_records,
+            spill_dir=settings.usage_spill_dir,
+        )
+    return _sink
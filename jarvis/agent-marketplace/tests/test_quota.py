@@ -0,0 +1,120 @@
+"""Redis quota accounting: reserve, settle and release against fakeredis."""
+
+import asyncio
+import time
+import uuid
+from datetime import datetime
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+
+from marketplace import quota
+from marketplace.quota import QuotaExceeded, acquire_quota, release_quota, settle_quota
+
+PERIOD_START = datetime(2026, 1, 1)
+
+
+@pytest.fixture
+def redis():
+    client = fakeredis.FakeAsyncRedis()
+    quota.set_redis(client)
+    yield client
+    quota.set_redis(None)
+
+
+def _plan(max_messages=None, max_tokens=None, rpm=None):
+    return SimpleNamespace(
+        max_messages_per_period=max_messages,
+        max_tokens_per_period=max_tokens,
+        max_requests_per_minute=rpm,
+    )
+
+
+def _usage(messages=0, tokens=0, reserved=0):
+    return {
+        "period_messages": messages,
+        "period_tokens": tokens,
+        "reserved_tokens": reserved,
+        "period_start": PERIOD_START,
+    }
+
+
+async def _counters(redis, license_id):
+    base, _, hold_tokens, _ = quota._keys(license_id)
+    counters = await redis.hgetall(base)
+    held = sum(int(v) for v in (await redis.hgetall(hold_tokens)).values())
+    return int(counters[b"messages"]), int(counters[b"tokens"]), held
+
+
+def test_reserve_and_settle_are_exact(redis):
+    async def run():
+        license = SimpleNamespace(id=uuid.uuid4())
+        plan = _plan(max_tokens=1000)
+
+        first = await acquire_quota(license, plan, _usage(), 100)
+        second = await acquire_quota(license, plan, _usage(), 900)
+        assert await _counters(redis, license.id) == (0, 0, 1000)
+        with pytest.raises(QuotaExceeded):
+            await acquire_quota(license, plan, _usage(), 1)
+
+        # Actual usage replaces the reservation
+        await settle_quota(first, 1, 40)
+        assert await _counters(redis, license.id) == (1, 40, 900)
+        third = await acquire_quota(license, plan, _usage(), 60)
+        with pytest.raises(QuotaExceeded):
+            await acquire_quota(license, plan, _usage(), 1)
+
+        # Settling twice counts once; a release counts nothing
+        await settle_quota(first, 1, 40)
+        await release_quota(second)
+        await settle_quota(third, 1, 60)
+        assert await _counters(redis, license.id) == (2, 100, 0)
+
+    asyncio.run(run())
+
+
+def test_in_flight_holds_count_against_message_limit(redis):
+    async def run():
+        license = SimpleNamespace(id=uuid.uuid4())
+        plan = _plan(max_messages=2)
+
+        holds = [await acquire_quota(license, plan, _usage(), 0) for _ in range(2)]
+        with pytest.raises(QuotaExceeded):
+            await acquire_quota(license, plan, _usage(), 0)
+        await release_quota(holds[0])
+        await acquire_quota(license, plan, _usage(), 0)
+
+    asyncio.run(run())
+
+
+def test_database_counters_and_reservations_are_honoured(redis):
+    async def run():
+        license = SimpleNamespace(id=uuid.uuid4())
+        plan = _plan(max_tokens=1000)
+
+        # 700 used plus 200 held by batches leaves 100
+        hold = await acquire_quota(license, plan, _usage(tokens=700, reserved=200), 100)
+        with pytest.raises(QuotaExceeded):
+            await acquire_quota(license, plan, _usage(tokens=700, reserved=200), 1)
+        await settle_quota(hold, 1, 50)
+        assert await _counters(redis, license.id) == (1, 750, 0)
+
+    asyncio.run(run())
+
+
+def test_local_rate_windows_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(quota, "_local_windows", None)
+    license_id = uuid.uuid4()
+    for _ in range(3):
+        quota._local_rate_check(license_id, 3)
+    with pytest.raises(QuotaExceeded) as rejected:
+        quota._local_rate_check(license_id, 3)
+    assert rejected.value.rate_limited
+
+    # A minute after its last request the window is empty and dropped
+    now[0] += 61
+    assert quota._get_local_windows().get(license_id) is None
+    quota._local_rate_check(license_id, 3)